@@ -0,0 +1,66 @@
+import logging
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from project_db import ProjectDB
+
+POLL_INTERVAL = 30
+
+
+class AnalysisState:
+    """Which DONE jobs of a project are in the knowledge graph.
+
+    Kept in the `analyzed_at` column of the project database, which is set
+    to the job's `finished_at` once its package is written, one commit per
+    package. A job compiled again finishes later and is pending again; the
+    compile status itself is left alone.
+    """
+
+    def __init__(self, project_root: str):
+        self.db = ProjectDB(os.path.join(project_root, "project_db.sqlite3"))
+        self.db.migrate()
+        self.logger = logging.getLogger("AnalysisState")
+
+    def pending(self) -> list:
+        """(id, package_name, optimization_level, dirname, finished_at) of the jobs to analyze."""
+        return self.db.execute(
+            "SELECT id, package_name, optimization_level, dirname, finished_at FROM packages "
+            "WHERE status = 'DONE' AND (analyzed_at IS NULL OR analyzed_at < finished_at) ORDER BY finished_at, id"
+        )
+
+    def mark(self, package: tuple):
+        """Checkpoints one row returned by `pending` as analyzed."""
+        self.db.execute("UPDATE packages SET analyzed_at = coalesce(?, 0) WHERE id = ?", (package[4], package[0]))
+
+    def reset(self):
+        """Makes every DONE job pending again, e.g. for an emptied graph."""
+        self.db.execute("UPDATE packages SET analyzed_at = NULL")
+
+    def compiling(self) -> bool:
+        return len(self.db.execute("SELECT 1 FROM packages WHERE status IN ('NOT_STARTED', 'STARTED') LIMIT 1")) > 0
+
+    def follow(self, poll_interval: float = POLL_INTERVAL):
+        """Yields batches of pending jobs as compilation finishes them.
+
+        Returns once no job is left to compile and every job has been
+        yielded. Jobs that were yielded but not marked, i.e. failed, are
+        not yielded again before the next run.
+        """
+        yielded = set()
+        while True:
+            # Asked first, so jobs finishing in between are not missed
+            compiling = self.compiling()
+            batch = [package for package in self.pending() if (package[0], package[4]) not in yielded]
+            if len(batch) > 0:
+                yielded.update((package[0], package[4]) for package in batch)
+                yield batch
+                continue
+            if not compiling:
+                return
+            self.logger.debug("Waiting for jobs to finish")
+            time.sleep(poll_interval)
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""Bulk ingestion of a compile project into Neo4j.
+
+`analyze_package` costs several round trips per file and one per edge.
+Here a process pool reads, hashes and classifies the files of whole
+packages, and every package is then written in one transaction of
+`UNWIND ... MERGE` batches: a handful of round trips per package instead
+of tens of thousands. The graph has the same shape as the one built
+through the OGM classes of node.py.
+"""
+import argparse
+import collections
+import concurrent.futures
+import logging
+import os
+import sys
+
+from py2neo import Graph
+
+from analysis_state import AnalysisState
+from node import describe_file, KnowledgeGraphNode
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from file_cache import FileCache
+from job_archive import open_job
+
+BATCH_SIZE = 1000
+# Labels of file nodes, see the KnowledgeGraphNode subclasses in node.py
+LABELS = [cls.__name__ for cls in KnowledgeGraphNode.__subclasses__()]
+
+MERGE_PACKAGE = """
+MERGE (p:Package {dirname: $dirname})
+SET p.package_name = $package_name, p.optimization_level = $optimization_level
+"""
+
+MERGE_FILES = """
+UNWIND $rows AS row
+MERGE (n:%s {hash: row.hash})
+ON CREATE SET n.name = row.name, n.magic_info = row.magic_info, n.description = row.description, n.language = row.language
+WITH n, row
+MATCH (p:Package {dirname: $dirname})
+MERGE (n)-[:BelongsTo]->(p)
+WITH n, row
+UNWIND row.urls AS path
+MERGE (u:Url {path: path})
+MERGE (n)-[:LocatedAt]->(u)
+"""
+
+MERGE_EDGES = """
+UNWIND $rows AS row
+MATCH (a:%s {hash: row.src}), (b:%s {hash: row.dst})
+MERGE (a)-[:%s]->(b)
+"""
+
+
+def scan_task(job, package_url: str, task_url: str, files: dict, skipped: list, cache: FileCache = None):
+    """Classifies the input and output files of one task, returns their keys."""
+    res = []
+    for direction in ("input", "output"):
+        keys = []
+        direction_url = os.path.join(task_url, direction)
+        if job.isdir(direction_url):
+            for object_name in job.listdir(direction_url):
+                file_name = os.path.join(direction_url, object_name)
+                file_url = os.path.join(package_url, file_name)
+                record = describe_file(job, file_name, file_url, cache)
+                if record["node_type"] is None:
+                    skipped.append((file_url, record["description"]))
+                    continue
+                key = (record["node_type"], record["hash"])
+                if key not in files:
+                    files[key] = {
+                        "hash": key[1],
+                        "name": object_name,
+                        "magic_info": record["magic_info"],
+                        "description": record["description"],
+                        "language": record["language"],
+                        "urls": []
+                    }
+                files[key]["urls"].append(file_url)
+                keys.append(key)
+        res.append(keys)
+    return res
+
+
+def scan_package(project_root: str, dirname: str) -> dict:
+    """Reads one job and returns its file nodes and edges, runs in a worker process."""
+    package_url = os.path.join("packages", dirname)
+    files = {}
+    edges = set()
+    skipped = []
+    with open_job(os.path.join(project_root, "packages"), dirname) as job, FileCache(project_root) as cache:
+        for task_name in job.listdir("gcc"):
+            inputs, outputs = scan_task(job, package_url, os.path.join("gcc", task_name), files, skipped, cache)
+            for src in inputs:
+                for dst in outputs:
+                    edges.add((src, "GCC_C" if dst[0] == "Relocatable" else "GCC", dst))
+        for task_name in job.listdir("ld"):
+            inputs, outputs = scan_task(job, package_url, os.path.join("ld", task_name), files, skipped, cache)
+            for src in inputs:
+                for dst in outputs:
+                    edges.add((src, "LD", dst))
+    return {"files": files, "edges": edges, "skipped": skipped}
+
+
+def _batches(rows: list):
+    for idx in range(0, len(rows), BATCH_SIZE):
+        yield rows[idx:idx + BATCH_SIZE]
+
+
+def write_package(graph: Graph, package_name: str, optimization_level: str, dirname: str, scan: dict) -> int:
+    """Writes a scanned package in one transaction, returns the number of round trips."""
+    nodes = collections.defaultdict(list)
+    for (label, _), row in scan["files"].items():
+        nodes[label].append(row)
+    edges = collections.defaultdict(list)
+    for (src_label, src_hash), rel_type, (dst_label, dst_hash) in scan["edges"]:
+        edges[(src_label, rel_type, dst_label)].append({"src": src_hash, "dst": dst_hash})
+
+    tx = graph.begin()
+    try:
+        tx.run(MERGE_PACKAGE, dirname=dirname, package_name=package_name, optimization_level=optimization_level)
+        calls = 1
+        for label, rows in nodes.items():
+            for batch in _batches(rows):
+                tx.run(MERGE_FILES % label, rows=batch, dirname=dirname)
+                calls += 1
+        for (src_label, rel_type, dst_label), rows in edges.items():
+            for batch in _batches(rows):
+                tx.run(MERGE_EDGES % (src_label, dst_label, rel_type), rows=batch)
+                calls += 1
+    except BaseException:
+        graph.rollback(tx)
+        raise
+    graph.commit(tx)
+    return calls + 1
+
+
+def create_indexes(graph: Graph):
+    # Every MERGE above looks nodes up by these keys
+    for label in LABELS:
+        graph.run(f"CREATE INDEX IF NOT EXISTS FOR (n:{label}) ON (n.hash)")
+    graph.run("CREATE INDEX IF NOT EXISTS FOR (n:Url) ON (n.path)")
+    graph.run("CREATE INDEX IF NOT EXISTS FOR (n:Package) ON (n.dirname)")
+
+
+def scan_packages(project_root: str, packages: list, max_workers: int = None):
+    """Scans rows starting with (id, package_name, optimization_level, dirname) in a process pool.
+
+    Yields (package, scan, error) in completion order. Scans are held in
+    memory until consumed, so only a few run ahead of the consumer.
+    """
+    max_workers = max_workers or os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        queue = iter(packages)
+        while True:
+            for package in queue:
+                pending[executor.submit(scan_package, project_root, package[3])] = package
+                if len(pending) >= max_workers * 2:
+                    break
+            if len(pending) == 0:
+                break
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                package = pending.pop(future)
+                error = future.exception()
+                yield package, future.result() if error is None else None, error
+
+
+def analyze_project_bulk(graph: Graph, project_root: str, max_workers: int = None, follow: bool = False):
+    """Ingests the DONE packages not in the graph yet, scanning up to `max_workers` packages at once.
+
+    Every package is checkpointed once written. With `follow`, packages
+    finishing meanwhile are picked up until the project is compiled.
+    """
+    logger = logging.getLogger("BulkIngest")
+    create_indexes(graph)
+    state = AnalysisState(project_root)
+    try:
+        batches = state.follow() if follow else [state.pending()]
+        for batch in batches:
+            for package, scan, error in scan_packages(project_root, batch, max_workers):
+                dirname = package[3]
+                try:
+                    if error is not None:
+                        raise error
+                    calls = write_package(graph, package[1], package[2], dirname, scan)
+                except Exception as e:
+                    logger.error("Error analyzing package %s: %s", dirname, e)
+                    continue
+                for file_url, description in scan["skipped"]:
+                    logger.debug("File type not supported, description: \"%s\", path: \"%s\"", description, file_url)
+                logger.info("Package %s: %d files, %d edges, %d skipped, %d round trips",
+                            dirname, len(scan["files"]), len(scan["edges"]), len(scan["skipped"]), calls)
+                state.mark(package)
+    finally:
+        state.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest a compile project into Neo4j in bulk")
+    parser.add_argument("project", type=str, help="Project path")
+    parser.add_argument("-j", "--parallel", type=int, default=os.cpu_count(), help="Packages scanned at the same time")
+    parser.add_argument("--uri", type=str, default="bolt://localhost:7687", help="Neo4j URI")
+    parser.add_argument("--user", type=str, default="neo4j", help="Neo4j user")
+    parser.add_argument("--password", type=str, default="test", help="Neo4j password")
+    parser.add_argument("-f", "--follow", action="store_true", help="Keep ingesting jobs as they finish until the project is compiled")
+    parser.add_argument("--reset", action="store_true", help="Ingest every DONE job again, e.g. into an emptied graph")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.reset:
+        state = AnalysisState(args.project)
+        state.reset()
+        state.close()
+    graph = Graph(args.uri, auth=(args.user, args.password))
+    analyze_project_bulk(graph, args.project, args.parallel, args.follow)
+
+
+if __name__ == '__main__':
+    main()
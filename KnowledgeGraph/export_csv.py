@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""Offline export of the knowledge graph for `neo4j-admin database import`.
+
+Walks the DONE packages of a compile project with the scanner of
+bulk_ingest and streams deduplicated node and relationship CSVs, ready
+for a full import into an empty database. Nothing but the current scans
+is held in memory. Files and edges seen before are remembered in a
+side-car SQLite database next to the CSVs, which is removed once the
+export is complete.
+
+The graph has the same shape as the one built through node.py: file
+nodes labelled by type and keyed by (label, hash), Package and Url
+nodes, and BelongsTo, LocatedAt, GCC, GCC_C and LD relationships.
+"""
+import argparse
+import csv
+import logging
+import os
+import sqlite3
+import sys
+
+from bulk_ingest import scan_packages
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from project_db import ProjectDB
+
+CSV_FILES = {
+    "packages": [":ID(Package)", "dirname", "package_name", "optimization_level"],
+    "files": [":ID(File)", "hash", "name", "magic_info", "description", "language", ":LABEL"],
+    "urls": ["path:ID(Url)"],
+    "belongs_to": [":START_ID(File)", ":END_ID(Package)", ":TYPE"],
+    "located_at": [":START_ID(File)", ":END_ID(Url)", ":TYPE"],
+    "edges": [":START_ID(File)", ":END_ID(File)", ":TYPE"],
+}
+
+
+class CsvExporter:
+    def __init__(self, output_path: str):
+        self.output_path = output_path
+        self.logger = logging.getLogger("CsvExporter")
+        os.makedirs(output_path, exist_ok=True)
+        self.seen_path = os.path.join(output_path, ".seen.sqlite3")
+        if os.path.exists(self.seen_path):
+            os.remove(self.seen_path)
+        self.seen = sqlite3.connect(self.seen_path, isolation_level=None)
+        self.seen.execute("PRAGMA journal_mode = OFF")
+        self.seen.execute("PRAGMA synchronous = OFF")
+        self.seen.execute("CREATE TABLE files (id TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.seen.execute("CREATE TABLE edges (src TEXT, dst TEXT, type TEXT, PRIMARY KEY (src, dst, type)) WITHOUT ROWID")
+        self.files = {}
+        self.writers = {}
+        for name, header in CSV_FILES.items():
+            self.files[name] = open(os.path.join(output_path, f"{name}.csv"), "w", newline="")
+            self.writers[name] = csv.writer(self.files[name])
+            self.writers[name].writerow(header)
+        self.counts = dict.fromkeys(CSV_FILES, 0)
+
+    def _write(self, name: str, row: list):
+        self.writers[name].writerow(row)
+        self.counts[name] += 1
+
+    def _first(self, table: str, key: tuple) -> bool:
+        placeholders = ", ".join("?" * len(key))
+        return self.seen.execute(f"INSERT OR IGNORE INTO {table} VALUES ({placeholders})", key).rowcount == 1
+
+    def add_package(self, package_name: str, optimization_level: str, dirname: str, scan: dict):
+        self._write("packages", [dirname, dirname, package_name, optimization_level])
+        self.seen.execute("BEGIN")
+        for (label, digest), row in scan["files"].items():
+            file_id = f"{label}:{digest}"
+            if self._first("files", (file_id,)):
+                self._write("files", [file_id, digest, row["name"], row["magic_info"] or "", row["description"], row["language"] or "", label])
+            # Packages and paths are unique, so are these
+            self._write("belongs_to", [file_id, dirname, "BelongsTo"])
+            for path in row["urls"]:
+                self._write("urls", [path])
+                self._write("located_at", [file_id, path, "LocatedAt"])
+        for (src_label, src_hash), rel_type, (dst_label, dst_hash) in scan["edges"]:
+            src, dst = f"{src_label}:{src_hash}", f"{dst_label}:{dst_hash}"
+            if self._first("edges", (src, dst, rel_type)):
+                self._write("edges", [src, dst, rel_type])
+        self.seen.execute("COMMIT")
+
+    def import_command(self) -> str:
+        path = lambda name: os.path.join(os.path.abspath(self.output_path), f"{name}.csv")
+        return " ".join([
+            "neo4j-admin database import full",
+            f"--nodes=Package={path('packages')}",
+            f"--nodes={path('files')}",
+            f"--nodes=Url={path('urls')}",
+            f"--relationships={path('belongs_to')}",
+            f"--relationships={path('located_at')}",
+            f"--relationships={path('edges')}",
+            "neo4j"
+        ])
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.seen.close()
+        os.remove(self.seen_path)
+
+
+def export_project(project_root: str, output_path: str, max_workers: int = None) -> CsvExporter:
+    logger = logging.getLogger("CsvExporter")
+    db = ProjectDB(os.path.join(project_root, "project_db.sqlite3"))
+    db.migrate()
+    packages = db.execute("SELECT id, package_name, optimization_level, dirname FROM packages WHERE status = 'DONE'")
+    db.close()
+    exporter = CsvExporter(output_path)
+    try:
+        for (pid, package_name, optimization_level, dirname), scan, error in scan_packages(project_root, packages, max_workers):
+            if error is not None:
+                logger.error("Error exporting package %s: %s", dirname, error)
+                continue
+            exporter.add_package(package_name, optimization_level, dirname, scan)
+    finally:
+        exporter.close()
+    logger.info("Exported %s", ", ".join(f"{count} {name}" for name, count in exporter.counts.items()))
+    return exporter
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a compile project as CSVs for neo4j-admin database import")
+    parser.add_argument("project", type=str, help="Project path")
+    parser.add_argument("output", type=str, help="Directory for the CSV files")
+    parser.add_argument("-j", "--parallel", type=int, default=os.cpu_count(), help="Packages scanned at the same time")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    exporter = export_project(args.project, args.output, args.parallel)
+    print(exporter.import_command())
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,13 @@
 from py2neo import *
 from py2neo.ogm import *
-from pygments.lexers import get_lexer_for_filename
 
-import magic
 import os
 import hashlib
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import classifier
+from file_cache import FileCache
 
 
 class NodeTypeNotImplemented(Exception):
@@ -37,11 +40,13 @@ class KnowledgeGraphNode(Model):
     __primarykey__ = "hash"
     name = Property()
     hash = Property()
+    # libmagic's description, None if the file was classified without it
     magic_info = Property()
+    description = Property()
     url = RelatedTo(Url, "LocatedAt")
     package = RelatedTo(Package, "BelongsTo")
 
-    def __init__(self, path: str):
+    def __init__(self, path: str, hash: str = None, magic_info: str = None, description: str = None):
         def calc_file_hash(target_file_path: str) -> str:
             """Returns the SHA256 hash of the file at the given path."""
             sha256 = hashlib.sha256()
@@ -53,39 +58,80 @@ class KnowledgeGraphNode(Model):
                     sha256.update(data)
             return sha256.hexdigest()
         super(KnowledgeGraphNode, self).__init__()
-        self.hash = calc_file_hash(path)
-        self.magic_info = magic.from_file(path)
+        # Packed jobs have both at hand, see job_archive.JobArchive
+        self.hash = hash or calc_file_hash(path)
+        if description is None:
+            with open(path, "rb") as f:
+                description, magic_info = classifier.classify(path, f.read(classifier.HEAD_SIZE))[2:]
+        self.magic_info = magic_info
+        self.description = description
         self.name = os.path.basename(path)
 
 
 class Source(KnowledgeGraphNode):
     language = Property()
 
-    def __init__(self, path: str, language: str):
-        super(Source, self).__init__(path)
+    def __init__(self, path: str, language: str, **kwargs):
+        super(Source, self).__init__(path, **kwargs)
         self.language = language
 
 
 class Relocatable(KnowledgeGraphNode):
-    def __init__(self, path: str):
-        super(Relocatable, self).__init__(path)
+    def __init__(self, path: str, **kwargs):
+        super(Relocatable, self).__init__(path, **kwargs)
 
 
 class Executable(KnowledgeGraphNode):
-    def __init__(self, path: str):
-        super(Executable, self).__init__(path)
+    def __init__(self, path: str, **kwargs):
+        super(Executable, self).__init__(path, **kwargs)
 
 
 class ArchiveLib(KnowledgeGraphNode):
-    def __init__(self, path: str):
-        super(ArchiveLib, self).__init__(path)
+    def __init__(self, path: str, **kwargs):
+        super(ArchiveLib, self).__init__(path, **kwargs)
 
 
 class SharedLib(KnowledgeGraphNode):
-    def __init__(self, path: str):
-        super(SharedLib, self).__init__(path)
+    def __init__(self, path: str, **kwargs):
+        super(SharedLib, self).__init__(path, **kwargs)
 
 
 class Dummy(KnowledgeGraphNode):
-    def __init__(self, path: str):
-        super(Dummy, self).__init__(path)
+    def __init__(self, path: str, **kwargs):
+        super(Dummy, self).__init__(path, **kwargs)
+
+
+def classify(file_url: str, file_info: str):
+    """Returns the node class of a file and its extra arguments, or (None, {})."""
+    node_type, language = classifier.classify_magic(file_url, file_info)
+    if node_type is None:
+        return None, {}
+    return NODE_TYPES[node_type], {"language": language} if node_type == "Source" else {}
+
+
+# Node classes by name, as stored in the file cache
+NODE_TYPES = {cls.__name__: cls for cls in KnowledgeGraphNode.__subclasses__()}
+
+
+def describe_file(job, file_name: str, file_url: str, cache: FileCache = None) -> dict:
+    """Returns the hash, magic info, description, node type and language of a file of a job.
+
+    With a cache, a file that has not changed since it was last described
+    is not read at all.
+    """
+    stat = job.stat(file_name)
+    record = cache.get(file_url, stat) if cache is not None else None
+    if record is not None:
+        return record
+    data = job.read(file_name)
+    node_type, language, description, magic_info = classifier.classify(file_url, data)
+    record = {
+        "hash": hashlib.sha256(data).hexdigest(),
+        "magic_info": magic_info,
+        "description": description,
+        "node_type": node_type,
+        "language": language
+    }
+    if cache is not None:
+        cache.put(file_url, stat, **record)
+    return record
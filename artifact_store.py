@@ -0,0 +1,138 @@
+import errno
+import hashlib
+import logging
+import os
+import stat
+import time
+import uuid
+
+HASH_CHUNK = 65536
+# Blobs deleted per statement in gc()
+GC_BATCH = 500
+
+
+class ArtifactStore:
+    """Content-addressed storage shared by the outputs of every job.
+
+    At the end of a job, `ingest()` hashes every regular file of its output
+    directory with SHA-256. The first copy of some content and mode is
+    hardlinked into `<root>/<h[0:2]>/<h[2:4]>/<h>.<mode>` and becomes the
+    blob; every later copy with the same mode is replaced by a hardlink to
+    that blob. Headers and sources shared by the optimization levels of a
+    package, and objects shared across packages, then take one inode and
+    their size once. An inode has one mode, so an executable and a header
+    of the same content stay apart, and no file has its mode changed.
+
+    Files keep their paths, so readers need not know about the store. A
+    blob whose job directories were all deleted has only the store's link
+    left and is removed by `gc()`.
+    """
+
+    def __init__(self, db, root: str):
+        self.db = db
+        self.root = root
+        self.logger = logging.getLogger("ArtifactStore")
+        os.makedirs(root, exist_ok=True)
+
+    def blob_path(self, key: str) -> str:
+        return os.path.join(self.root, key[0:2], key[2:4], key)
+
+    @staticmethod
+    def blob_key(digest: str, st: os.stat_result) -> str:
+        """Names the blob of a content and mode, the `hash` of the blobs table."""
+        return f"{digest}.{stat.S_IMODE(st.st_mode):04o}"
+
+    @staticmethod
+    def file_hash(path: str) -> str:
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(HASH_CHUNK)
+                if not data:
+                    break
+                sha256.update(data)
+        return sha256.hexdigest()
+
+    def _link(self, path: str, st: os.stat_result, key: str) -> bool:
+        """Makes `path` a link of its blob, returns True if it was a duplicate."""
+        blob = self.blob_path(key)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        try:
+            # The first copy becomes the blob
+            os.link(path, blob)
+            return False
+        except FileExistsError:
+            pass
+        if os.stat(blob).st_ino == st.st_ino:
+            return False
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.link(blob, tmp)
+            os.replace(tmp, path)
+        except OSError as e:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            # Too many links to one inode, or another filesystem: keep the copy
+            if e.errno not in (errno.EMLINK, errno.EXDEV):
+                raise
+            return False
+        return True
+
+    def ingest(self, package_id: int, path: str) -> dict:
+        """Deduplicates the files below `path` and records what it saved."""
+        res = {"files": 0, "bytes": 0, "deduplicated_files": 0, "deduplicated_bytes": 0}
+        blobs = []
+        for root, dirs, files in os.walk(path):
+            for file_name in files:
+                file_path = os.path.join(root, file_name)
+                try:
+                    st = os.lstat(file_path)
+                    if not stat.S_ISREG(st.st_mode):
+                        continue
+                    key = self.blob_key(self.file_hash(file_path), st)
+                    duplicate = self._link(file_path, st, key)
+                except OSError as e:
+                    self.logger.warning("Failed to store %s: %s", file_path, e)
+                    continue
+                res["files"] += 1
+                res["bytes"] += st.st_size
+                if duplicate:
+                    res["deduplicated_files"] += 1
+                    res["deduplicated_bytes"] += st.st_size
+                else:
+                    blobs.append((key, st.st_size, time.time()))
+        with self.db.transaction() as cursor:
+            cursor.executemany("INSERT OR IGNORE INTO blobs (hash, size, created_at) VALUES (?, ?, ?)", blobs)
+            cursor.execute(
+                "UPDATE packages SET deduplicated_files = ?, deduplicated_bytes = ? WHERE id = ?",
+                (res["deduplicated_files"], res["deduplicated_bytes"], package_id)
+            )
+        self.logger.info("Stored %d files of %s, %d duplicates (%d bytes)",
+                         res["files"], path, res["deduplicated_files"], res["deduplicated_bytes"])
+        return res
+
+    def gc(self) -> int:
+        """Removes blobs no job directory links to any more."""
+        removed = []
+        for root, dirs, files in os.walk(self.root):
+            for key in files:
+                blob = os.path.join(root, key)
+                try:
+                    if os.lstat(blob).st_nlink == 1:
+                        os.remove(blob)
+                        removed.append(key)
+                except OSError as e:
+                    self.logger.warning("Failed to remove blob %s: %s", blob, e)
+        with self.db.transaction() as cursor:
+            for idx in range(0, len(removed), GC_BATCH):
+                batch = removed[idx:idx + GC_BATCH]
+                cursor.execute(f"DELETE FROM blobs WHERE hash IN ({', '.join('?' * len(batch))})", batch)
+        self.logger.info("Removed %d unreferenced blobs", len(removed))
+        return len(removed)
+
+    def stats(self) -> dict:
+        blobs, blob_bytes = self.db.execute("SELECT count(*), coalesce(sum(size), 0) FROM blobs")[0]
+        files, saved = self.db.execute(
+            "SELECT coalesce(sum(deduplicated_files), 0), coalesce(sum(deduplicated_bytes), 0) FROM packages"
+        )[0]
+        return {"blobs": blobs, "blob_bytes": blob_bytes, "deduplicated_files": files, "deduplicated_bytes": saved}
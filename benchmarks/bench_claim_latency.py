@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""Claim latency as the DONE fraction of a project grows.
+
+Builds a project-sized job table, marks the first part of it DONE and times
+batched claims of the next NOT_STARTED jobs, once on the original schema
+(no index on status) and once on the current one.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from project_db import ProjectDB, MIGRATIONS
+
+CLAIM = "UPDATE packages SET status = ?, worker_id = ?, claimed_at = ? WHERE id IN (SELECT id FROM packages WHERE status = ? ORDER BY priority DESC, id LIMIT ?) RETURNING id"
+
+
+def create_db(db_path: str, rows: int, migrations) -> ProjectDB:
+    db = ProjectDB(db_path)
+    db.migrate(migrations)
+    if len(migrations) < len(MIGRATIONS):
+        # The claim statement needs the columns even on the old schema
+        for migration in MIGRATIONS[len(migrations):]:
+            for statement in migration:
+                if statement.startswith("ALTER TABLE packages"):
+                    db.execute(statement)
+    with db.transaction() as conn:
+        conn.executemany(
+            "INSERT INTO packages (package_name, optimization_level, status, dirname) VALUES (?, ?, ?, ?)",
+            ((f"pkg{i // 7}", str(i % 7), "NOT_STARTED", f"pkg{i}") for i in range(rows))
+        )
+    return db
+
+
+def measure(db: ProjectDB, rows: int, fraction: float, batch: int, claims: int) -> float:
+    db.execute("UPDATE packages SET status = 'DONE' WHERE id <= ?", (int(rows * fraction),))
+    db.execute("UPDATE packages SET status = 'NOT_STARTED' WHERE id > ?", (int(rows * fraction),))
+    start = time.perf_counter()
+    for _ in range(claims):
+        with db.transaction():
+            db.execute(CLAIM, ("STARTED", "bench", time.time(), "NOT_STARTED", batch))
+    return (time.perf_counter() - start) / claims
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--rows", type=int, default=82000 * 7, help="Rows in the packages table")
+    parser.add_argument("-b", "--batch", type=int, default=16, help="Jobs per claim")
+    parser.add_argument("-c", "--claims", type=int, default=200, help="Claims per measurement")
+    args = parser.parse_args()
+    fractions = (0.0, 0.5, 0.9, 0.99)
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, migrations in (("unindexed", MIGRATIONS[:1]), ("indexed", MIGRATIONS)):
+            db = create_db(os.path.join(tmp, f"{name}.sqlite3"), args.rows, migrations)
+            for fraction in fractions:
+                latency = measure(db, args.rows, fraction, args.batch, args.claims)
+                print(f"{name:>10}: {fraction * 100:5.1f}% DONE, {latency * 1000:8.3f} ms per claim of {args.batch}")
+            db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""File classification throughput, libmagic and pygments vs classifier.py.
+
+Classifies an in-memory mix of the files found in compile jobs: C and
+C++ sources and headers, relocatables, executables, ar archives and a
+few other text files. The libmagic path is what create_node did before
+classifier.py: magic.from_buffer, then a pygments lexer for plain text.
+It needs python-magic and is skipped without it.
+"""
+import argparse
+import os
+import random
+import struct
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import classifier
+
+
+def elf(e_type: int, size: int) -> bytes:
+    header = b"\x7fELF\x02\x01\x01" + b"\x00" * 9 + struct.pack("<HHI", e_type, 62, 1) + b"\x00" * 40
+    return header + random.randbytes(size - len(header))
+
+
+def create_files(count: int) -> list:
+    source = "#include <stdio.h>\n\nint func%d(int x) {\n    return x * %d;\n}\n" * 20
+    makers = [
+        lambda idx: (f"file{idx}.c", (source % ((idx,) * 40)).encode()),
+        lambda idx: (f"file{idx}.cpp", (source % ((idx,) * 40)).replace("stdio.h", "vector").encode()),
+        lambda idx: (f"file{idx}.h", b"#ifndef H\n#define H\nint common(void);\n#endif\n"),
+        lambda idx: (f"file{idx}.o", elf(1, 16384)),
+        lambda idx: (f"prog{idx}", elf(2, 65536)),
+        lambda idx: (f"lib{idx}.a", b"!<arch>\n" + random.randbytes(32768)),
+        lambda idx: (f"file{idx}.s", b"\t.text\n\t.globl main\nmain:\n\tret\n" * 10),
+        lambda idx: ("Makefile", b"all:\n\tcc -o prog prog.c\n"),
+    ]
+    return [makers[idx % len(makers)](idx) for idx in range(count)]
+
+
+def libmagic_classify(file_name: str, data: bytes) -> tuple:
+    import magic
+    from pygments.lexers import get_lexer_for_filename
+    file_info = magic.from_buffer(data)
+    if file_info.startswith("ASCII text"):
+        try:
+            guess_type = get_lexer_for_filename(file_name).name
+        except Exception:
+            return None, None, file_info
+        if guess_type in ("C", "C++"):
+            return "Source", guess_type, file_info
+        return None, None, file_info
+    return (*classifier.classify_magic(file_name, file_info), file_info)
+
+
+def run(name: str, classify, files: list) -> list:
+    start = time.perf_counter()
+    res = [classify(file_name, data)[:2] for file_name, data in files]
+    elapsed = time.perf_counter() - start
+    print(f"{name:>12}: {len(files) / elapsed:10.0f} files/s")
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--files", type=int, default=20000, help="Files to classify")
+    args = parser.parse_args()
+    random.seed(0)
+    files = create_files(args.files)
+    fast = run("classifier", classifier.classify, files)
+    if classifier.magic is None:
+        print("    libmagic: skipped, python-magic is not installed")
+        return
+    slow = run("libmagic", libmagic_classify, files)
+    differ = sum(1 for a, b in zip(fast, slow) if a != b)
+    print(f"   different: {differ} of {len(files)} files")
+
+
+if __name__ == '__main__':
+    main()
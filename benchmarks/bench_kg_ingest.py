@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Knowledge graph ingestion throughput, per-object vs bulk.
+
+Builds a synthetic project of DONE jobs, each with gcc tasks compiling a
+few C sources (shared headers included) into relocatables and one ld task
+linking them. With --uri, both analyze_project (one round trip per object
+and edge) and analyze_project_bulk run against that Neo4j, which should be
+an empty scratch database. Without it, the bulk path writes to a stub
+graph that charges --latency per round trip.
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "KnowledgeGraph"))
+import analyze_project
+import bulk_ingest
+
+# Just enough of an ELF header to be classified as a relocatable
+ELF_REL = b"\x7fELF\x02\x01\x01" + b"\x00" * 9 + struct.pack("<HHI", 1, 62, 1) + b"\x00" * 40
+
+
+def create_project(project_root: str, packages: int, tasks: int):
+    os.makedirs(os.path.join(project_root, "packages"))
+    db = sqlite3.connect(os.path.join(project_root, "project_db.sqlite3"))
+    db.execute("CREATE TABLE packages (id INTEGER PRIMARY KEY AUTOINCREMENT, package_name TEXT, optimization_level TEXT, status TEXT, dirname TEXT)")
+    for idx in range(packages):
+        dirname = f"pkg{idx}_O2"
+        for task in range(tasks):
+            task_path = os.path.join(project_root, "packages", dirname, "gcc", str(task))
+            os.makedirs(os.path.join(task_path, "input"))
+            os.makedirs(os.path.join(task_path, "output"))
+            with open(os.path.join(task_path, "input", f"file{task}.c"), "w") as f:
+                f.write(f"#include <stdio.h>\nint func{idx}_{task}(void) {{\n    return {task};\n}}\n")
+            with open(os.path.join(task_path, "input", "common.h"), "w") as f:
+                f.write("#include <stdio.h>\nint common(void);\n")
+            with open(os.path.join(task_path, "output", f"file{task}.o"), "wb") as f:
+                f.write(ELF_REL + f"{idx}_{task}".encode())
+        ld_path = os.path.join(project_root, "packages", dirname, "ld", "0")
+        os.makedirs(os.path.join(ld_path, "output"))
+        shutil.copytree(os.path.join(project_root, "packages", dirname, "gcc", "0", "output"), os.path.join(ld_path, "input"))
+        db.execute(
+            "INSERT INTO packages (package_name, optimization_level, status, dirname) VALUES (?, ?, ?, ?)",
+            (f"pkg{idx}", "2", "DONE", dirname)
+        )
+    db.commit()
+    db.close()
+
+
+def reset(project_root: str):
+    db = sqlite3.connect(os.path.join(project_root, "project_db.sqlite3"))
+    db.execute("UPDATE packages SET analyzed_at = NULL")
+    db.commit()
+    db.close()
+
+
+class StubGraph:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+
+    def _call(self):
+        self.calls += 1
+        time.sleep(self.latency)
+
+    def run(self, *args, **kwargs):
+        self._call()
+
+    def begin(self):
+        return self
+
+    def commit(self, tx):
+        self._call()
+
+    def rollback(self, tx):
+        self._call()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--packages", type=int, default=50, help="Packages in the project")
+    parser.add_argument("-t", "--tasks", type=int, default=20, help="gcc tasks per package")
+    parser.add_argument("-j", "--parallel", type=int, default=os.cpu_count(), help="Packages scanned at the same time")
+    parser.add_argument("--uri", type=str, help="Neo4j to benchmark against, e.g. bolt://localhost:7687")
+    parser.add_argument("--password", type=str, default="test", help="Neo4j password")
+    parser.add_argument("--latency", type=float, default=0.0005, help="Seconds per round trip of the stub graph")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        create_project(tmp, args.packages, args.tasks)
+        if args.uri:
+            from py2neo import Graph
+            graph = Graph(args.uri, auth=("neo4j", args.password))
+            graph.run("MATCH (n) DETACH DELETE n")
+            start = time.perf_counter()
+            analyze_project.analyze_project(graph, tmp)
+            elapsed = time.perf_counter() - start
+            print(f"  per-object: {args.packages / elapsed:8.2f} packages/s")
+            graph.run("MATCH (n) DETACH DELETE n")
+            reset(tmp)
+        else:
+            graph = StubGraph(args.latency)
+        start = time.perf_counter()
+        bulk_ingest.analyze_project_bulk(graph, tmp, args.parallel)
+        elapsed = time.perf_counter() - start
+        print(f"        bulk: {args.packages / elapsed:8.2f} packages/s")
+        if not args.uri:
+            print(f"        bulk: {graph.calls / args.packages:8.2f} round trips per package")
+
+
+if __name__ == '__main__':
+    main()
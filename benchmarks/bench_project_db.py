@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Claim/update throughput of the project database at high parallelism.
+
+Compares the old connect-execute-commit-close pattern against the pooled
+WAL connections of ProjectDB, with every worker thread doing what a
+compile slot does: claim one NOT_STARTED row, then mark it DONE.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from project_db import ProjectDB
+
+CLAIM = "UPDATE packages SET status = ? WHERE id IN (SELECT id FROM packages WHERE status = ? LIMIT ?) RETURNING id"
+FINISH = "UPDATE packages SET status = ? WHERE id = ?"
+
+
+def create_db(db_path: str, rows: int):
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE packages (id INTEGER PRIMARY KEY AUTOINCREMENT, package_name TEXT, optimization_level TEXT, status TEXT, dirname TEXT)")
+    conn.executemany(
+        "INSERT INTO packages (package_name, optimization_level, status, dirname) VALUES (?, ?, ?, ?)",
+        ((f"pkg{i // 7}", str(i % 7), "NOT_STARTED", f"pkg{i}") for i in range(rows))
+    )
+    conn.commit()
+    conn.close()
+
+
+def legacy_exec(db_path: str):
+    def db_exec(*args):
+        while True:
+            try:
+                db_conn = sqlite3.connect(db_path)
+                break
+            except sqlite3.Error:
+                continue
+        res = db_conn.execute(*args).fetchall()
+        db_conn.commit()
+        db_conn.close()
+        return res
+    return db_exec
+
+
+def run(db_exec, jobs: int, parallel: int) -> float:
+    remaining = [jobs]
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            try:
+                res = db_exec(CLAIM, ("STARTED", "NOT_STARTED", 1))
+                if len(res) == 0:
+                    return
+                db_exec(FINISH, ("DONE", res[0][0]))
+            except sqlite3.Error as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(parallel)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if errors:
+        print(f"  {len(errors)} errors, first: {errors[0]}")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-j", "--parallel", type=int, default=64, help="Worker threads")
+    parser.add_argument("-n", "--rows", type=int, default=50000, help="Rows in the packages table")
+    parser.add_argument("-c", "--claims", type=int, default=5000, help="Claim/update pairs to run")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy_path = os.path.join(tmp, "legacy.sqlite3")
+        pooled_path = os.path.join(tmp, "pooled.sqlite3")
+        create_db(legacy_path, args.rows)
+        create_db(pooled_path, args.rows)
+
+        elapsed = run(legacy_exec(legacy_path), args.claims, args.parallel)
+        print(f"legacy: {args.claims} claims in {elapsed:.2f}s, {args.claims / elapsed:.0f} claims/s")
+
+        db = ProjectDB(pooled_path)
+        elapsed = run(db.execute, args.claims, args.parallel)
+        db.close()
+        print(f"pooled: {args.claims} claims in {elapsed:.2f}s, {args.claims / elapsed:.0f} claims/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import os
+import re
+
+# Kinds of COMPILE_ERROR, see classify_failure
+TRANSIENT = "TRANSIENT"
+DEPENDENCY = "DEPENDENCY"
+FETCH = "FETCH"
+COMPILER = "COMPILER"
+UNKNOWN = "UNKNOWN"
+
+# Failures that every optimization level of the package would hit as well
+LEVEL_INDEPENDENT = (DEPENDENCY, FETCH)
+
+# Only the end of a log is read, builds can log hundreds of megabytes
+TAIL_SIZE = 1 << 20
+LOG_FILES = ("compile.log", "container.log")
+# Lines at the end of each log searched for TRANSIENT failures: a mirror
+# that timed out early on and was retried by apt did not end the build
+TRANSIENT_LINES = 50
+
+PATTERNS = [
+    (TRANSIENT, re.compile(
+        r"Temporary failure resolving|Could not resolve|Could not connect to|Connection timed out|"
+        r"Connection failed|Hash Sum mismatch|50[234] +(Bad Gateway|Service Unavailable|Gateway Time-?out)|"
+        r"No space left on device|Cannot allocate memory|virtual memory exhausted|"
+        r"internal compiler error: Killed|Killed signal terminated program"
+    )),
+    (DEPENDENCY, re.compile(
+        r"Unable to satisfy build-dependencies|Unmet build dependencies|unmet build dependencies|"
+        r"E: apt build-dep .* failed|has no installation candidate|Unable to correct problems, you have held broken packages"
+    )),
+    (FETCH, re.compile(
+        r"Unable to find a source package for|You must put some 'deb-src' URIs|E: Failed to fetch|"
+        r"dpkg-source: error|Unable to locate package"
+    )),
+    (COMPILER, re.compile(r"^\S+:(\d+:)+ (fatal )?error: |error: ld returned|undefined reference to", re.MULTILINE)),
+]
+
+
+def _tail(path: str) -> str:
+    with open(path, "rb") as f:
+        f.seek(max(0, os.fstat(f.fileno()).st_size - TAIL_SIZE))
+        return f.read().decode("utf-8", errors="replace")
+
+
+def classify_failure(save_path: str) -> str:
+    """Tells why the build in `save_path` failed, from the logs it left.
+
+    TRANSIENT failures (network, disk, memory) are worth a retry, if
+    they are among the last TRANSIENT_LINES lines of a log. A
+    DEPENDENCY or FETCH failure happens at every optimization level,
+    a COMPILER error may depend on the level (e.g. warnings made errors).
+    """
+    text = ""
+    last_lines = ""
+    for name in LOG_FILES:
+        path = os.path.join(save_path, name)
+        if os.path.exists(path):
+            tail = _tail(path)
+            text += tail
+            last_lines += "\n".join(tail.splitlines()[-TRANSIENT_LINES:]) + "\n"
+    for kind, pattern in PATTERNS:
+        if pattern.search(last_lines if kind == TRANSIENT else text):
+            return kind
+    return UNKNOWN
@@ -0,0 +1,122 @@
+"""File classification for the knowledge graph and the decompiler inputs.
+
+libmagic runs hundreds of tests on every file and pygments is slow to
+import and to ask, while the outputs of a compile project are almost all
+ELF objects, ar archives and C/C++ sources. `classify` tells these apart
+from the first HEAD_SIZE bytes and the file name, and only leaves files
+it cannot place to libmagic: text whose extension does not settle the
+language (a .h header is C or C++, libmagic reads its content), text
+without a known extension, non-ASCII text. It returns the node types of
+KnowledgeGraph/node.py, a short description of the file, and libmagic's
+own description where libmagic was asked.
+"""
+import os
+import struct
+
+try:
+    import magic
+except ImportError:
+    magic = None
+
+HEAD_SIZE = 4096
+
+ELF_MAGIC = b"\x7fELF"
+AR_MAGIC = b"!<arch>\n"
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ET_REL, ET_EXEC, ET_DYN = 1, 2, 3
+MACHINES = {3: "Intel 80386", 40: "ARM", 62: "x86-64", 183: "ARM aarch64", 243: "UCB RISC-V"}
+
+# The file names pygments gives a C or C++ lexer, see classify_magic
+EXTENSIONS = {
+    **dict.fromkeys((".c", ".h", ".idc", ".xpm", ".xbm"), "C"),
+    **dict.fromkeys((".cpp", ".hpp", ".c++", ".h++", ".cc", ".hh", ".cxx", ".hxx",
+                     ".C", ".H", ".cp", ".CPP", ".tpp"), "C++")
+}
+# Extensions with one possible language. A .h header may be C or C++, and
+# .idc, .xpm and .xbm are hardly ever C sources; libmagic reads those.
+UNAMBIGUOUS_EXTENSIONS = frozenset(name for name, language in EXTENSIONS.items() if language == "C++") | {".c"}
+
+
+def _classify_elf(head: bytes) -> tuple:
+    if len(head) < 64 or head[4] != ELFCLASS64 or head[5] != ELFDATA2LSB:
+        # Not built by this project's toolchain, left to libmagic to describe
+        return None, None, None
+    # Right after the 16 bytes of e_ident
+    e_type, e_machine = struct.unpack_from("<HH", head, 16)
+    machine = MACHINES.get(e_machine, f"machine {e_machine}")
+    if e_type == ET_REL:
+        return "Relocatable", None, f"ELF 64-bit LSB relocatable, {machine}"
+    elif e_type == ET_EXEC:
+        return "Executable", None, f"ELF 64-bit LSB executable, {machine}"
+    elif e_type == ET_DYN:
+        # PIE executables included, as the libmagic the project pins describes them
+        return "SharedLib", None, f"ELF 64-bit LSB shared object, {machine}"
+    return None, None, f"ELF 64-bit LSB, {machine}"
+
+
+def _is_ascii(head: bytes) -> bool:
+    try:
+        head.decode("ascii")
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def classify_magic(file_name: str, file_info: str) -> tuple:
+    """Returns (node type, language) from a libmagic description, or (None, None)."""
+    if file_info.startswith("C source"):
+        return "Source", "C"
+    elif file_info.startswith("C++ source"):
+        return "Source", "C++"
+    elif file_info.startswith("ELF 64-bit LSB relocatable"):
+        return "Relocatable", None
+    elif file_info.startswith("ELF 64-bit LSB executable"):
+        return "Executable", None
+    elif file_info.startswith("current ar archive"):
+        return "ArchiveLib", None
+    elif file_info.startswith("ELF 64-bit LSB shared object"):
+        return "SharedLib", None
+    elif file_info.startswith("ASCII text"):
+        language = EXTENSIONS.get(os.path.splitext(file_name)[1])
+        if language is not None:
+            return "Source", language
+    elif file_info == "very short file (no magic)":
+        return "Dummy", None
+    return None, None
+
+
+def classify(file_name: str, data: bytes) -> tuple:
+    """Returns (node type, language, description, magic info) of a file.
+
+    `data` is the content of the file, or at least its first HEAD_SIZE
+    bytes. The node type is None for files of no interest. The magic info
+    is libmagic's description, None unless libmagic had to be asked.
+    """
+    head = data[:HEAD_SIZE]
+    extension = os.path.splitext(file_name)[1]
+    if len(head) == 0:
+        return None, None, "empty", None
+    elif len(head) == 1:
+        return "Dummy", None, "very short file (no magic)", None
+    elif head.startswith(ELF_MAGIC):
+        node_type, language, description = _classify_elf(head)
+        if description is not None:
+            return node_type, language, description, None
+    elif head.startswith(AR_MAGIC):
+        return "ArchiveLib", None, "current ar archive", None
+    elif b"\x00" in head:
+        # Binary, neither ELF nor ar: of no interest whatever libmagic says
+        return None, None, "data", None
+    elif _is_ascii(head) and extension in UNAMBIGUOUS_EXTENSIONS:
+        language = EXTENSIONS[extension]
+        return "Source", language, f"{language} source, ASCII text", None
+    # Text the extension says little about, ELF of another class
+    if magic is None:
+        # Only the extension to go by
+        language = EXTENSIONS.get(extension) if _is_ascii(head) else None
+        if language is not None:
+            return "Source", language, f"{language} source, ASCII text", None
+        return None, None, "unknown", None
+    file_info = magic.from_buffer(head)
+    return (*classify_magic(file_name, file_info), file_info, file_info)
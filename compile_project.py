@@ -3,7 +3,7 @@ import atexit
 import sys
 import logging
 import os
-import shutil
+import socket
 import sqlite3
 import threading
 import docker
@@ -11,19 +11,65 @@ import time
 import uuid
 import psutil
 import argparse
-from tqdm.auto import tqdm
+import asyncio
+from project_db import ProjectDB
+from scheduler import WorkerPool, LoadMonitor, CPU_THRESHOLD, MEMORY_THRESHOLD
+from docker_async import AsyncDockerClient, container_config
+from dep_layer import DepLayerCache, DEPS_REPOSITORY
+from source_cache import SourceCache
+from trash import Trash
+from artifact_store import ArtifactStore
+import job_archive
+import build_failure
+from preflight import Preflight
 
 IMAGE="compile_docker:latest"
-SLOW_START_INTERVAL=30
+MEMORY_SAMPLE_INTERVAL=5
+# Per-container limits, the memory limit defaults to a share of the host
+CPU_SHARES=1024
+MEMORY_LIMIT_FRACTION=0.5
+PIDS_LIMIT=16384
+# Dirnames looked up per query in strict consolidation
+CONSOLIDATE_BATCH=500
+# Expected peak memory of a job nothing is known about yet
+DEFAULT_JOB_MEMORY=2 << 30
+
+def parse_size(size):
+    """Parses sizes like 512m or 16g into bytes."""
+    units = {"k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+    size = str(size).strip().lower().rstrip("b")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def default_limits():
+    return {
+        "cpu_shares": CPU_SHARES,
+        "mem_limit": int(psutil.virtual_memory().total * MEMORY_LIMIT_FRACTION),
+        "pids_limit": PIDS_LIMIT
+    }
+
+def dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for file_name in files:
+            try:
+                size += os.lstat(os.path.join(root, file_name)).st_size
+            except OSError:
+                pass
+    return size
 
 class CompileProject:
-    def __init__(self, project_root, package_list=None):
+    def __init__(self, project_root, package_list=None, share_deps=False, source_cache=False, artifact_store=False, pack=False):
         self.project_root = project_root
         self.packages_root = os.path.join(project_root, "packages")
         self.project_db_path = os.path.join(project_root, "project_db.sqlite3")
         self.initialized = os.path.exists(self.project_db_path)
         self.logger = logging.getLogger("CompileProject")
-        self.db_conn = None
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.db = None
+        self.limits = default_limits()
+        self.trash = Trash(os.path.join(project_root, ".trash"))
     
         if not self.initialized:
             self.logger.info("Project database not found, creating new one")
@@ -31,62 +77,86 @@ class CompileProject:
             if package_list is None:
                 self.logger.error("Package list is required to create a new project database")
                 raise Exception("Package list is required to create a new project database")
-            self.db_conn = sqlite3.connect(self.project_db_path)
-            cursor = self.db_conn.cursor()
-            cursor.execute("CREATE TABLE packages (id INTEGER PRIMARY KEY AUTOINCREMENT, package_name TEXT, optimization_level TEXT, status TEXT, dirname TEXT)")
-            for package_name in package_list:
-                for optimization_level in ("0", "1", "2", "3", "g", "s", "fast"):
-                    # print(type(optimization_level))
-                    # print(type(uuid.uuid4().hex))
-                    # print(type(package_name))
-                    # print(package_name)
-                    cursor.execute(
-                        "INSERT INTO packages (package_name, optimization_level, status, dirname) VALUES (?, ?, ?, ?)", 
+            self.db = ProjectDB(self.project_db_path)
+            self.db.migrate()
+            with self.db.transaction() as cursor:
+                cursor.executemany(
+                    "INSERT INTO packages (package_name, optimization_level, status, dirname, version, size) VALUES (?, ?, ?, ?, ?, ?)", 
+                    (
                         (
                             package_name["package"], 
                             optimization_level, 
                             "NOT_STARTED", 
-                            package_name["package"] + "_O" + optimization_level + "_" + uuid.uuid4().hex
+                            package_name["package"] + "_O" + optimization_level + "_" + uuid.uuid4().hex,
+                            package_name.get("version"),
+                            package_name.get("size")
                         )
+                        for package_name in package_list
+                        for optimization_level in ("0", "1", "2", "3", "g", "s", "fast")
                     )
-            self.db_conn.commit()
+                )
         else:
-            self.db_conn = sqlite3.connect(self.project_db_path)
+            self.db = ProjectDB(self.project_db_path)
+            self.db.migrate()
+        
+        self.dep_layers = None
+        if share_deps:
+            self.dep_layers = DepLayerCache(self.db, IMAGE, os.path.join(project_root, "dep_layers"))
+            self.dep_layers.gc()
+        
+        self.source_cache = None
+        if source_cache:
+            self.source_cache = SourceCache(self.db, IMAGE, os.path.join(project_root, "source_cache"))
+        
+        self.artifact_store = None
+        if artifact_store:
+            self.artifact_store = ArtifactStore(self.db, os.path.join(project_root, "blobs"))
+        self.pack = pack
     
     def db_exec(self, *args):
-        db_conn = None
-        while True:
-            try:
-                db_conn = sqlite3.connect(self.project_db_path)
-                break
-            except sqlite3.Error as e:
-                self.logger.error("Error connecting to database: %s", e)
-                continue
-        res = db_conn.execute(*args).fetchall()
-        db_conn.commit()
-        db_conn.close()
-        return res
+        return self.db.execute(*args)
     
     def consolidate(self, strict=False):
-        # Check directories
+        """Puts jobs interrupted by a crash back to NOT_STARTED.
+
+        Only STARTED rows are read, through the status index, and jobs under
+        an unexpired farm lease are left to their worker. In strict mode,
+        jobs of every directory on disk that does not belong to a DONE job
+        are restored too, found with one scan of the packages directory.
+        Output directories are handed to the trash, so compiles can start
+        while they are being deleted.
+        """
         self.logger.info("Consolidate.")
+        now = time.time()
         res = self.db_exec(
-            "SELECT id, dirname, status FROM packages"
+            "SELECT id, dirname FROM packages WHERE status = 'STARTED' AND coalesce(lease_expires, 0) < ?",
+            (now,)
         )
-        for _id, dirname, status in tqdm(res):
-            if strict:
-                need_restore = (status != "DONE" and os.path.exists(os.path.join(self.packages_root, dirname)))
-            else:
-                need_restore = (status == "STARTED")
-            
-            if need_restore:
+        if strict:
+            done = set(dirname for dirname, in self.db_exec("SELECT dirname FROM packages WHERE status = 'DONE'"))
+            with os.scandir(self.packages_root) as entries:
+                names = list(set(job_archive.job_dirname(entry.name) for entry in entries) - done)
+            restored = set(_id for _id, _ in res)
+            for idx in range(0, len(names), CONSOLIDATE_BATCH):
+                batch = names[idx:idx + CONSOLIDATE_BATCH]
+                for _id, dirname in self.db_exec(
+                    f"SELECT id, dirname FROM packages WHERE dirname IN ({', '.join('?' * len(batch))}) AND (status != 'STARTED' OR coalesce(lease_expires, 0) < ?)",
+                    (*batch, now)
+                ):
+                    if _id not in restored:
+                        res.append((_id, dirname))
+        for _id, dirname in res:
+            if self.trash.discard(os.path.join(self.packages_root, dirname)):
                 self.logger.info("Directory %s already exists, delete it", dirname)
-                os.system(f"rm -rf {os.path.join(self.packages_root, dirname)}")
+            self.trash.discard(os.path.join(self.packages_root, dirname + job_archive.SUFFIX))
+        # Restored rows are committed together at the end
+        with self.db.transaction():
+            for _id, dirname in res:
                 self.set_package_status(_id, "NOT_STARTED")
-            
-        
+        self.logger.info("Restored %d jobs", len(res))
+    
     def get_package_status(self, package_id: int) -> str:
-        # NOT_FOUND, NOT_STARTED, STARTED, DONE, COMPILE_ERROR, PYTHON_ERROR
+        # NOT_FOUND, NOT_STARTED, STARTED, DONE, COMPILE_ERROR, PYTHON_ERROR, OOM_KILLED, SKIPPED
         res = self.db_exec(
             "SELECT status FROM packages WHERE id = ?", 
             (package_id,)
@@ -98,15 +168,86 @@ class CompileProject:
         return status
     
     def set_package_status(self, package_id, status):
-        if status not in ("NOT_STARTED", "STARTED", "DONE", "COMPILE_ERROR", "PYTHON_ERROR"):
+        if status not in ("NOT_STARTED", "STARTED", "DONE", "COMPILE_ERROR", "PYTHON_ERROR", "OOM_KILLED", "SKIPPED"):
             self.logger.error("Invalid status: %s", status)
             raise Exception("Invalid status")
-        self.db_exec(
-            "UPDATE packages SET status = ? WHERE id = ?", 
-            (status, package_id)
-        )
+        if status == "NOT_STARTED":
+            self.db_exec(
+                "UPDATE packages SET status = ?, worker_id = NULL, claimed_at = NULL, finished_at = NULL, lease_expires = NULL WHERE id = ?", 
+                (status, package_id)
+            )
+        elif status == "STARTED":
+            self.db_exec(
+                "UPDATE packages SET status = ?, worker_id = coalesce(worker_id, ?), claimed_at = coalesce(claimed_at, ?) WHERE id = ?", 
+                (status, self.worker_id, time.time(), package_id)
+            )
+        else:
+            self.db_exec(
+                "UPDATE packages SET status = ?, finished_at = ? WHERE id = ?", 
+                (status, time.time(), package_id)
+            )
+    
+    def container_spec(self, package_name, optimization_level, save_path, in_memory=False, image=IMAGE, source_path=None) -> dict:
+        """Returns the `containers.run` arguments of one compile job."""
+        # Prepare command string
+        command_str = f"compile.sh {package_name} {os.getuid()} {os.getgid()}"
+        
+        # Prepare environments
+        environments = {
+            "GCC_PARSER_HIJACK_OPTIMIZATION_LEVEL": optimization_level,
+            "GCC_PARSER_HIJACK_DWARF4": "1",
+            "DEB_DH_SHLIBDEPS_ARGS_ALL": "--dpkg-shlibdeps-params=--ignore-missing-info" # Fix some deb-build failures
+        }
+        if image != IMAGE:
+            # Started from a dependency layer, see DepLayerCache
+            environments["SKIP_BUILD_DEP"] = "1"
+        spec = {
+            "image": image,
+            "command": [
+                "/bin/sh",
+                "-c",
+                command_str
+            ],
+            "environment": environments,
+            "name": f"{package_name}_O{optimization_level}"
+        }
+        # cgroup limits, so one runaway build is killed instead of the host
+        spec.update(self.limits)
+        if spec.get("mem_limit") is not None:
+            spec["memswap_limit"] = spec["mem_limit"]
+        if in_memory:
+            spec["volumes"] = {
+                os.path.abspath(save_path): {
+                    "bind": "/save",
+                    "mode": "rw"
+                }
+            }
+            spec["tmpfs"] = {
+                "/workspace": "exec"
+            }
+        else:
+            environments["SAVE_PATH"] = "/workspace/package"
+            spec["volumes"] = {
+                os.path.abspath(save_path): {
+                    "bind": "/workspace/package",
+                    "mode": "rw"
+                }
+            }
+        if source_path is not None:
+            # Pristine source tree, see SourceCache
+            environments["SOURCE_PATH"] = "/source"
+            spec["volumes"][os.path.abspath(source_path)] = {
+                "bind": "/source",
+                "mode": "ro"
+            }
+        return spec
     
-    def compile_package_internal(self, package_name, optimization_level, dirname, in_memory=False):
+    def compile_package_internal(self, package_name, optimization_level, dirname, in_memory=False, image=IMAGE, source_path=None, metrics=None):
+        """Runs one compile container and returns the job status.
+
+        If a `metrics` dict is given, the peak memory of the container is
+        stored in it as "peak_memory".
+        """
         if not optimization_level in ("0", "1", "2", "3", "g", "s", "fast"):
             self.logger.error("Invalid optimization level: %s", optimization_level)
             raise Exception("Invalid optimization level")
@@ -114,113 +255,298 @@ class CompileProject:
         self.logger.info("Compiling package %s with optimization_level -O%s in %s", package_name, optimization_level, save_path)
         try:
             os.system(f"mkdir -p {save_path}")
-            # Prepare command string
-            command_str = f"compile.sh {package_name} {os.getuid()} {os.getgid()}"
-            
-            # Prepare environments
-            environments = {
-                "GCC_PARSER_HIJACK_OPTIMIZATION_LEVEL": optimization_level,
-                "GCC_PARSER_HIJACK_DWARF4": "1",
-                "DEB_DH_SHLIBDEPS_ARGS_ALL": "--dpkg-shlibdeps-params=--ignore-missing-info" # Fix some deb-build failures
-            }
-            # print(f"in_memeory: {in_memory}")
-            if in_memory:
-                client = docker.from_env()
-                result = client.containers.run(
-                    image=IMAGE,
-                    command=[
-                        "/bin/sh",
-                        "-c",
-                        command_str
-                    ],
-                    remove=True,
-                    environment=environments,
-                    volumes={
-                        os.path.abspath(save_path): {
-                            "bind": "/save",
-                            "mode": "rw"
-                        }
-                    },
-                    tmpfs={
-                        "/workspace": "exec"
-                    },
-                    name=f"{package_name}_O{optimization_level}"
-                )
-            else:
-                # Prepare environments
-                environments["SAVE_PATH"] = "/workspace/package"
-                
-                client = docker.from_env()
-                result = client.containers.run(
-                    image=IMAGE,
-                    command=[
-                        "/bin/sh", 
-                        "-c", 
-                        command_str
-                    ],
-                    remove=True,
-                    environment=environments,
-                    volumes={
-                        os.path.abspath(save_path): {
-                            "bind": "/workspace/package",
-                            "mode": "rw"
-                        }
-                    },
-                    name=f"{package_name}_O{optimization_level}"
-                )
+            spec = self.container_spec(package_name, optimization_level, save_path, in_memory, image, source_path)
+            client = docker.from_env()
+            container = client.containers.run(detach=True, **spec)
+            try:
+                if metrics is not None:
+                    threading.Thread(target=self._track_memory, args=(container, metrics), daemon=True).start()
+                exit_status = container.wait()["StatusCode"]
+                container.reload()
+                oom_killed = container.attrs["State"]["OOMKilled"]
+                if exit_status != 0 and not oom_killed:
+                    raise docker.errors.ContainerError(
+                        container, exit_status, spec["command"], spec["image"], container.logs(stdout=False, stderr=True)
+                    )
+            finally:
+                container.remove(force=True)
         # except docker.errors.APIError:
         #     return "STARTED"
         except Exception as e:
-            self.logger.error(f"Python error compiling package {package_name} with optimization_level -O{optimization_level}")
-            self.logger.error(f"Error: {e}")
-            import traceback
-            self.logger.error(f"Trace: {traceback.format_exc()}")
-            with open(os.path.join(save_path, "python_error"), "w") as f:
-                f.write(e.__str__())
-            return "PYTHON_ERROR"
+            return self._python_error(package_name, optimization_level, save_path, e)
+        return self._compile_result(package_name, optimization_level, save_path, oom_killed)
+    
+    async def compile_package_internal_async(self, client: AsyncDockerClient, package_name, optimization_level, dirname, in_memory=False, image=IMAGE, source_path=None, metrics=None):
+        if not optimization_level in ("0", "1", "2", "3", "g", "s", "fast"):
+            self.logger.error("Invalid optimization level: %s", optimization_level)
+            raise Exception("Invalid optimization level")
+        save_path = os.path.join(self.packages_root, dirname)
+        self.logger.info("Compiling package %s with optimization_level -O%s in %s", package_name, optimization_level, save_path)
+        try:
+            os.makedirs(save_path, exist_ok=True)
+            spec = self.container_spec(package_name, optimization_level, save_path, in_memory, image, source_path)
+            state = await client.run_container(
+                container_config(spec),
+                name=spec["name"],
+                log_path=os.path.join(save_path, "container.log"),
+                memory_interval=None if metrics is None else MEMORY_SAMPLE_INTERVAL
+            )
+            if metrics is not None:
+                metrics["peak_memory"] = max(metrics.get("peak_memory", 0), state["PeakMemory"])
+            if state["ExitCode"] != 0 and not state["OOMKilled"]:
+                # Same as the ContainerError raised by containers.run
+                raise Exception(f"Container exited with status {state['ExitCode']}")
+        except Exception as e:
+            return self._python_error(package_name, optimization_level, save_path, e)
+        return self._compile_result(package_name, optimization_level, save_path, state["OOMKilled"])
+    
+    def _track_memory(self, container, metrics):
+        # The stats stream ends by itself once the container is gone
+        try:
+            for stats in container.stats(stream=True, decode=True):
+                memory = stats.get("memory_stats", {})
+                metrics["peak_memory"] = max(metrics.get("peak_memory", 0), memory.get("max_usage", 0), memory.get("usage", 0))
+        except Exception:
+            pass
+    
+    def _python_error(self, package_name, optimization_level, save_path, e):
+        self.logger.error(f"Python error compiling package {package_name} with optimization_level -O{optimization_level}")
+        self.logger.error(f"Error: {e}")
+        import traceback
+        self.logger.error(f"Trace: {traceback.format_exc()}")
+        with open(os.path.join(save_path, "python_error"), "w") as f:
+            f.write(e.__str__())
+        return "PYTHON_ERROR"
+    
+    def _compile_result(self, package_name, optimization_level, save_path, oom_killed=False):
         if os.path.exists(os.path.join(save_path, "compile_succeed")):
             self.logger.info(f"Package {package_name} with optimization_level -O{optimization_level} compile succeed")
             return "DONE"
+        elif oom_killed:
+            self.logger.warning(f"Package {package_name} with optimization_level -O{optimization_level} killed by the OOM killer")
+            return "OOM_KILLED"
         else:
             return "COMPILE_ERROR"
         
     def compile_package(self, package_id, package_name, optimization_level, dirname, retry, in_memory):
         status = None
+        failure = None
         tried = 0
         self.set_package_status(package_id , "STARTED")
-        while True:
-            status = self.compile_package_internal(package_name, optimization_level, dirname, in_memory)
-            if status == "DONE" or status == "PYTHON_ERROR" or status == "STARTED":
-                break
-            elif status == "COMPILE_ERROR":
-                if tried >= retry:
-                    break
-                self.logger.info(f"{package_name} with optimization_level O{optimization_level} compile error, retrying {tried + 1}/{retry}")
-                os.system(f"rm -rf {dirname}")
-                tried += 1
-            else:
-                raise Exception("Invalid status")
-        self.set_package_status(package_id, status)
+        start_time = time.time()
+        metrics = {}
+        image = IMAGE
+        if self.dep_layers is not None:
+            image = self.dep_layers.acquire(package_name)
+        try:
+            source_path = None
+            if self.source_cache is not None:
+                source_path = self.source_cache.acquire(package_name)
+            try:
+                while True:
+                    status = self.compile_package_internal(package_name, optimization_level, dirname, in_memory, image, source_path, metrics)
+                    if status == "DONE" or status == "PYTHON_ERROR" or status == "OOM_KILLED" or status == "STARTED":
+                        break
+                    elif status == "COMPILE_ERROR":
+                        failure = build_failure.classify_failure(os.path.join(self.packages_root, dirname))
+                        # Anything but a transient failure happens again
+                        if failure != build_failure.TRANSIENT or tried >= retry:
+                            break
+                        self.logger.info(f"{package_name} with optimization_level O{optimization_level} transient compile error, retrying {tried + 1}/{retry}")
+                        self.trash.discard(os.path.join(self.packages_root, dirname))
+                        tried += 1
+                    else:
+                        raise Exception("Invalid status")
+                if self.pack:
+                    self.pack_job(dirname)
+                elif self.artifact_store is not None:
+                    self.artifact_store.ingest(package_id, os.path.join(self.packages_root, dirname))
+                self.finish_package(package_id, status, time.time() - start_time, metrics.get("peak_memory"), dirname, failure if status == "COMPILE_ERROR" else None)
+            finally:
+                if self.source_cache is not None:
+                    self.source_cache.release(package_name)
+        finally:
+            if self.dep_layers is not None:
+                self.dep_layers.release(package_name)
         return status
     
-    def get_packages_not_started(self, num_packages, set_started=True):
-        if set_started:
-            res = self.db_exec(
-                "UPDATE packages SET status = ? WHERE id IN (SELECT id FROM packages WHERE status = ? LIMIT ?) RETURNING id, package_name, optimization_level, dirname",
-                ("STARTED", "NOT_STARTED", num_packages)
+    async def compile_package_async(self, client: AsyncDockerClient, package_id, package_name, optimization_level, dirname, retry, in_memory):
+        status = None
+        failure = None
+        tried = 0
+        await asyncio.to_thread(self.set_package_status, package_id, "STARTED")
+        start_time = time.time()
+        metrics = {}
+        image = IMAGE
+        if self.dep_layers is not None:
+            image = await self.dep_layers.acquire_async(client, package_name)
+        try:
+            source_path = None
+            if self.source_cache is not None:
+                source_path = await self.source_cache.acquire_async(client, package_name)
+            try:
+                while True:
+                    status = await self.compile_package_internal_async(client, package_name, optimization_level, dirname, in_memory, image, source_path, metrics)
+                    if status == "DONE" or status == "PYTHON_ERROR" or status == "OOM_KILLED" or status == "STARTED":
+                        break
+                    elif status == "COMPILE_ERROR":
+                        failure = await asyncio.to_thread(build_failure.classify_failure, os.path.join(self.packages_root, dirname))
+                        # Anything but a transient failure happens again
+                        if failure != build_failure.TRANSIENT or tried >= retry:
+                            break
+                        self.logger.info(f"{package_name} with optimization_level O{optimization_level} transient compile error, retrying {tried + 1}/{retry}")
+                        self.trash.discard(os.path.join(self.packages_root, dirname))
+                        tried += 1
+                    else:
+                        raise Exception("Invalid status")
+                if self.pack:
+                    await asyncio.to_thread(self.pack_job, dirname)
+                elif self.artifact_store is not None:
+                    await asyncio.to_thread(self.artifact_store.ingest, package_id, os.path.join(self.packages_root, dirname))
+                await asyncio.to_thread(self.finish_package, package_id, status, time.time() - start_time, metrics.get("peak_memory"), dirname, failure if status == "COMPILE_ERROR" else None)
+            finally:
+                if self.source_cache is not None:
+                    await asyncio.to_thread(self.source_cache.release, package_name)
+        finally:
+            if self.dep_layers is not None:
+                await self.dep_layers.release_async(client, package_name)
+        return status
+    
+    def pack_job(self, dirname):
+        """Replaces the output directory of a job by its archive, see job_archive."""
+        save_path = os.path.join(self.packages_root, dirname)
+        try:
+            res = job_archive.pack(save_path, save_path + job_archive.SUFFIX)
+            try:
+                job_archive.verify(save_path, save_path + job_archive.SUFFIX)
+            except Exception:
+                os.remove(save_path + job_archive.SUFFIX)
+                raise
+        except Exception as e:
+            self.logger.error("Error packing %s, keeping the directory: %s", dirname, e)
+            return
+        self.trash.discard(save_path)
+        self.logger.info("Packed %d files of %s, %d bytes into %d bytes", res["files"], dirname, res["bytes"], res["packed_bytes"])
+    
+    def output_size(self, dirname):
+        archive_path = os.path.join(self.packages_root, dirname + job_archive.SUFFIX)
+        if os.path.exists(archive_path):
+            return os.path.getsize(archive_path)
+        return dir_size(os.path.join(self.packages_root, dirname))
+    
+    def finish_package(self, package_id, status, wall_time, peak_memory, dirname, failure=None):
+        """Stores the final status of a job together with what it cost, see record_result.
+
+        The output size is measured here, from the job's directory or archive.
+        """
+        output_size = self.output_size(dirname)
+        self.record_result(package_id, status, wall_time, peak_memory, output_size, failure)
+    
+    def record_result(self, package_id, status, wall_time, peak_memory, output_size, failure=None):
+        """Stores the final status of a job and what it cost.
+
+        The wall time and peak memory also become the priority and memory
+        estimate of sibling optimization levels that have no history of
+        their own yet. After a COMPILE_ERROR, `failure` is its kind, see
+        build_failure: siblings that would fail alike are SKIPPED, those
+        of a compiler error run last, whatever their siblings report later.
+        """
+        with self.db.transaction():
+            self.set_package_status(package_id, status)
+            self.db_exec(
+                "UPDATE packages SET wall_time = ?, peak_memory = ?, output_size = ?, failure = ? WHERE id = ?",
+                (wall_time, peak_memory, output_size, failure, package_id)
             )
+            self.db_exec(
+                "UPDATE packages SET priority = CASE WHEN EXISTS (SELECT 1 FROM packages f WHERE f.package_name = packages.package_name AND f.failure = ?) THEN priority ELSE ? END, "
+                "memory_estimate = max(coalesce(memory_estimate, 0), coalesce(?, 0)) WHERE status = 'NOT_STARTED' AND wall_time IS NULL AND package_name = (SELECT package_name FROM packages WHERE id = ?)",
+                (build_failure.COMPILER, wall_time, peak_memory, package_id)
+            )
+            if failure in build_failure.LEVEL_INDEPENDENT:
+                res = self.db_exec(
+                    "UPDATE packages SET status = 'SKIPPED', skip_reason = ? WHERE status = 'NOT_STARTED' AND package_name = (SELECT package_name FROM packages WHERE id = ?) RETURNING id",
+                    (f"{failure.lower()} failure", package_id)
+                )
+                if len(res) > 0:
+                    self.logger.warning("Job %d failed with a %s error, skipped %d other optimization levels", package_id, failure.lower(), len(res))
+            elif failure == build_failure.COMPILER:
+                self.db_exec(
+                    "UPDATE packages SET priority = -1 WHERE status = 'NOT_STARTED' AND package_name = (SELECT package_name FROM packages WHERE id = ?)",
+                    (package_id,)
+                )
+    
+    def load_history(self, history_db_path):
+        """Takes recorded job costs from an earlier project for jobs without any."""
+        history = sqlite3.connect(history_db_path)
+        try:
+            columns = [column[1] for column in history.execute("PRAGMA table_info(packages)")]
+            if "wall_time" not in columns:
+                self.logger.warning("No job costs recorded in %s", history_db_path)
+                return
+            res = history.execute(
+                "SELECT wall_time, peak_memory, output_size, package_name, optimization_level FROM packages WHERE wall_time IS NOT NULL ORDER BY id"
+            ).fetchall()
+        finally:
+            history.close()
+        with self.db.transaction() as cursor:
+            cursor.executemany(
+                "UPDATE packages SET wall_time = ?, peak_memory = ?, output_size = ? WHERE package_name = ? AND optimization_level = ? AND wall_time IS NULL",
+                res
+            )
+        self.logger.info("Loaded %d job costs from %s", len(res), history_db_path)
+    
+    def update_priorities(self):
+        """Orders NOT_STARTED jobs longest-processing-time first.
+
+        A job's priority is its expected wall time: its own recorded one,
+        else the longest recorded one among its optimization levels, else
+        the package size scaled by the median seconds per byte of jobs that
+        have both. Starting the longest jobs first keeps a few multi-hour
+        builds from running alone at the end of a project.
+
+        The memory estimate used for admission is the recorded peak memory
+        of the job, else the highest one among its optimization levels.
+        """
+        res = self.db_exec("SELECT wall_time / size FROM packages WHERE size > 0 AND wall_time IS NOT NULL ORDER BY 1")
+        seconds_per_byte = res[len(res) // 2][0] if len(res) > 0 else 1.0
+        with self.db.transaction():
+            self.db_exec(
+                "UPDATE packages SET priority = coalesce(wall_time, (SELECT max(h.wall_time) FROM packages h WHERE h.package_name = packages.package_name), size * ?, 0), "
+                "memory_estimate = coalesce(peak_memory, (SELECT max(h.peak_memory) FROM packages h WHERE h.package_name = packages.package_name)) WHERE status = 'NOT_STARTED'",
+                (seconds_per_byte,)
+            )
+            # Compiler errors are likely at every level, those jobs go last
+            self.db_exec(
+                "UPDATE packages SET priority = -1 WHERE status = 'NOT_STARTED' AND package_name IN (SELECT package_name FROM packages WHERE failure = ?)",
+                (build_failure.COMPILER,)
+            )
+    
+    def get_packages_not_started(self, num_packages, set_started=True, worker_id=None):
+        """Hand out up to `num_packages` NOT_STARTED jobs, highest priority first.
+
+        With `set_started`, the jobs are claimed in a single transaction: they
+        are marked STARTED and stamped with the claiming worker and time, so
+        concurrent callers never receive the same job.
+        """
+        if set_started:
+            with self.db.transaction():
+                res = self.db_exec(
+                    "UPDATE packages SET status = ?, worker_id = ?, claimed_at = ?, finished_at = NULL WHERE id IN (SELECT id FROM packages WHERE status = ? ORDER BY priority DESC, id LIMIT ?) RETURNING id, package_name, optimization_level, dirname, priority, memory_estimate",
+                    ("STARTED", worker_id or self.worker_id, time.time(), "NOT_STARTED", num_packages)
+                )
         else:
             res = self.db_exec(
-                "SELECT id, package_name, optimization_level, dirname FROM packages WHERE status = ? LIMIT ?",
+                "SELECT id, package_name, optimization_level, dirname, priority, memory_estimate FROM packages WHERE status = ? ORDER BY priority DESC, id LIMIT ?",
                 ("NOT_STARTED", num_packages)
             )
         to_ret = []
-        for item in res:
+        for item in sorted(res, key=lambda item: (-item[4], item[0])):
             to_ret.append({
                 "package_id": item[0],
                 "package_name": item[1],
                 "optimization_level": item[2],
-                "dirname": item[3]
+                "dirname": item[3],
+                "memory_estimate": item[5] or DEFAULT_JOB_MEMORY
             })
         return to_ret
     
@@ -240,49 +566,89 @@ def compile_packages(compile_project: CompileProject, retry: int, in_memory: boo
         )
     
 def compile_packages_parallel(compile_project: CompileProject, retry: int, max_parallel: int, in_memory: bool, slow_start: bool = False):
-    import threading
-    thread_list = []
-    slow_start_count = 0
-    while True:
-        for thread in thread_list:
-            if not thread.is_alive():
-                thread.join()
-                thread_list.remove(thread)
-        if len(thread_list) >= max_parallel or psutil.cpu_percent() >= 80 or psutil.virtual_memory().percent >= 85:
-            time.sleep(1)
-            continue
-        packages = compile_project.get_packages_not_started(1)
-        if len(packages) == 0:
-            break
-        package = packages[0]
-        thread = threading.Thread(
-            target=compile_project.compile_package, 
-            args=(
-                package["package_id"],
-                package["package_name"],
-                package["optimization_level"],
-                package["dirname"],
-                retry,
-                in_memory
-            )
-        )
-        thread.daemon = True
-        thread.start()
-        thread_list.append(thread)
-        if slow_start_count <= max_parallel and slow_start:
-            print(f"Slow start {slow_start_count}/{max_parallel}, waiting for {SLOW_START_INTERVAL} seconds")
-            time.sleep(SLOW_START_INTERVAL)
-            slow_start_count += 1
+    pool = WorkerPool(
+        fetch=compile_project.get_packages_not_started,
+        run=lambda package: compile_project.compile_package(
+            package["package_id"],
+            package["package_name"],
+            package["optimization_level"],
+            package["dirname"],
+            retry,
+            in_memory
+        ),
+        max_workers=max_parallel,
+        ramp_up=slow_start,
+        weight=lambda package: package["memory_estimate"],
+        capacity=psutil.virtual_memory().total * MEMORY_THRESHOLD / 100
+    )
+    pool.start()
+    pool.join()
+
+
+async def compile_packages_async(compile_project: CompileProject, retry: int, max_parallel: int, in_memory: bool):
+    """Drives up to `max_parallel` builds from one event loop.
+
+    Containers run detached and share one Docker API connection pool, so
+    parallelism is not bounded by threads. Admission works like WorkerPool:
+    new jobs start only while the smoothed machine load is below the
+    thresholds and their expected peak memory fits next to the running
+    ones.
+    """
+    client = AsyncDockerClient()
+    monitor = LoadMonitor()
+    monitor.start()
+    capacity = psutil.virtual_memory().total * MEMORY_THRESHOLD / 100
+    pending = []
+    running = {}
+    committed = 0
+    exhausted = False
+    try:
+        while True:
+            free = max_parallel - len(running)
+            if not exhausted and len(pending) < free:
+                packages = await asyncio.to_thread(compile_project.get_packages_not_started, free - len(pending))
+                exhausted = len(packages) == 0
+                pending.extend(packages)
+            overloaded = monitor.cpu >= CPU_THRESHOLD or monitor.memory >= MEMORY_THRESHOLD
+            for package in list(pending):
+                if len(running) >= max_parallel:
+                    break
+                # An idle machine always gets one job, whatever else runs on it
+                if len(running) > 0 and (overloaded or committed + package["memory_estimate"] > capacity):
+                    continue
+                pending.remove(package)
+                committed += package["memory_estimate"]
+                task = asyncio.ensure_future(compile_project.compile_package_async(
+                    client,
+                    package["package_id"],
+                    package["package_name"],
+                    package["optimization_level"],
+                    package["dirname"],
+                    retry,
+                    in_memory
+                ))
+                running[task] = package["memory_estimate"]
+            if len(running) == 0:
+                break
+            done, _ = await asyncio.wait(running, timeout=monitor.interval, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                committed -= running.pop(task)
+                if task.exception() is not None:
+                    compile_project.logger.error("Compile task failed: %s", task.exception())
+    finally:
+        monitor.stop()
+        await client.close()
 
 
-@atexit.register    
 def clean_container():
+    """Removes the compile containers left running, registered at exit by the CLIs that start them."""
     if not threading.current_thread().name == 'MainThread':
         return 
     print("Cleaning container")
     client = docker.from_env()
     for container in client.containers.list(all=True):
-        if container.image.tags[0] == IMAGE:
+        tags = container.image.tags
+        if len(tags) > 0 and (tags[0] == IMAGE or tags[0].startswith(DEPS_REPOSITORY + ":")):
             print(f"Removing container {container.id}")
             try:
                 container.remove(force=True)
@@ -291,20 +657,50 @@ def clean_container():
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("-r", "--retry", type=int, default=3, help="Retry times when 'compile_error' occurs")
+    parser.add_argument("-r", "--retry", type=int, default=3, help="Retry times when a transient compile error (network, disk, memory) occurs")
     parser.add_argument("-j", "--parallel", type=int, default=1, help="Max parallel jobs")
     parser.add_argument("-p", "--project", type=str, required=True, help="Project path")
     parser.add_argument("-l", "--list", type=str, required=True, help="List of packages to compile, must be a json file")
     parser.add_argument("-M", "--in-memory", action="store_true", help="Determines whether to use ramdisk to accelerate compilation")
+    parser.add_argument("-B", "--backend", choices=("thread", "async"), default="thread", help="Run each job in its own thread, or drive all containers from one asyncio event loop")
+    parser.add_argument("-D", "--share-deps", action="store_true", help="Install build dependencies once per package into an image shared by all optimization levels")
+    parser.add_argument("-C", "--source-cache", action="store_true", help="Fetch and unpack each source package once and build every optimization level from a copy")
+    parser.add_argument("-A", "--artifact-store", action="store_true", help="Hardlink identical output files of all jobs to one copy in a content-addressed store")
+    parser.add_argument("-P", "--pack", action="store_true", help="Pack the output of each finished job into one compressed archive with an index")
+    parser.add_argument("-H", "--history", type=str, help="Database of an earlier project whose job costs order this one longest first")
+    parser.add_argument("-F", "--preflight", action="store_true", help="Skip jobs that cannot produce gcc output, by --sources and the outcomes of this and the --history project")
+    parser.add_argument("--sources", type=str, action="append", default=[], help="Sources index of the mirror used by --preflight (repeatable)")
+    parser.add_argument("--memory-limit", type=str, help="Memory limit of each compile container, e.g. 16g (default: half of the host memory)")
+    parser.add_argument("--cpu-shares", type=int, default=CPU_SHARES, help="Relative CPU weight of each compile container")
+    parser.add_argument("--pids-limit", type=int, default=PIDS_LIMIT, help="Maximum number of processes in each compile container")
+    parser.add_argument("-s", "--slow-start", action="store_true", help="Start with one job and ramp up as load allows")
     parser.add_argument("-S", "--strict", action="store_true", help="Determines whether consolidate use strict mode, if set, PYTHON_ERROR may be restored")
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
+    atexit.register(clean_container)
     with open(args.list, "r") as f:
         import json
         package_list = json.load(f)
-    project = CompileProject(args.project, package_list)
+    project = CompileProject(args.project, package_list, args.share_deps, args.source_cache, args.artifact_store, args.pack)
+    project.limits["cpu_shares"] = args.cpu_shares
+    project.limits["pids_limit"] = args.pids_limit
+    if args.memory_limit:
+        project.limits["mem_limit"] = parse_size(args.memory_limit)
     project.consolidate(args.strict)
-    compile_packages_parallel(project, args.retry, args.parallel, args.in_memory)
+    if args.history:
+        project.load_history(args.history)
+    project.update_priorities()
+    if args.preflight:
+        Preflight(project.db, project.packages_root).run(args.sources, args.history)
+    if args.backend == "async":
+        asyncio.run(compile_packages_async(project, args.retry, args.parallel, args.in_memory))
+    else:
+        compile_packages_parallel(project, args.retry, args.parallel, args.in_memory, args.slow_start)
+    if project.source_cache is not None:
+        project.logger.info("Source cache: %(hits)d hits, %(misses)d misses, %(failed)d failed fetches", project.source_cache.stats())
+    if project.artifact_store is not None:
+        project.artifact_store.gc()
+        project.logger.info("Artifact store: %(blobs)d blobs (%(blob_bytes)d bytes), %(deduplicated_files)d duplicate files (%(deduplicated_bytes)d bytes) deduplicated", project.artifact_store.stats())
 
 def test():
     logging.basicConfig(level=logging.INFO)
@@ -0,0 +1,123 @@
+"""Reading and writing .decomp files, the pseudocode of one binary.
+
+A .decomp file is JSON Lines, one function per line:
+
+    {"name": ..., "pseudocode": ..., "address": ..., "file_offset": ...}
+
+optionally zstd-compressed as a whole, which readers tell by its magic.
+Files written before this format are a single indented JSON list; they
+are read all the same.
+
+`DecompWriter` appends every function to `<binary>.decomp.part` as soon
+as it is decompiled, so a run that is killed loses nothing. The next run
+reads the functions already there back, the caller skips them, and
+`close` renames the finished file to `<binary>.decomp` (compressing it
+first if asked to), so a .decomp file is always complete. Only the
+standard library is needed, unless zstd is used; the module is imported
+by the IDA script as well.
+"""
+import json
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+RESULT_SUFFIX = ".decomp"
+PARTIAL_SUFFIX = RESULT_SUFFIX + ".part"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+ZSTD_LEVEL = 10
+CHUNK_SIZE = 1 << 20
+
+
+def _open_text(path: str):
+    f = open(path, "rb")
+    if f.read(4) == ZSTD_MAGIC:
+        if zstandard is None:
+            f.close()
+            raise Exception(f"{path} is zstd-compressed, but the zstandard module is not installed")
+        f.seek(0)
+        return zstandard.ZstdDecompressor().stream_reader(f, closefd=True, read_across_frames=True)
+    f.seek(0)
+    return f
+
+
+def iter_functions(path: str):
+    """Yields the functions of a .decomp file one at a time, as dicts."""
+    with _open_text(path) as f:
+        head = f.read(CHUNK_SIZE)
+        if head.lstrip()[:1] == b"[":
+            # Written before JSON Lines, has to be read at once
+            yield from json.loads(head + f.read())
+            return
+        buf = head
+        while len(buf) > 0:
+            lines = buf.split(b"\n")
+            for line in lines[:-1]:
+                if line.strip():
+                    yield json.loads(line)
+            chunk = f.read(CHUNK_SIZE)
+            if len(chunk) == 0:
+                if lines[-1].strip():
+                    yield json.loads(lines[-1])
+                return
+            buf = lines[-1] + chunk
+
+
+class DecompWriter:
+    """Writes the .decomp file of a binary function by function, see the module docstring.
+
+    `done` holds the addresses of the functions a killed run has
+    written already.
+    """
+
+    def __init__(self, path: str, compress: bool = False):
+        if compress and zstandard is None:
+            raise Exception("zstd output asked for, but the zstandard module is not installed")
+        self.path = path
+        self.partial_path = path + ".part"
+        self.compress = compress
+        self.done = set()
+        valid = 0
+        if os.path.exists(self.partial_path):
+            with open(self.partial_path, "rb") as f:
+                for line in f:
+                    # The last line may have been cut short by a kill
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        self.done.add(json.loads(line)["address"])
+                    except (ValueError, KeyError):
+                        break
+                    valid += len(line)
+        self.file = open(self.partial_path, "ab")
+        self.file.truncate(valid)
+
+    def write(self, function_info: dict):
+        self.file.write(json.dumps(function_info).encode() + b"\n")
+        # Lines reach the disk as they come, not when IDA's buffers fill
+        self.file.flush()
+        self.done.add(function_info["address"])
+
+    def close(self):
+        """Makes the finished .decomp file appear at once."""
+        self.file.close()
+        if self.compress:
+            tmp = self.path + ".tmp"
+            with open(self.partial_path, "rb") as src, open(tmp, "wb") as dst:
+                zstandard.ZstdCompressor(level=ZSTD_LEVEL).copy_stream(src, dst)
+            os.replace(tmp, self.path)
+            os.remove(self.partial_path)
+        else:
+            os.replace(self.partial_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            # Kept for the next run
+            self.file.close()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""Finds the functions that are decompiled again and again across a decomp project.
+
+Static libraries and inlined helpers end up in thousands of binaries.
+Every function of every .decomp file is hashed twice:
+- its pseudocode normalized, i.e. with the names IDA derives from
+  addresses (sub_401000, dword_6010A0, ...), the function's own name,
+  hex constants that fall inside a loaded segment of the binary (its
+  PT_LOAD ranges), comments and whitespace replaced or dropped, so that
+  the same source linked at another address hashes alike; any other
+  constant, a CRC polynomial or a mask, is kept;
+- its raw bytes, `size` bytes at `file_offset` of the binary; these
+  only match within identical links, and are None for .decomp files
+  written before `size` was dumped.
+Each normalized body is stored once in `bodies`, keyed by its hash, with
+the pseudocode it was first seen with; `functions` references a body per
+(binary, address). Both live in dedup_db.sqlite3 in the project, and a
+rerun only reads the .decomp files that are new or have changed.
+`--export` writes one line per distinct body, a duplicate-free data set.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import struct
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from project_db import ProjectDB
+from decomp_file import RESULT_SUFFIX, iter_functions
+
+MIGRATIONS = [
+    [
+        "CREATE TABLE IF NOT EXISTS bodies (hash TEXT PRIMARY KEY, pseudocode TEXT, refs INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS functions (binary TEXT, address INTEGER, name TEXT, body_hash TEXT, bytes_hash TEXT, "
+        "PRIMARY KEY (binary, address)) WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS functions_body ON functions (body_hash)",
+        "CREATE TABLE IF NOT EXISTS decomp_files (binary TEXT PRIMARY KEY, size INTEGER, mtime INTEGER) WITHOUT ROWID",
+    ],
+]
+
+DUMMY_NAME = re.compile(
+    r"\b(sub|nullsub|j_sub|loc|locret|off|seg|dword|qword|word|byte|xmmword|ymmword|unk|stru|asc|flt|dbl|funcs)_[0-9A-Fa-f]+\b"
+)
+# Short constants are never addresses, even where a shared object's segments start at 0
+HEX_CONSTANT = re.compile(r"\b0x([0-9A-Fa-f]{5,})(?:u?i64|u?ll|u?LL|u|U)?\b")
+PT_LOAD = 1
+COMMENT = re.compile(r"//.*$", re.MULTILINE)
+SPACES = re.compile(r"\s+")
+
+
+def load_ranges(binary) -> list:
+    """Returns the [start, end) addresses of the PT_LOAD segments of an open ELF64 binary, [] for anything else."""
+    if binary is None:
+        return []
+    head = os.pread(binary.fileno(), 64, 0)
+    if len(head) < 64 or head[:4] != b"\x7fELF" or head[4] != 2 or head[5] != 1:
+        return []
+    (phoff,) = struct.unpack_from("<Q", head, 32)
+    phentsize, phnum = struct.unpack_from("<HH", head, 54)
+    table = os.pread(binary.fileno(), phentsize * phnum, phoff)
+    ranges = []
+    for idx in range(len(table) // phentsize if phentsize else 0):
+        p_type, _, _, p_vaddr, _, _, p_memsz = struct.unpack_from("<IIQQQQQ", table, idx * phentsize)
+        if p_type == PT_LOAD and p_memsz > 0:
+            ranges.append((p_vaddr, p_vaddr + p_memsz))
+    return ranges
+
+
+def normalize(pseudocode: str, name: str = None, ranges: list = ()) -> str:
+    """Strips what changes with the link address or naming of a function, see the module docstring.
+
+    `ranges` are the address ranges of the binary, see load_ranges;
+    without them no constant is taken for an address.
+    """
+    if name:
+        # The signature, and recursive calls
+        pseudocode = re.sub(rf"\b{re.escape(name)}\b", "FUNC", pseudocode)
+    pseudocode = COMMENT.sub("", pseudocode)
+    pseudocode = DUMMY_NAME.sub(r"\1_X", pseudocode)
+    if len(ranges) > 0:
+        def address(match):
+            value = int(match.group(1), 16)
+            return "ADDR" if any(start <= value < end for start, end in ranges) else match.group(0)
+        pseudocode = HEX_CONSTANT.sub(address, pseudocode)
+    return SPACES.sub(" ", pseudocode).strip()
+
+
+def body_hash(function_info: dict, ranges: list = ()) -> str:
+    return hashlib.sha256(normalize(function_info["pseudocode"], function_info.get("name"), ranges).encode()).hexdigest()
+
+
+def bytes_hash(binary, function_info: dict) -> str:
+    """Hashes the raw bytes of a function, `binary` is the open binary, None if missing."""
+    size = function_info.get("size")
+    offset = function_info.get("file_offset")
+    if binary is None or not size or offset is None or offset < 0:
+        return None
+    data = os.pread(binary.fileno(), size, offset)
+    if len(data) != size:
+        return None
+    return hashlib.sha256(data).hexdigest()
+
+
+class FunctionDedup:
+    def __init__(self, project_root: str):
+        self.project_root = project_root
+        self.logger = logging.getLogger("FunctionDedup")
+        self.db = ProjectDB(os.path.join(project_root, "dedup_db.sqlite3"))
+        self.db.migrate(MIGRATIONS)
+
+    def decomp_files(self) -> list:
+        """Returns (binary, path) of the .decomp files new or changed since they were added."""
+        known = {binary: (size, mtime) for binary, size, mtime in self.db.execute("SELECT binary, size, mtime FROM decomp_files")}
+        res = []
+        for package in sorted(os.listdir(self.project_root)):
+            bin_root = os.path.join(self.project_root, package, "bin")
+            if not os.path.isdir(bin_root):
+                continue
+            for entry in sorted(os.scandir(bin_root), key=lambda entry: entry.name):
+                if not entry.name.endswith(RESULT_SUFFIX) or not entry.is_file():
+                    continue
+                binary = os.path.join(package, "bin", entry.name[:-len(RESULT_SUFFIX)])
+                stat = entry.stat()
+                if known.get(binary) != (stat.st_size, stat.st_mtime_ns):
+                    res.append((binary, entry.path))
+        return res
+
+    def add(self, binary: str, decomp_path: str) -> int:
+        """Adds the functions of one .decomp file, replacing what was added for it before; returns how many."""
+        stat = os.stat(decomp_path)
+        bin_path = os.path.join(self.project_root, binary)
+        rows = []
+        bodies = {}
+        binary_file = open(bin_path, "rb") if os.path.exists(bin_path) else None
+        try:
+            ranges = load_ranges(binary_file)
+            for function_info in iter_functions(decomp_path):
+                digest = body_hash(function_info, ranges)
+                bodies.setdefault(digest, function_info["pseudocode"])
+                rows.append((binary, function_info["address"], function_info.get("name"), digest, bytes_hash(binary_file, function_info)))
+        finally:
+            if binary_file is not None:
+                binary_file.close()
+        with self.db.transaction() as conn:
+            self._remove(conn, binary)
+            conn.executemany("INSERT OR IGNORE INTO bodies (hash, pseudocode) VALUES (?, ?)", bodies.items())
+            conn.executemany("INSERT OR REPLACE INTO functions VALUES (?, ?, ?, ?, ?)", rows)
+            conn.execute(
+                "UPDATE bodies SET refs = refs + (SELECT count(*) FROM functions f WHERE f.binary = ? AND f.body_hash = bodies.hash) "
+                "WHERE hash IN (SELECT body_hash FROM functions WHERE binary = ?)",
+                (binary, binary)
+            )
+            conn.execute("INSERT OR REPLACE INTO decomp_files VALUES (?, ?, ?)", (binary, stat.st_size, stat.st_mtime_ns))
+        return len(rows)
+
+    @staticmethod
+    def _remove(conn, binary: str):
+        hashes = [(digest,) for digest, in conn.execute("SELECT DISTINCT body_hash FROM functions WHERE binary = ?", (binary,))]
+        if len(hashes) == 0:
+            return
+        conn.execute(
+            "UPDATE bodies SET refs = refs - (SELECT count(*) FROM functions f WHERE f.binary = ? AND f.body_hash = bodies.hash) "
+            "WHERE hash IN (SELECT body_hash FROM functions WHERE binary = ?)",
+            (binary, binary)
+        )
+        conn.execute("DELETE FROM functions WHERE binary = ?", (binary,))
+        conn.executemany("DELETE FROM bodies WHERE hash = ? AND refs <= 0", hashes)
+
+    def update(self) -> int:
+        """Adds every new or changed .decomp file, returns how many."""
+        files = self.decomp_files()
+        for idx, (binary, path) in enumerate(files):
+            try:
+                self.logger.debug("Adding %s (%d/%d)", binary, idx + 1, len(files))
+                self.add(binary, path)
+            except (OSError, ValueError, KeyError) as e:
+                self.logger.error("Failed to read %s: %s", path, e)
+        return len(files)
+
+    def stats(self, top: int = 10) -> dict:
+        functions, binaries, pseudocode_size = self.db.execute(
+            "SELECT count(*), count(DISTINCT binary), "
+            "(SELECT coalesce(sum(length(b.pseudocode)), 0) FROM functions f JOIN bodies b ON b.hash = f.body_hash) FROM functions"
+        )[0]
+        bodies, unique_size = self.db.execute("SELECT count(*), coalesce(sum(length(pseudocode)), 0) FROM bodies")[0]
+        byte_functions, byte_hashes = self.db.execute(
+            "SELECT count(*), count(DISTINCT bytes_hash) FROM functions WHERE bytes_hash IS NOT NULL"
+        )[0]
+        most_common = self.db.execute(
+            # Named after a symbol where any binary has one
+            "SELECT (SELECT name FROM functions f WHERE f.body_hash = hash ORDER BY name GLOB 'sub_*', name LIMIT 1), refs "
+            "FROM bodies ORDER BY refs DESC LIMIT ?",
+            (top,)
+        )
+        return {
+            "binaries": binaries,
+            "functions": functions,
+            "unique_bodies": bodies,
+            "duplicate_ratio": 1 - bodies / functions if functions > 0 else 0.0,
+            "pseudocode_bytes": pseudocode_size,
+            "unique_pseudocode_bytes": unique_size,
+            "functions_with_bytes": byte_functions,
+            "unique_bytes": byte_hashes,
+            "most_common": most_common
+        }
+
+    def export(self, path: str) -> int:
+        """Writes every distinct body as a JSON line, with its hash and reference count; returns how many."""
+        count = 0
+        with open(path, "w") as f:
+            for digest, pseudocode, refs in self.db.execute("SELECT hash, pseudocode, refs FROM bodies ORDER BY hash"):
+                f.write(json.dumps({"hash": digest, "pseudocode": pseudocode, "refs": refs}) + "\n")
+                count += 1
+        return count
+
+    def close(self):
+        self.db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deduplicate the decompiled functions of a decomp project")
+    parser.add_argument("project", type=str, help="Decomp project path, see extract_functions_with_ida.py")
+    parser.add_argument("-t", "--top", type=int, default=10, help="Most duplicated functions to list")
+    parser.add_argument("-e", "--export", type=str, help="Write every distinct function to this JSON Lines file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    dedup = FunctionDedup(args.project)
+    dedup.logger.info("Added %d .decomp files", dedup.update())
+    stats = dedup.stats(args.top)
+    dedup.logger.info(
+        "%d functions of %d binaries, %d distinct (%.1f%% duplicates), pseudocode %.1f MiB, %.1f MiB distinct",
+        stats["functions"], stats["binaries"], stats["unique_bodies"], stats["duplicate_ratio"] * 100,
+        stats["pseudocode_bytes"] / (1 << 20), stats["unique_pseudocode_bytes"] / (1 << 20)
+    )
+    dedup.logger.info("%d functions with raw bytes, %d distinct", stats["functions_with_bytes"], stats["unique_bytes"])
+    for name, refs in stats["most_common"]:
+        dedup.logger.info("%8d x %s", refs, name)
+    if args.export:
+        dedup.logger.info("Exported %d functions to %s", dedup.export(args.export), args.export)
+    dedup.close()
+
+
+if __name__ == '__main__':
+    main()
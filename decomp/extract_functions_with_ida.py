@@ -1,76 +1,306 @@
 #!/usr/bin/env python3
+"""Decompiles every binary of a decomp project with IDA.
 
+The project is what misc_scripts/convert_project_to_decomp.py produced:
+<project>/<package>/bin/<binary>. Binaries are rows of a job table,
+decomp_db.sqlite3 in the project, filled by one directory scan at start.
+Workers, one per core, run `idat64` with ida_script/dump_pseudocode.py
+and report back; the table and the progress bar are updated from their
+results, so the directories are never polled. A rerun picks up where the
+last one stopped, binaries interrupted by a crash included.
+
+Binaries are handed out largest first, so the long ones do not start at
+the end of a run and leave most cores idle. Each IDA run gets a time
+budget growing with the size of the binary; when it is used up, IDA and
+whatever it started are killed as a process group. Only failures that
+look transient, IDA killed by a signal (e.g. by the OOM killer) or not
+started at all, are retried; a timeout or an error exit would happen
+again.
+
+dump_pseudocode.py writes a .decomp file function by function and renames
+it into place when done, see decomp_file.py: it exists only when complete,
+and the next run of a binary whose IDA was killed resumes from what the
+last one wrote.
+
+Work is keyed by the SHA-256 of a binary: the same file built at several
+-O levels of a package that ignores CFLAGS, or a tool vendored by many
+sources, is decompiled once. Its copies get a link to the .decomp file
+of the one decompiled (or fail with it) and record it as `duplicate_of`.
+"""
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import logging
 import os
+import signal
+import subprocess
 import sys
 import time
 from tqdm.auto import tqdm
-import multiprocessing
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from project_db import ProjectDB
+from decomp_file import PARTIAL_SUFFIX, RESULT_SUFFIX
+
+# Left next to the binary by IDA
+IDA_SUFFIXES = (".id0", ".id1", ".id2", ".nam", ".til")
+SKIP_SUFFIXES = (RESULT_SUFFIX, PARTIAL_SUFFIX, RESULT_SUFFIX + ".tmp", ".log", ".i64", ".idb") + IDA_SUFFIXES
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ida_script", "dump_pseudocode.py")
+RETRY = 3
+# Time budget of a binary: TIMEOUT_BASE seconds plus TIMEOUT_PER_MB per MiB
+TIMEOUT_BASE = 600
+TIMEOUT_PER_MB = 60
 
-def analyze(bin_path, retry=3):
-    tried = 0
-    while tried < retry:
+MIGRATIONS = [
+    [
+        "CREATE TABLE IF NOT EXISTS binaries (id INTEGER PRIMARY KEY AUTOINCREMENT, package TEXT, name TEXT, path TEXT UNIQUE, "
+        "size INTEGER, status TEXT, attempts INTEGER NOT NULL DEFAULT 0, elapsed REAL, error TEXT, finished_at REAL)",
+        "CREATE INDEX IF NOT EXISTS binaries_status ON binaries (status, id)",
+    ],
+    [
+        "ALTER TABLE binaries ADD COLUMN sha256 TEXT",
+        "ALTER TABLE binaries ADD COLUMN duplicate_of INTEGER",
+        "CREATE INDEX IF NOT EXISTS binaries_sha256 ON binaries (sha256, status)",
+    ],
+]
+
+
+def clean_ida_files(bin_path: str):
+    for suffix in IDA_SUFFIXES:
         try:
-            bin_dir_path = os.path.dirname(bin_path)
-            bin_name = os.path.basename(bin_path)
-            os.system(
-                f'idat64 -A -S"ida_script/dump_pseudocode.py {bin_dir_path}" -L{os.path.join(bin_dir_path, bin_name+".log")} {bin_path}')
-        except Exception:
+            os.remove(bin_path + suffix)
+        except FileNotFoundError:
             pass
-        if os.path.exists(os.path.join(bin_dir_path, bin_name+".decomp")):
-            break
-        else:
-            tried += 1
-    os.system(f"rm -f {os.path.join(bin_dir_path, bin_name+'.id0')}")
-    os.system(f"rm -f {os.path.join(bin_dir_path, bin_name+'.id1')}")
-    os.system(f"rm -f {os.path.join(bin_dir_path, bin_name+'.id2')}")
-    os.system(f"rm -f {os.path.join(bin_dir_path, bin_name+'.nam')}")
-    os.system(f"rm -f {os.path.join(bin_dir_path, bin_name+'.til')}")
-
-
-project_path = sys.argv[1]
-
-pool = multiprocessing.Pool(56)
-for package in tqdm(os.listdir(project_path)):
-    for binary in os.listdir(os.path.join(project_path, package, "bin")):
-        if binary.endswith(".decomp") or \
-            binary.endswith(".log") or \
-            binary.endswith(".i64"):
-            continue
-        if binary.endswith(".id0") or \
-            binary.endswith(".id1") or \
-            binary.endswith(".id2") or \
-            binary.endswith(".nam") or \
-            binary.endswith(".til"):
-            os.system(f"rm -f {os.path.join(project_path, package, 'bin', binary)}")
-            continue
-        if os.path.exists(os.path.join(project_path, package, "bin", binary+".decomp")):
-            continue
-        pool.apply_async(analyze, (os.path.join(
-            project_path, package, "bin", binary), ))
-
-pool.close()
-
-
-while True:
-    oknum = 0
-    totalnum = 0
-    for package in os.listdir(project_path):
-        for binary in os.listdir(os.path.join(project_path, package, "bin")):
-            if binary.endswith(".decomp") or \
-                binary.endswith(".log") or \
-                binary.endswith(".i64") or \
-                binary.endswith(".id0") or \
-                binary.endswith(".id1") or \
-                binary.endswith(".id2") or \
-                binary.endswith(".nam") or \
-                binary.endswith(".til"):
+
+
+def file_hash(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def link_result(src_bin_path: str, dst_bin_path: str):
+    """Makes the .decomp file of `src_bin_path` that of `dst_bin_path` as well."""
+    src = src_bin_path + RESULT_SUFFIX
+    dst = dst_bin_path + RESULT_SUFFIX
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        # Not on the same file system
+        os.symlink(os.path.relpath(src, os.path.dirname(dst)), dst)
+
+
+def time_budget(size: int, base: float = TIMEOUT_BASE, per_mb: float = TIMEOUT_PER_MB) -> float:
+    return base + size / (1 << 20) * per_mb
+
+
+def analyze(bin_path: str, idat: str = "idat64", timeout: float = None, compress: bool = False) -> dict:
+    """Runs IDA on one binary, in a worker thread; returns how it went.
+
+    `transient` tells whether another attempt may go better.
+    """
+    bin_dir_path = os.path.dirname(bin_path)
+    start = time.monotonic()
+    error = None
+    transient = False
+    try:
+        # A session of its own, so that a timeout kills what IDA started as well
+        process = subprocess.Popen(
+            [idat, "-A", f"-S{SCRIPT_PATH} {bin_dir_path}{' --zstd' if compress else ''}", f"-L{bin_path}.log", bin_path],
+            stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True
+        )
+        try:
+            returncode = process.wait(timeout)
+            if returncode < 0:
+                error = f"{idat} killed by signal {-returncode}"
+                transient = True
+            elif returncode != 0:
+                error = f"{idat} exited with status {returncode}"
+        except subprocess.TimeoutExpired:
+            error = f"Timed out after {timeout:.0f} s"
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            process.wait()
+    except OSError as e:
+        error = str(e)
+        transient = True
+    finally:
+        clean_ida_files(bin_path)
+    # Renamed into place once complete, whatever happened after
+    done = os.path.exists(bin_path + RESULT_SUFFIX)
+    if done:
+        error = None
+        transient = False
+    elif error is None:
+        error = f"No {RESULT_SUFFIX} written"
+    return {"done": done, "elapsed": time.monotonic() - start, "error": error, "transient": transient}
+
+
+class DecompProject:
+    def __init__(self, project_root: str):
+        self.project_root = project_root
+        self.logger = logging.getLogger("DecompProject")
+        self.db = ProjectDB(os.path.join(project_root, "decomp_db.sqlite3"))
+        self.db.migrate(MIGRATIONS)
+
+    def scan(self) -> int:
+        """Adds the binaries not in the job table yet, returns how many."""
+        rows = []
+        for package in sorted(os.listdir(self.project_root)):
+            bin_root = os.path.join(self.project_root, package, "bin")
+            if not os.path.isdir(bin_root):
                 continue
-            if os.path.exists(os.path.join(project_path, package, "bin", binary+".decomp")):
-                oknum += 1
-            totalnum += 1
-    print(f"{oknum}/{totalnum} ({oknum/totalnum*100:.2f}%)")
-    time.sleep(10)
+            for entry in os.scandir(bin_root):
+                if not entry.is_file() or entry.name.endswith(SKIP_SUFFIXES):
+                    continue
+                done = os.path.exists(entry.path + RESULT_SUFFIX)
+                rows.append((package, entry.name, entry.path, entry.stat().st_size, "DONE" if done else "NOT_STARTED"))
+        with self.db.transaction() as cursor:
+            before = cursor.total_changes
+            cursor.executemany(
+                "INSERT OR IGNORE INTO binaries (package, name, path, size, status) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            added = cursor.total_changes - before
+        # Rows added by an earlier scan, before hashes were kept, included
+        hashes = []
+        for binary_id, path in self.db.execute("SELECT id, path FROM binaries WHERE sha256 IS NULL"):
+            try:
+                hashes.append((file_hash(path), binary_id))
+            except OSError as e:
+                self.logger.warning("Failed to hash %s: %s", path, e)
+        with self.db.transaction() as cursor:
+            cursor.executemany("UPDATE binaries SET sha256 = ? WHERE id = ?", hashes)
+        for (sha256,) in self.db.execute("SELECT DISTINCT sha256 FROM binaries WHERE status = 'NOT_STARTED' AND sha256 IS NOT NULL"):
+            self.resolve_duplicates(sha256)
+        return added
+
+    def resolve_duplicates(self, sha256: str) -> int:
+        """Gives the NOT_STARTED binaries of `sha256` the result of a copy that is finished, returns how many."""
+        source = self.db.execute(
+            "SELECT id, path, status, error FROM binaries WHERE sha256 = ? AND status IN ('DONE', 'FAILED') "
+            "AND duplicate_of IS NULL ORDER BY status = 'FAILED', id LIMIT 1",
+            (sha256,)
+        )
+        if len(source) == 0:
+            return 0
+        source_id, source_path, status, error = source[0]
+        if status == "DONE" and not os.path.exists(source_path + RESULT_SUFFIX):
+            self.logger.warning("%s is DONE but has no %s", source_path, RESULT_SUFFIX)
+            return 0
+        duplicates = self.db.execute("SELECT id, path FROM binaries WHERE sha256 = ? AND status = 'NOT_STARTED'", (sha256,))
+        with self.db.transaction() as cursor:
+            for binary_id, path in duplicates:
+                if status == "DONE":
+                    link_result(source_path, path)
+                cursor.execute(
+                    "UPDATE binaries SET status = ?, error = ?, duplicate_of = ?, finished_at = ? WHERE id = ?",
+                    (status, error, source_id, time.time(), binary_id)
+                )
+        return len(duplicates)
+
+    def consolidate(self) -> int:
+        """Puts binaries interrupted by a crash back to NOT_STARTED."""
+        res = self.db.execute("UPDATE binaries SET status = 'NOT_STARTED' WHERE status = 'STARTED' RETURNING path")
+        for path, in res:
+            clean_ida_files(path)
+        if len(res) > 0:
+            self.logger.info("Restored %d binaries", len(res))
+        return len(res)
+
+    def pending(self) -> list:
+        """Returns (id, path, size, sha256) of the binaries to decompile, one per hash, largest first."""
+        return self.db.execute(
+            "SELECT id, path, size, sha256 FROM binaries WHERE status = 'NOT_STARTED' AND id IN "
+            "(SELECT min(id) FROM binaries WHERE status = 'NOT_STARTED' GROUP BY coalesce(sha256, id)) ORDER BY size DESC, id"
+        )
+
+    def set_started(self, binary_id: int):
+        self.db.execute("UPDATE binaries SET status = 'STARTED', attempts = attempts + 1 WHERE id = ?", (binary_id,))
+
+    def set_result(self, binary_id: int, status: str, elapsed: float, error: str = None):
+        self.db.execute(
+            "UPDATE binaries SET status = ?, elapsed = ?, error = ?, finished_at = ? WHERE id = ?",
+            (status, elapsed, error, time.time(), binary_id)
+        )
+
+    def counts(self) -> dict:
+        return dict(self.db.execute("SELECT status, count(*) FROM binaries GROUP BY status"))
+
+    def saved(self) -> tuple:
+        """Returns how many binaries were not decompiled for being copies, and the IDA seconds that took their originals."""
+        return self.db.execute(
+            "SELECT count(*), coalesce(sum(s.elapsed), 0) FROM binaries d JOIN binaries s ON s.id = d.duplicate_of"
+        )[0]
+
+    def close(self):
+        self.db.close()
+
+
+def decompile_project(project: DecompProject, idat: str = "idat64", max_workers: int = None, retry: int = RETRY,
+                      timeout_base: float = TIMEOUT_BASE, timeout_per_mb: float = TIMEOUT_PER_MB, compress: bool = False) -> dict:
+    """Decompiles every NOT_STARTED binary, each content once; returns the job counts by status."""
+    max_workers = max_workers or os.cpu_count()
+    queue = collections.deque(project.pending())
+    counts = project.counts()
+    progress = tqdm(total=sum(counts.values()), initial=counts.get("DONE", 0) + counts.get("FAILED", 0))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while len(queue) > 0 or len(running) > 0:
+            while len(queue) > 0 and len(running) < max_workers:
+                binary_id, path, size, sha256 = queue.popleft()
+                project.set_started(binary_id)
+                timeout = time_budget(size, timeout_base, timeout_per_mb)
+                running[executor.submit(analyze, path, idat, timeout, compress)] = (binary_id, path, size, sha256)
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                binary_id, path, size, sha256 = running.pop(future)
+                res = future.result()
+                if res["done"]:
+                    project.set_result(binary_id, "DONE", res["elapsed"])
+                    progress.update(1 + (project.resolve_duplicates(sha256) if sha256 else 0))
+                    continue
+                attempts = project.db.execute("SELECT attempts FROM binaries WHERE id = ?", (binary_id,))[0][0]
+                if res["transient"] and attempts < retry:
+                    project.logger.info("Decompiling %s failed: %s, retrying %d/%d", path, res["error"], attempts, retry)
+                    project.set_result(binary_id, "NOT_STARTED", res["elapsed"], res["error"])
+                    queue.append((binary_id, path, size, sha256))
+                    continue
+                project.logger.error("Decompiling %s failed: %s", path, res["error"])
+                project.set_result(binary_id, "FAILED", res["elapsed"], res["error"])
+                # Identical bytes, the same error
+                progress.update(1 + (project.resolve_duplicates(sha256) if sha256 else 0))
+    progress.close()
+    return project.counts()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decompile the binaries of a decomp project with IDA")
+    parser.add_argument("project", type=str, help="Decomp project path, see misc_scripts/convert_project_to_decomp.py")
+    parser.add_argument("-j", "--parallel", type=int, default=os.cpu_count(), help="IDA instances running at the same time")
+    parser.add_argument("-r", "--retry", type=int, default=RETRY, help="Attempts per binary, after transient failures only")
+    parser.add_argument("-t", "--timeout", type=float, default=TIMEOUT_BASE, help="Seconds every binary gets")
+    parser.add_argument("--timeout-per-mb", type=float, default=TIMEOUT_PER_MB, help="Seconds added per MiB of binary")
+    parser.add_argument("-z", "--zstd", action="store_true", help="Write zstd-compressed .decomp files")
+    parser.add_argument("--idat", type=str, default="idat64", help="IDA console executable")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    project = DecompProject(args.project)
+    project.consolidate()
+    project.logger.info("Found %d new binaries", project.scan())
+    counts = decompile_project(project, args.idat, args.parallel, args.retry, args.timeout, args.timeout_per_mb, args.zstd)
+    project.logger.info("Done: %s", ", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+    duplicates, seconds = project.saved()
+    project.logger.info("%d binaries were copies of another, saving %.1f IDA hours", duplicates, seconds / 3600)
+    project.close()
 
 
-pool.join()
+if __name__ == '__main__':
+    main()
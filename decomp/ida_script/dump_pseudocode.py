@@ -4,8 +4,8 @@ import shutil
 import typing
 import logging
 import traceback
-import json
 
+import ida_funcs
 import ida_nalt
 import idautils
 import ida_hexrays
@@ -14,8 +14,10 @@ import ida_loader
 import idc
 import ida_segment
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from decomp_file import RESULT_SUFFIX, DecompWriter
+
 force_decompile = False
-RESULT_SUFFIX = ".decomp"
 
 #? maybe we should clean the output file (log) each Analysis
 logger = None
@@ -44,24 +46,32 @@ def decompile_function(function_address: int) -> typing.Dict[str, typing.Any]:
     function_info['pseudocode'] = pseudocode
     function_info['address'] = function_address
     function_info['file_offset'] = ida_loader.get_fileregion_offset(function_address)
+    # Bytes from the entry up to the end of its first chunk
+    function_info['size'] = ida_funcs.get_func(function_address).end_ea - function_address
     return function_info
 
-def decompile_binary() -> typing.List:
+def decompile_binary(writer: DecompWriter) -> int:
+    """
+    write every function not written by an earlier run, return how many
+    """
     global logger
-    result = []
+    count = 0
     for function_address in idautils.Functions():
+        if function_address in writer.done:
+            continue
         try:
             if skip_function(function_address):
                 continue
-            result.append(decompile_function(function_address))
+            writer.write(decompile_function(function_address))
+            count += 1
         except Exception as e:
             logger.error(f"Decompile function failed, address: {hex(function_address)}, error: {e}")
-    return result
+    return count
 
 def main():
     global logger
     
-    # sys.arg[1] is dump path
+    # idc.ARGV[1] is dump path, "--zstd" may follow
     binary_name = ida_nalt.get_root_filename()
     
     # set logging format
@@ -95,10 +105,13 @@ def main():
     else:
         logger.info("Hexrays plugin found, version: %s", ida_hexrays.get_hexrays_version())
     
-    # Begin decompile
-    result = decompile_binary()
-    with open(result_file_path, 'w') as f:
-        json.dump(result, f, indent=4)   
+    # Begin decompile, resuming the partial result of a killed run
+    writer = DecompWriter(result_file_path, compress="--zstd" in idc.ARGV[2:])
+    if len(writer.done) > 0:
+        logger.info(f"Resuming, {len(writer.done)} functions already decompiled")
+    with writer:
+        count = decompile_binary(writer)
+    logger.info(f"Decompiled {count} functions")
 
 if __name__ == '__main__':
     idc.auto_wait()
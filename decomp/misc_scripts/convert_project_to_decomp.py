@@ -1,49 +1,69 @@
 import os
 import sys
-import magic
+import hashlib
 from tqdm.auto import tqdm
-from pygments.lexers import get_lexer_for_filename
 
-def walk_path(target_path):
-    if os.path.isdir(target_path):
-        for file_name in os.listdir(target_path):
-            yield from walk_path(os.path.join(target_path, file_name))
-    else:
-        yield target_path
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+import classifier
+from file_cache import FileCache
+from job_archive import open_job, job_dirname
 
-def process_dir(input_path: str, output_path: str):
-    for file_path in walk_path(input_path):
+# Node types of KnowledgeGraph/node.py, they share the file cache
+SRC_TYPES = ("Source",)
+BIN_TYPES = ("Executable", "ArchiveLib")
+
+def copy_file(data: bytes, file_path: str, output_path: str):
+    os.makedirs(output_path, exist_ok=True)
+    with open(os.path.join(output_path, os.path.basename(file_path)), "wb") as f:
+        f.write(data)
+
+def is_copied(file_path: str, output_path: str, size: int) -> bool:
+    try:
+        return os.path.getsize(os.path.join(output_path, os.path.basename(file_path))) == size
+    except OSError:
+        return False
+
+def process_job(job, output_path: str, cache: FileCache = None, package_url: str = ""):
+    # Packed or not, only gcc/ and ld/ are read, through the job
+    for file_path in job.names():
+        if file_path.split(os.sep)[0] not in ("gcc", "ld"):
+            continue
         try:
-            file_info = magic.from_file(os.path.join(input_path, file_path))
-            to_copy = None
-            if file_info.startswith("C source") or \
-                file_info.startswith("C++ source"):
-                to_copy = os.path.join(input_path, file_path)
-            elif file_info.startswith("ASCII text"):
-                guess_type = get_lexer_for_filename(file_path).name
-                if guess_type == "C" or guess_type == "C++":
-                    to_copy = os.path.join(input_path, file_path)
+            file_url = os.path.join(package_url, file_path)
+            stat = job.stat(file_path)
+            record = cache.get(file_url, stat) if cache is not None else None
+            data = None
+            if record is None:
+                data = job.read(file_path)
+                node_type, language, description, magic_info = classifier.classify(file_path, data)
+                record = {"hash": hashlib.sha256(data).hexdigest(), "magic_info": magic_info, "description": description,
+                          "node_type": node_type, "language": language}
+                if cache is not None:
+                    cache.put(file_url, stat, **record)
+            if record["node_type"] in SRC_TYPES:
+                target = os.path.join(output_path, 'src')
+            elif record["node_type"] in BIN_TYPES:
+                target = os.path.join(output_path, 'bin')
             else:
-                pass
-            if to_copy is not None:
-                os.system(f"mkdir -p {os.path.join(output_path, 'src')}")
-                os.system(f"cp {os.path.join(input_path, file_path)} {os.path.join(output_path, 'src')}")
                 continue
-        
-            if file_info.startswith("ELF 64-bit LSB executable") or \
-                file_info.startswith("current ar archive"):
-                os.system(f"mkdir -p {os.path.join(output_path, 'bin')}")
-                os.system(f"cp {os.path.join(input_path, file_path)} {os.path.join(output_path, 'bin')}")
+            # Unchanged files copied by an earlier run are not read again
+            if data is None and is_copied(file_path, target, stat[0]):
+                continue
+            copy_file(data if data is not None else job.read(file_path), file_path, target)
         except Exception:
             print(f"Error processing {file_path}")
 
-def process_package(package_path: str, output_path: str):
-    process_dir(os.path.join(package_path, "gcc"), output_path)
-    process_dir(os.path.join(package_path, "ld"), output_path)
+def process_package(packages_root: str, dirname: str, output_path: str, cache: FileCache = None):
+    with open_job(packages_root, dirname) as job:
+        process_job(job, output_path, cache, os.path.join("packages", dirname))
+        if cache is not None:
+            cache.commit()
 
 def main(project_path: str, output_path: str):
-    for package_name in tqdm(os.listdir(os.path.join(project_path, "packages"))):
-        process_package(os.path.join(project_path, "packages", package_name), os.path.join(output_path, package_name))
+    packages_root = os.path.join(project_path, "packages")
+    with FileCache(project_path) as cache:
+        for package_name in tqdm(sorted(set(job_dirname(name) for name in os.listdir(packages_root)))):
+            process_package(packages_root, package_name, os.path.join(output_path, package_name), cache)
 
 if __name__ == '__main__':
     main(sys.argv[1], sys.argv[2])
\ No newline at end of file
@@ -0,0 +1,188 @@
+import asyncio
+import collections
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+import docker
+from docker_async import AsyncDockerClient, DockerAPIError, container_config
+
+DEPS_REPOSITORY = "compile_docker_deps"
+
+
+class DepLayerCache:
+    """Build dependencies installed once per package, shared by all -O levels.
+
+    The first job of a package runs `compile.sh` with COMPILE_STAGE=deps,
+    which stops right after `apt build-dep`, and commits that container as
+    an image. Every optimization level of the package then starts from the
+    image with SKIP_BUILD_DEP=1. Once no job of the package is NOT_STARTED
+    or STARTED any more, the image is removed again.
+
+    Layers are recorded in the `dep_layers` table, so a restarted project
+    reuses the images that survived and `gc()` removes the ones that are
+    no longer needed. A package whose dependencies fail to install falls
+    back to the base image, where the build reports the failure itself.
+    """
+
+    def __init__(self, db, base_image: str, log_root: str):
+        self.db = db
+        self.base_image = base_image
+        self.log_root = log_root
+        self.logger = logging.getLogger("DepLayerCache")
+        self._locks = collections.defaultdict(threading.Lock)
+        self._async_locks = collections.defaultdict(asyncio.Lock)
+        self._locks_lock = threading.Lock()
+
+    def image_name(self, package_name: str) -> str:
+        # Docker tags do not allow '+', which is common in package names
+        digest = hashlib.sha1(package_name.encode()).hexdigest()[:8]
+        return f"{DEPS_REPOSITORY}:{re.sub(r'[^A-Za-z0-9_.-]', '_', package_name)[:100]}-{digest}"
+
+    def deps_spec(self, package_name: str) -> dict:
+        return {
+            "image": self.base_image,
+            "command": [
+                "/bin/sh",
+                "-c",
+                f"compile.sh {package_name} {os.getuid()} {os.getgid()}"
+            ],
+            "environment": {
+                "COMPILE_STAGE": "deps"
+            },
+            "name": f"{package_name}_deps"
+        }
+
+    def _log_path(self, package_name: str) -> str:
+        os.makedirs(self.log_root, exist_ok=True)
+        return os.path.join(self.log_root, f"{package_name}.log")
+
+    def _lookup(self, package_name: str):
+        res = self.db.execute("SELECT image, status FROM dep_layers WHERE package_name = ?", (package_name,))
+        if len(res) == 0:
+            return None
+        image, status = res[0]
+        return image if status == "READY" else self.base_image
+
+    def _record(self, package_name: str, image: str, succeed: bool) -> str:
+        self.db.execute(
+            "INSERT OR REPLACE INTO dep_layers (package_name, image, status, created_at) VALUES (?, ?, ?, ?)",
+            (package_name, image, "READY" if succeed else "FAILED", time.time())
+        )
+        if succeed:
+            self.logger.info("Dependency layer of %s ready as %s", package_name, image)
+            return image
+        self.logger.warning("Dependency layer of %s failed, building from %s", package_name, self.base_image)
+        return self.base_image
+
+    def _pending(self, package_name: str) -> int:
+        return self.db.execute(
+            "SELECT count(*) FROM packages WHERE package_name = ? AND status IN ('NOT_STARTED', 'STARTED')",
+            (package_name,)
+        )[0][0]
+
+    def _lock(self, package_name: str) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks[package_name]
+
+    def acquire(self, package_name: str) -> str:
+        """Returns the image to build `package_name` from, creating it if needed."""
+        with self._lock(package_name):
+            image = self._lookup(package_name)
+            if image is not None:
+                return image
+            image = self.image_name(package_name)
+            try:
+                succeed = self._build(package_name, image)
+            except Exception as e:
+                self.logger.error("Error building dependency layer of %s: %s", package_name, e)
+                succeed = False
+            return self._record(package_name, image, succeed)
+
+    def _build(self, package_name: str, image: str) -> bool:
+        client = docker.from_env()
+        container = client.containers.run(detach=True, **self.deps_spec(package_name))
+        try:
+            exit_code = container.wait()["StatusCode"]
+            with open(self._log_path(package_name), "wb") as f:
+                f.write(container.logs())
+            if exit_code != 0:
+                return False
+            repository, tag = image.split(":")
+            container.commit(repository=repository, tag=tag)
+            return True
+        finally:
+            container.remove(force=True)
+
+    def release(self, package_name: str):
+        """Removes the layer once the last job of `package_name` has finished."""
+        with self._lock(package_name):
+            if self._pending(package_name) > 0:
+                return
+            res = self.db.execute("SELECT image, status FROM dep_layers WHERE package_name = ?", (package_name,))
+            if len(res) == 0:
+                return
+            image, status = res[0]
+            if status == "READY":
+                try:
+                    docker.from_env().images.remove(image, force=True)
+                except docker.errors.ImageNotFound:
+                    pass
+                except Exception as e:
+                    self.logger.warning("Failed to remove dependency layer %s: %s", image, e)
+                    return
+            self.db.execute("DELETE FROM dep_layers WHERE package_name = ?", (package_name,))
+            self.logger.info("Dependency layer of %s removed", package_name)
+
+    def gc(self):
+        """Removes layers left behind by packages that have no jobs to run."""
+        for package_name, in self.db.execute("SELECT package_name FROM dep_layers"):
+            self.release(package_name)
+
+    async def acquire_async(self, client: AsyncDockerClient, package_name: str) -> str:
+        async with self._async_locks[package_name]:
+            image = await asyncio.to_thread(self._lookup, package_name)
+            if image is not None:
+                return image
+            image = self.image_name(package_name)
+            repository, tag = image.split(":")
+
+            async def commit(container_id, state):
+                if state["ExitCode"] == 0:
+                    await client.commit_container(container_id, repository, tag)
+
+            spec = self.deps_spec(package_name)
+            try:
+                state = await client.run_container(
+                    container_config(spec),
+                    name=spec["name"],
+                    log_path=self._log_path(package_name),
+                    on_exit=commit
+                )
+                succeed = state["ExitCode"] == 0
+            except Exception as e:
+                self.logger.error("Error building dependency layer of %s: %s", package_name, e)
+                succeed = False
+            return await asyncio.to_thread(self._record, package_name, image, succeed)
+
+    async def release_async(self, client: AsyncDockerClient, package_name: str):
+        async with self._async_locks[package_name]:
+            if await asyncio.to_thread(self._pending, package_name) > 0:
+                return
+            res = await asyncio.to_thread(
+                self.db.execute, "SELECT image, status FROM dep_layers WHERE package_name = ?", (package_name,)
+            )
+            if len(res) == 0:
+                return
+            image, status = res[0]
+            if status == "READY":
+                try:
+                    await client.remove_image(image)
+                except DockerAPIError as e:
+                    if e.status != 404:
+                        self.logger.warning("Failed to remove dependency layer %s: %s", image, e)
+                        return
+            await asyncio.to_thread(self.db.execute, "DELETE FROM dep_layers WHERE package_name = ?", (package_name,))
+            self.logger.info("Dependency layer of %s removed", package_name)
@@ -21,9 +21,35 @@ export COMPILE_COMMANDS_DB=${ARCHIVE_PATH}/compile_commands.sqlite3
 export GCC_PARSER_HIJACK_DWARF4=${GCC_PARSER_HIJACK_DWARF4:-1}
 export GCC_PARSER_HIJACK_OPTIMIZATION=${GCC_PARSER_HIJACK_OPTIMIZATION:-0}
 
-# Prepare user with same uid and gid as host
-addgroup --gid ${gid} build
-adduser --disabled-password --gecos "" --uid ${uid} --gid ${gid} build
+# Prepare user with same uid and gid as host (already there in a dependency layer)
+getent group build > /dev/null || addgroup --gid ${gid} build
+id build > /dev/null 2>&1 || adduser --disabled-password --gecos "" --uid ${uid} --gid ${gid} build
+
+# COMPILE_STAGE=fetch only downloads and unpacks the source package into
+# SOURCE_PATH, which the project keeps as a pristine tree for every
+# optimization level. Builds given such a tree set SOURCE_PATH as well.
+if [ "${COMPILE_STAGE:-build}" = "fetch" ]; then
+    chown build:build ${SOURCE_PATH}
+    su build -c "cd ${SOURCE_PATH} && apt -y source ${package_name}"
+    exit $?
+fi
+
+# Install build dependencies
+# COMPILE_STAGE=deps stops after this step, so the container can be committed
+# as a dependency layer shared by every optimization level of the package.
+# Builds started from such a layer set SKIP_BUILD_DEP=1.
+if [ ${SKIP_BUILD_DEP:-0} -ne 1 ]; then
+    apt -y build-dep ${package_name}
+    build_dep_status=$?
+
+    # Restore libstdc++ to self-compiled version, as build-dep may change
+    rm /usr/lib/x86_64-linux-gnu/libstdc++.so.6
+    ln -s /usr/lib64/libstdc++.so.6 /usr/lib/x86_64-linux-gnu/libstdc++.so.6
+fi
+
+if [ "${COMPILE_STAGE:-build}" = "deps" ]; then
+    exit ${build_dep_status:-0}
+fi
 
 # Prepare directories
 mkdir -p ${BUILD_PATH}
@@ -36,20 +62,22 @@ chown -R build:build ${BUILD_PATH}
 chown -R build:build ${ARCHIVE_PATH}
 chown -R build:build ${SAVE_PATH}
 
-# Install build dependencies
-apt -y build-dep ${package_name}
-
-# Restore libstdc++ to self-compiled version, as build-dep may change
-rm /usr/lib/x86_64-linux-gnu/libstdc++.so.6
-ln -s /usr/lib64/libstdc++.so.6 /usr/lib/x86_64-linux-gnu/libstdc++.so.6
-
 # Prepare compile.log
 touch ${SAVE_PATH}/compile.log
 chown build:build ${SAVE_PATH}/compile.log    
 
+# Let the project tell missing build dependencies from build failures
+if [ ${build_dep_status:-0} -ne 0 ]; then
+    echo "E: apt build-dep ${package_name} failed with status ${build_dep_status}" >> ${SAVE_PATH}/compile.log
+fi
+
 {
     # Start build process
-    su build -c "cd ${BUILD_PATH} && apt -y source --compile ${1}"
+    if [ -n "${SOURCE_PATH}" ]; then
+        su build -c "cp -a --reflink=auto ${SOURCE_PATH}/. ${BUILD_PATH}/ && cd \$(find ${BUILD_PATH} -mindepth 1 -maxdepth 1 -type d | head -n 1) && dpkg-buildpackage -b -uc"
+    else
+        su build -c "cd ${BUILD_PATH} && apt -y source --compile ${1}"
+    fi
 
     if [ $? -eq 0 ]; then
         compile_succeed=1
@@ -63,4 +91,4 @@ chown build:build ${SAVE_PATH}/compile.log
     if [ ${compile_succeed:=0} -eq 1 ]; then
         su build -c "touch ${SAVE_PATH}/compile_succeed"
     fi
-} 2>&1 > ${SAVE_PATH}/compile.log
\ No newline at end of file
+} >> ${SAVE_PATH}/compile.log 2>&1
\ No newline at end of file
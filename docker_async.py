@@ -0,0 +1,350 @@
+import asyncio
+import json
+import logging
+import os
+import urllib.parse
+
+DOCKER_HOST = "unix:///var/run/docker.sock"
+API_VERSION = "v1.41"
+MAX_CONNECTIONS = 16
+LOG_DRAIN_TIMEOUT = 30
+
+
+class DockerAPIError(Exception):
+    def __init__(self, status: int, message: str):
+        super(DockerAPIError, self).__init__(f"{status}: {message}")
+        self.status = status
+
+
+class _Response:
+    def __init__(self, release, conn, status: int, headers: dict):
+        self.release = release
+        self.conn = conn
+        self.status = status
+        self.headers = headers
+
+    async def iter_body(self):
+        reader = self.conn[0]
+        try:
+            if self.status in (204, 304):
+                pass
+            elif self.headers.get("transfer-encoding", "").lower() == "chunked":
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        raise ConnectionResetError("Docker daemon closed the connection")
+                    size = int(line.split(b";")[0].strip(), 16)
+                    if size == 0:
+                        await reader.readline()
+                        break
+                    chunk = await reader.readexactly(size)
+                    await reader.readexactly(2)
+                    yield chunk
+            elif "content-length" in self.headers:
+                length = int(self.headers["content-length"])
+                if length > 0:
+                    yield await reader.readexactly(length)
+            else:
+                while True:
+                    chunk = await reader.read(65536)
+                    if not chunk:
+                        break
+                    yield chunk
+        except BaseException:
+            self.close(reusable=False)
+            raise
+        self.close(reusable=self.headers.get("connection", "").lower() != "close")
+
+    async def read(self) -> bytes:
+        body = b""
+        async for chunk in self.iter_body():
+            body += chunk
+        return body
+
+    async def json(self):
+        body = await self.read()
+        return json.loads(body) if body else None
+
+    def close(self, reusable: bool = False):
+        if self.conn is not None:
+            self.release(self.conn, reusable)
+            self.conn = None
+
+
+class AsyncDockerClient:
+    """A small asyncio client for the Docker Engine API.
+
+    Plain requests share a bounded pool of keep-alive connections to the
+    daemon. Long-lived streams (events, followed logs) get a connection of
+    their own outside of the pool, closed once the stream ends. Container
+    exits are awaited through one shared `/events` subscription, so waiting
+    on hundreds of containers costs one stream instead of hundreds of
+    blocked `wait` requests.
+    """
+
+    def __init__(self, base_url: str = None, max_connections: int = MAX_CONNECTIONS, version: str = API_VERSION):
+        self.base_url = base_url or os.environ.get("DOCKER_HOST", DOCKER_HOST)
+        self.version = version
+        self.logger = logging.getLogger("AsyncDockerClient")
+        self._slots = asyncio.Semaphore(max_connections)
+        self._idle = []
+        self._waiters = {}
+        self._events_task = None
+        self._events_lock = asyncio.Lock()
+
+    async def _open(self):
+        url = urllib.parse.urlparse(self.base_url)
+        if url.scheme == "unix":
+            return await asyncio.open_unix_connection(url.path)
+        elif url.scheme in ("tcp", "http"):
+            return await asyncio.open_connection(url.hostname, url.port)
+        else:
+            raise Exception(f"Unsupported docker host: {self.base_url}")
+
+    def _release(self, conn, reusable: bool):
+        if reusable and not conn[0].at_eof():
+            self._idle.append(conn)
+        else:
+            conn[1].close()
+        self._slots.release()
+
+    def _close(self, conn, reusable: bool):
+        conn[1].close()
+
+    async def request(self, method: str, path: str, params: dict = None, body=None, stream: bool = False) -> _Response:
+        """Sends a request and returns once the response headers are in.
+
+        Unless `stream` is set, the connection is taken from the bounded pool
+        and the caller must consume the body (read/json/iter_body).
+        """
+        target = f"/{self.version}{path}"
+        if params:
+            target += "?" + urllib.parse.urlencode(params)
+        payload = json.dumps(body).encode() if body is not None else b""
+        head = f"{method} {target} HTTP/1.1\r\nHost: docker\r\nContent-Length: {len(payload)}\r\n"
+        if body is not None:
+            head += "Content-Type: application/json\r\n"
+        head += "\r\n"
+
+        if stream:
+            conn = await self._open()
+        else:
+            await self._slots.acquire()
+            conn = self._idle.pop() if self._idle else await self._open()
+        try:
+            reader, writer = conn
+            writer.write(head.encode() + payload)
+            await writer.drain()
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionResetError("Docker daemon closed the connection")
+            status = int(status_line.split()[1])
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                key, _, value = line.partition(":")
+                headers[key.strip().lower()] = value.strip()
+        except BaseException:
+            conn[1].close()
+            if not stream:
+                self._slots.release()
+            raise
+
+        response = _Response(self._close if stream else self._release, conn, status, headers)
+        if status >= 400:
+            message = await response.read()
+            try:
+                message = json.loads(message)["message"]
+            except (ValueError, KeyError, TypeError):
+                message = message.decode(errors="replace")
+            raise DockerAPIError(status, message)
+        return response
+
+    async def call(self, method: str, path: str, params: dict = None, body=None):
+        response = await self.request(method, path, params, body)
+        return await response.json()
+
+    async def create_container(self, config: dict, name: str = None) -> str:
+        params = {"name": name} if name else None
+        return (await self.call("POST", "/containers/create", params, config))["Id"]
+
+    async def start_container(self, container_id: str):
+        await self.call("POST", f"/containers/{container_id}/start")
+
+    async def inspect_container(self, container_id: str) -> dict:
+        return await self.call("GET", f"/containers/{container_id}/json")
+
+    async def remove_container(self, container_id: str, force: bool = True):
+        await self.call("DELETE", f"/containers/{container_id}", {"force": "1" if force else "0"})
+
+    async def commit_container(self, container_id: str, repository: str, tag: str) -> str:
+        params = {"container": container_id, "repo": repository, "tag": tag}
+        return (await self.call("POST", "/commit", params))["Id"]
+
+    async def remove_image(self, image: str, force: bool = True):
+        await self.call("DELETE", f"/images/{image}", {"force": "1" if force else "0"})
+
+    async def stream_logs(self, container_id: str):
+        """Yields (stream, data) frames of a container's output as it is written."""
+        response = await self.request(
+            "GET", f"/containers/{container_id}/logs",
+            {"follow": "1", "stdout": "1", "stderr": "1"}, stream=True
+        )
+        buffer = b""
+        async for chunk in response.iter_body():
+            buffer += chunk
+            # Without a TTY, output is multiplexed: 1 byte stream, 3 padding,
+            # 4 bytes big-endian length, then the payload
+            while len(buffer) >= 8:
+                length = int.from_bytes(buffer[4:8], "big")
+                if len(buffer) < 8 + length:
+                    break
+                yield buffer[0], buffer[8:8 + length]
+                buffer = buffer[8 + length:]
+
+    async def _subscribe(self) -> _Response:
+        filters = json.dumps({"type": ["container"], "event": ["die"]})
+        return await self.request("GET", "/events", {"filters": filters}, stream=True)
+
+    async def _watch_events(self, response: _Response):
+        while True:
+            try:
+                if response is None:
+                    response = await self._subscribe()
+                    # Exits that happened while the stream was down
+                    for container_id in list(self._waiters):
+                        await self._check_exited(container_id)
+                buffer = b""
+                async for chunk in response.iter_body():
+                    buffer += chunk
+                    while b"\n" in buffer:
+                        line, buffer = buffer.split(b"\n", 1)
+                        if line.strip():
+                            self._on_event(json.loads(line))
+                self.logger.warning("Docker event stream ended, reconnecting")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.warning("Docker event stream failed: %s, reconnecting", e)
+                await asyncio.sleep(1)
+            response = None
+
+    def _on_event(self, event: dict):
+        actor = event.get("Actor", {})
+        container_id = actor.get("ID") or event.get("id")
+        future = self._waiters.pop(container_id, None)
+        if future is not None and not future.done():
+            future.set_result(int(actor.get("Attributes", {}).get("exitCode", -1)))
+
+    async def _check_exited(self, container_id: str):
+        try:
+            state = (await self.inspect_container(container_id))["State"]
+        except DockerAPIError:
+            return
+        if state["Status"] in ("exited", "dead"):
+            self._on_event({"Actor": {"ID": container_id, "Attributes": {"exitCode": str(state["ExitCode"])}}})
+
+    async def _ensure_events(self):
+        async with self._events_lock:
+            if self._events_task is None:
+                # Subscribe before the first container starts, so no exit is missed
+                response = await self._subscribe()
+                self._events_task = asyncio.ensure_future(self._watch_events(response))
+
+    async def container_memory(self, container_id: str) -> int:
+        stats = await self.call("GET", f"/containers/{container_id}/stats", {"stream": "0", "one-shot": "1"})
+        memory = stats.get("memory_stats", {})
+        return max(memory.get("max_usage", 0), memory.get("usage", 0))
+
+    async def _track_memory(self, container_id: str, state: dict, interval: float):
+        while True:
+            try:
+                state["PeakMemory"] = max(state["PeakMemory"], await self.container_memory(container_id))
+            except (DockerAPIError, ConnectionError):
+                pass
+            await asyncio.sleep(interval)
+
+    async def run_container(self, config: dict, name: str = None, log_path: str = None, on_exit=None, memory_interval: float = None) -> dict:
+        """Runs a container detached and waits for it to exit.
+
+        Output is appended to `log_path` while the container runs. Returns
+        the final `State` of the container, which is removed afterwards.
+        `on_exit(container_id, state)` is awaited before the removal, e.g.
+        to commit the container as an image. With `memory_interval`, memory
+        usage is sampled that often and its maximum is added to the state as
+        `PeakMemory`.
+        """
+        await self._ensure_events()
+        container_id = await self.create_container(config, name)
+        try:
+            exited = asyncio.get_running_loop().create_future()
+            self._waiters[container_id] = exited
+            await self.start_container(container_id)
+            log_task = None
+            if log_path is not None:
+                log_task = asyncio.ensure_future(self._save_logs(container_id, log_path))
+            memory = {"PeakMemory": 0}
+            memory_task = None
+            if memory_interval is not None:
+                memory_task = asyncio.ensure_future(self._track_memory(container_id, memory, memory_interval))
+            try:
+                await exited
+            finally:
+                if memory_task is not None:
+                    memory_task.cancel()
+            if log_task is not None:
+                # The log stream ends on its own once the output is drained
+                await asyncio.wait([log_task], timeout=LOG_DRAIN_TIMEOUT)
+                log_task.cancel()
+            state = (await self.inspect_container(container_id))["State"]
+            if memory_task is not None:
+                state.update(memory)
+            if on_exit is not None:
+                await on_exit(container_id, state)
+            return state
+        finally:
+            self._waiters.pop(container_id, None)
+            try:
+                await asyncio.shield(self.remove_container(container_id))
+            except DockerAPIError as e:
+                self.logger.warning("Failed to remove container %s: %s", container_id, e)
+
+    async def _save_logs(self, container_id: str, log_path: str):
+        try:
+            with open(log_path, "ab") as f:
+                async for _, data in self.stream_logs(container_id):
+                    f.write(data)
+                    f.flush()
+        except Exception as e:
+            self.logger.warning("Log stream of %s failed: %s", container_id, e)
+
+    async def close(self):
+        if self._events_task is not None:
+            self._events_task.cancel()
+            try:
+                await self._events_task
+            except asyncio.CancelledError:
+                pass
+            self._events_task = None
+        while self._idle:
+            self._idle.pop()[1].close()
+
+
+def container_config(spec: dict) -> dict:
+    """Translates docker-py `containers.run` keyword arguments to an API body."""
+    config = {
+        "Image": spec["image"],
+        "Cmd": spec["command"],
+        "Env": [f"{key}={value}" for key, value in spec.get("environment", {}).items()],
+        "HostConfig": {
+            "Binds": [f"{src}:{bind['bind']}:{bind['mode']}" for src, bind in spec.get("volumes", {}).items()],
+        },
+    }
+    if "tmpfs" in spec:
+        config["HostConfig"]["Tmpfs"] = spec["tmpfs"]
+    for key, name in (("cpu_shares", "CpuShares"), ("mem_limit", "Memory"), ("memswap_limit", "MemorySwap"), ("pids_limit", "PidsLimit")):
+        if spec.get(key) is not None:
+            config["HostConfig"][name] = spec[key]
+    return config
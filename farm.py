@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import atexit
+import http.server
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+from compile_project import CompileProject, clean_container, compile_packages_parallel, compile_packages_async, default_limits, parse_size, CPU_SHARES, PIDS_LIMIT
+from trash import Trash
+
+DEFAULT_PORT = 8642
+LEASE_TIMEOUT = 60
+HEARTBEAT_INTERVAL = 10
+# How long a worker keeps retrying while the coordinator is unreachable
+RECONNECT_TIMEOUT = 300
+# Answered by a proxy in front of a coordinator that is down or restarting,
+# any other error would only come again
+RETRY_CODES = (502, 503, 504)
+
+
+class Coordinator:
+    """Hands out the jobs of one project to workers on any number of hosts.
+
+    The coordinator is the only process that opens the job table. Workers
+    claim jobs over HTTP and hold a lease on each of them, which they renew
+    with heartbeats. A job whose lease runs out, because its worker crashed
+    or lost the network, goes back to NOT_STARTED on its own, so nothing has
+    to be consolidated after a crash. A result reported for a lost lease is
+    dropped, the job has been handed to someone else by then.
+
+    Routes, all JSON:
+        POST /claim     {worker_id, num_packages} -> {packages, leased, lease_timeout}
+        POST /heartbeat {worker_id, package_ids}  -> {held}
+        POST /finish    {worker_id, package_id, status, wall_time, peak_memory, output_size, failure} -> {accepted}
+        GET  /status    -> {status: count}
+    """
+
+    def __init__(self, project: CompileProject, host: str = "0.0.0.0", port: int = DEFAULT_PORT, lease_timeout: float = LEASE_TIMEOUT):
+        self.project = project
+        self.db = project.db
+        self.lease_timeout = lease_timeout
+        self.logger = logging.getLogger("Coordinator")
+        self.server = http.server.ThreadingHTTPServer((host, port), _CoordinatorHandler)
+        self.server.daemon_threads = True
+        self.server.coordinator = self
+        self._stopped = threading.Event()
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def claim(self, worker_id: str, num_packages: int) -> dict:
+        with self.db.transaction():
+            packages = self.project.get_packages_not_started(num_packages, worker_id=worker_id)
+            self.db.executemany(
+                "UPDATE packages SET lease_expires = ? WHERE id = ?",
+                ((time.time() + self.lease_timeout, package["package_id"]) for package in packages)
+            )
+            # Leases held elsewhere may still expire and come back
+            leased = self.db.execute(
+                "SELECT count(*) FROM packages WHERE status = 'STARTED' AND worker_id != ?",
+                (worker_id,)
+            )[0][0]
+        if len(packages) > 0:
+            self.logger.info("Leased %d jobs to %s", len(packages), worker_id)
+        return {"packages": packages, "leased": leased, "lease_timeout": self.lease_timeout}
+
+    def heartbeat(self, worker_id: str, package_ids: list) -> dict:
+        with self.db.transaction():
+            self.db.executemany(
+                "UPDATE packages SET lease_expires = ? WHERE id = ? AND worker_id = ? AND status = 'STARTED'",
+                ((time.time() + self.lease_timeout, package_id, worker_id) for package_id in package_ids)
+            )
+            held = self.db.execute(
+                "SELECT id FROM packages WHERE status = 'STARTED' AND worker_id = ?",
+                (worker_id,)
+            )
+        return {"held": [package_id for package_id, in held]}
+
+    def finish(self, worker_id: str, package_id: int, status: str, wall_time: float, peak_memory: int, output_size: int, failure: str = None) -> dict:
+        with self.db.transaction():
+            res = self.db.execute("SELECT worker_id, status FROM packages WHERE id = ?", (package_id,))
+            if len(res) == 0 or tuple(res[0]) != (worker_id, "STARTED"):
+                self.logger.warning("Dropping result of job %d from %s, its lease is gone", package_id, worker_id)
+                return {"accepted": False}
+            self.project.record_result(package_id, status, wall_time, peak_memory, output_size, failure)
+            self.db.execute("UPDATE packages SET lease_expires = NULL WHERE id = ?", (package_id,))
+        return {"accepted": True}
+
+    def status(self) -> dict:
+        return dict(self.db.execute("SELECT status, count(*) FROM packages GROUP BY status"))
+
+    def expire(self) -> int:
+        """Puts jobs whose lease ran out back to NOT_STARTED."""
+        res = self.db.execute(
+            "UPDATE packages SET status = 'NOT_STARTED', worker_id = NULL, claimed_at = NULL, lease_expires = NULL "
+            "WHERE status = 'STARTED' AND lease_expires < ? RETURNING id",
+            (time.time(),)
+        )
+        if len(res) > 0:
+            self.logger.warning("Leases of %d jobs expired, jobs restored", len(res))
+        return len(res)
+
+    def _reap(self):
+        while not self._stopped.wait(self.lease_timeout / 4):
+            try:
+                self.expire()
+            except Exception:
+                self.logger.exception("Error expiring leases")
+
+    def start(self):
+        # Jobs left STARTED by a crashed run: workers that survived get one
+        # lease period to reclaim them with a heartbeat, the rest expire
+        self.db.execute(
+            "UPDATE packages SET lease_expires = ? WHERE status = 'STARTED'",
+            (time.time() + self.lease_timeout,)
+        )
+        threading.Thread(target=self._reap, name="LeaseReaper", daemon=True).start()
+        threading.Thread(target=self.server.serve_forever, name="Coordinator", daemon=True).start()
+        self.logger.info("Coordinator listening on %s:%d", *self.address[:2])
+
+    def stop(self):
+        self._stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _CoordinatorHandler(http.server.BaseHTTPRequestHandler):
+    def _respond(self, code: int, body):
+        payload = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        coordinator = self.server.coordinator
+        routes = {
+            "/claim": coordinator.claim,
+            "/heartbeat": coordinator.heartbeat,
+            "/finish": coordinator.finish
+        }
+        if self.path not in routes:
+            self._respond(404, {"message": f"Unknown route {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            res = routes[self.path](**body)
+        except (ValueError, TypeError) as e:
+            self._respond(400, {"message": str(e)})
+            return
+        except Exception as e:
+            coordinator.logger.exception("Error handling %s", self.path)
+            self._respond(500, {"message": str(e)})
+            return
+        self._respond(200, res)
+
+    def do_GET(self):
+        if self.path != "/status":
+            self._respond(404, {"message": f"Unknown route {self.path}"})
+            return
+        self._respond(200, self.server.coordinator.status())
+
+    def log_message(self, format, *args):
+        self.server.coordinator.logger.debug(format, *args)
+
+    def finish(self):
+        # Every request runs on a thread of its own, which would otherwise
+        # leave its database connection open until the coordinator stops
+        try:
+            super().finish()
+        finally:
+            self.server.coordinator.db.release()
+
+
+class FarmClient:
+    """Calls a Coordinator, retrying while it is unreachable (e.g. restarting)."""
+
+    def __init__(self, url: str, worker_id: str, timeout: float = RECONNECT_TIMEOUT):
+        self.url = url.rstrip("/")
+        self.worker_id = worker_id
+        self.timeout = timeout
+        self.logger = logging.getLogger("FarmClient")
+
+    def call(self, path: str, body: dict = None):
+        data = json.dumps(body).encode() if body is not None else None
+        deadline = time.monotonic() + self.timeout
+        tried = 0
+        while True:
+            request = urllib.request.Request(self.url + path, data=data, headers={"Content-Type": "application/json"})
+            try:
+                with urllib.request.urlopen(request, timeout=HEARTBEAT_INTERVAL * 3) as response:
+                    return json.loads(response.read())
+            except urllib.error.HTTPError as e:
+                message = e.read().decode(errors="replace")
+                if e.code not in RETRY_CODES:
+                    raise Exception(f"Coordinator rejected {path}: {e.code} {message}")
+                error = f"{e.code} {message}"
+            except (urllib.error.URLError, ConnectionError, socket.timeout) as e:
+                error = e
+            tried += 1
+            if time.monotonic() >= deadline:
+                self.logger.error("Coordinator unreachable: %s", error)
+                raise Exception(f"Coordinator unreachable: {error}")
+            self.logger.warning("Error calling coordinator: %s, retrying %d", error, tried)
+            time.sleep(min(HEARTBEAT_INTERVAL, 0.1 * 2 ** tried))
+
+    def claim(self, num_packages: int) -> dict:
+        return self.call("/claim", {"worker_id": self.worker_id, "num_packages": num_packages})
+
+    def heartbeat(self, package_ids: list) -> list:
+        return self.call("/heartbeat", {"worker_id": self.worker_id, "package_ids": package_ids})["held"]
+
+    def finish(self, package_id: int, status: str, wall_time: float, peak_memory: int, output_size: int, failure: str = None) -> bool:
+        return self.call("/finish", {
+            "worker_id": self.worker_id,
+            "package_id": package_id,
+            "status": status,
+            "wall_time": wall_time,
+            "peak_memory": peak_memory,
+            "output_size": output_size,
+            "failure": failure
+        })["accepted"]
+
+    def status(self) -> dict:
+        return self.call("/status")
+
+
+class RemoteProject(CompileProject):
+    """A CompileProject whose jobs are leased from a Coordinator.
+
+    Builds run and write their output under the local `project_root` just
+    like in a local project, only claims and results go to the coordinator.
+    Shared dependency layers, the source cache and the artifact store are
+    not available, they keep their state in the local job table.
+    """
+
+    def __init__(self, project_root, coordinator_url, heartbeat_interval=HEARTBEAT_INTERVAL):
+        self.project_root = project_root
+        self.packages_root = os.path.join(project_root, "packages")
+        self.logger = logging.getLogger("RemoteProject")
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.db = None
+        self.limits = default_limits()
+        self.trash = Trash(os.path.join(project_root, ".trash"))
+        self.dep_layers = None
+        self.source_cache = None
+        self.artifact_store = None
+        self.pack = False
+        self.client = FarmClient(coordinator_url, self.worker_id)
+        self.heartbeat_interval = heartbeat_interval
+        self.held = set()
+        self._held_lock = threading.Lock()
+        self._stopped = threading.Event()
+        os.makedirs(self.packages_root, exist_ok=True)
+
+    def set_package_status(self, package_id, status):
+        # Leased jobs are STARTED already, final statuses go through finish_package
+        if status != "STARTED":
+            self.logger.error("Invalid status for a leased job: %s", status)
+            raise Exception("Invalid status")
+
+    def get_packages_not_started(self, num_packages, set_started=True, worker_id=None):
+        while True:
+            res = self.client.claim(num_packages)
+            if len(res["packages"]) > 0 or res["leased"] == 0:
+                break
+            # Nothing to claim, but jobs leased by other workers may come back
+            time.sleep(self.heartbeat_interval)
+        with self._held_lock:
+            self.held.update(package["package_id"] for package in res["packages"])
+        return res["packages"]
+
+    def compile_package(self, package_id, package_name, optimization_level, dirname, retry, in_memory):
+        # Left behind when an earlier lease of this job expired here
+        self.trash.discard(os.path.join(self.packages_root, dirname))
+        return super(RemoteProject, self).compile_package(package_id, package_name, optimization_level, dirname, retry, in_memory)
+
+    async def compile_package_async(self, client, package_id, package_name, optimization_level, dirname, retry, in_memory):
+        self.trash.discard(os.path.join(self.packages_root, dirname))
+        return await super(RemoteProject, self).compile_package_async(client, package_id, package_name, optimization_level, dirname, retry, in_memory)
+
+    def finish_package(self, package_id, status, wall_time, peak_memory, dirname, failure=None):
+        output_size = self.output_size(dirname)
+        try:
+            if not self.client.finish(package_id, status, wall_time, peak_memory, output_size, failure):
+                self.logger.warning("Lease of job %d was lost, result dropped by the coordinator", package_id)
+        finally:
+            with self._held_lock:
+                self.held.discard(package_id)
+
+    def _heartbeat(self):
+        while not self._stopped.wait(self.heartbeat_interval):
+            with self._held_lock:
+                package_ids = list(self.held)
+            try:
+                held = set(self.client.heartbeat(package_ids))
+            except Exception as e:
+                self.logger.error("Heartbeat failed: %s", e)
+                continue
+            with self._held_lock:
+                lost = (set(package_ids) & self.held) - held
+            for package_id in lost:
+                self.logger.warning("Lease of job %d lost", package_id)
+
+    def start(self):
+        threading.Thread(target=self._heartbeat, name="Heartbeat", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run one project on many hosts: one coordinator, any number of workers")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve = subparsers.add_parser("serve", help="Own the job table and lease jobs to workers")
+    serve.add_argument("-p", "--project", type=str, required=True, help="Project path")
+    serve.add_argument("-l", "--list", type=str, help="List of packages to compile, must be a json file, required for a new project")
+    serve.add_argument("-H", "--history", type=str, help="Database of an earlier project whose job costs order this one longest first")
+    serve.add_argument("--listen", type=str, default=f"0.0.0.0:{DEFAULT_PORT}", help="Address to listen on, host:port")
+    serve.add_argument("--lease-timeout", type=float, default=LEASE_TIMEOUT, help="Seconds without a heartbeat before a job goes back to NOT_STARTED")
+
+    work = subparsers.add_parser("work", help="Run jobs leased from a coordinator")
+    work.add_argument("-c", "--coordinator", type=str, required=True, help=f"Coordinator URL, e.g. http://host:{DEFAULT_PORT}")
+    work.add_argument("-p", "--project", type=str, required=True, help="Local path where build outputs are written")
+    work.add_argument("-r", "--retry", type=int, default=3, help="Retry times when 'compile_error' occurs")
+    work.add_argument("-j", "--parallel", type=int, default=1, help="Max parallel jobs")
+    work.add_argument("-M", "--in-memory", action="store_true", help="Determines whether to use ramdisk to accelerate compilation")
+    work.add_argument("-B", "--backend", choices=("thread", "async"), default="thread", help="Run each job in its own thread, or drive all containers from one asyncio event loop")
+    work.add_argument("-P", "--pack", action="store_true", help="Pack the output of each finished job into one compressed archive with an index")
+    work.add_argument("-s", "--slow-start", action="store_true", help="Start with one job and ramp up as load allows")
+    work.add_argument("--memory-limit", type=str, help="Memory limit of each compile container, e.g. 16g (default: half of the host memory)")
+    work.add_argument("--cpu-shares", type=int, default=CPU_SHARES, help="Relative CPU weight of each compile container")
+    work.add_argument("--pids-limit", type=int, default=PIDS_LIMIT, help="Maximum number of processes in each compile container")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "serve":
+        package_list = None
+        if args.list:
+            with open(args.list, "r") as f:
+                package_list = json.load(f)
+        project = CompileProject(args.project, package_list)
+        if args.history:
+            project.load_history(args.history)
+        project.update_priorities()
+        host, _, port = args.listen.rpartition(":")
+        coordinator = Coordinator(project, host or "0.0.0.0", int(port), args.lease_timeout)
+        coordinator.start()
+        try:
+            while True:
+                time.sleep(HEARTBEAT_INTERVAL * 6)
+                coordinator.logger.info("Jobs: %s", coordinator.status())
+        except KeyboardInterrupt:
+            coordinator.stop()
+    else:
+        atexit.register(clean_container)
+        project = RemoteProject(args.project, args.coordinator)
+        project.pack = args.pack
+        project.limits["cpu_shares"] = args.cpu_shares
+        project.limits["pids_limit"] = args.pids_limit
+        if args.memory_limit:
+            project.limits["mem_limit"] = parse_size(args.memory_limit)
+        project.start()
+        try:
+            if args.backend == "async":
+                asyncio.run(compile_packages_async(project, args.retry, args.parallel, args.in_memory))
+            else:
+                compile_packages_parallel(project, args.retry, args.parallel, args.in_memory, args.slow_start)
+        finally:
+            project.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import logging
+import os
+import sqlite3
+
+CACHE_NAME = "file_cache.sqlite3"
+# Bumped whenever files are classified differently, older records are dropped
+VERSION = 3
+
+
+class FileCache:
+    """Side-car cache of what is known about the files of a project's jobs.
+
+    Maps a path, relative to the project, to its SHA-256, descriptions and
+    node type (see classifier.py, None if the file is of no interest). A
+    record is only returned while the file's (size, mtime, inode), see
+    `stat` of job_archive, is unchanged, so a rebuilt or repacked job is
+    looked at again. Several processes may use
+    the cache at once; new records are written in one transaction on
+    `commit`.
+    """
+
+    def __init__(self, project_root: str):
+        self.path = os.path.join(project_root, CACHE_NAME)
+        self.logger = logging.getLogger("FileCache")
+        self.conn = sqlite3.connect(self.path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] != VERSION:
+            with self.conn:
+                self.conn.execute("DROP TABLE IF EXISTS files")
+                self.conn.execute(f"PRAGMA user_version = {VERSION}")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime INTEGER,
+                inode INTEGER,
+                sha256 TEXT,
+                magic_info TEXT,
+                description TEXT,
+                node_type TEXT,
+                language TEXT
+            ) WITHOUT ROWID
+        """)
+        self.conn.commit()
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path: str, stat: tuple) -> dict:
+        """Returns the record of `path`, or None if it is unknown or has changed."""
+        record = self.pending.get(path)
+        if record is None:
+            row = self.conn.execute(
+                "SELECT size, mtime, inode, sha256, magic_info, description, node_type, language FROM files WHERE path = ?",
+                (path,)
+            ).fetchone()
+            if row is not None:
+                record = dict(zip(("size", "mtime", "inode", "hash", "magic_info", "description", "node_type", "language"), row))
+        if record is None or (record["size"], record["mtime"], record["inode"]) != tuple(stat):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return record
+
+    def put(self, path: str, stat: tuple, hash: str, magic_info: str, description: str = None, node_type: str = None, language: str = None) -> dict:
+        size, mtime, inode = stat
+        self.pending[path] = {
+            "size": size,
+            "mtime": mtime,
+            "inode": inode,
+            "hash": hash,
+            "magic_info": magic_info,
+            "description": description,
+            "node_type": node_type,
+            "language": language
+        }
+        return self.pending[path]
+
+    def commit(self):
+        if len(self.pending) == 0:
+            return
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (path, r["size"], r["mtime"], r["inode"], r["hash"], r["magic_info"], r["description"], r["node_type"], r["language"])
+                    for path, r in self.pending.items()
+                ]
+            )
+        self.pending = {}
+
+    def close(self):
+        try:
+            self.commit()
+        except sqlite3.Error as e:
+            # Only a cache, the next run redoes the work
+            self.logger.warning("Failed to write %s: %s", self.path, e)
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
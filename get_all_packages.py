@@ -1,39 +1,212 @@
 #!/usr/bin/env python3
+"""Builds the package list of a project from the indices of a Debian mirror.
 
-# get content from url
-def get_url(url):
-    import urllib.request
-    return urllib.request.urlopen(url).read()
-
-# extract content of a gzip file string
-def extract_gzip(data):
-    import gzip
-    return gzip.decompress(data).decode('utf-8')
-
-def extract_line(line):
-    for idx in range(len(line)):
-        if line[idx] == '(':
-            left = idx
-        if line[idx] == ')':
-            right = idx
-            break
-    return line[:left].strip(), line[left + 1: right].strip(), line[right + 1: ].strip()
-
-def extract_package(data):
-    lines = data.split('\n')
-    packages = []
+Jobs are per source package, `apt source` builds every binary of a source
+at once. `Sources` indices are read as a stream, one stanza at a time, and
+so are `Packages` indices if given, which map binaries built from another
+version (binNMUs) or missing from the Binary field. Given a list of binary
+names, each is mapped to its source and every source becomes one job. The
+list carries the version and the size of the source files, which
+compile_project.py stores in the job table to schedule large sources first.
+"""
+import argparse
+import bz2
+import gzip
+import itertools
+import json
+import logging
+import lzma
+import re
+
+
+def open_index(path):
+    """Opens an index as text, compressed or not."""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    elif path.endswith(".xz"):
+        return lzma.open(path, "rt", encoding="utf-8", errors="replace")
+    elif path.endswith(".bz2"):
+        return bz2.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, "r", encoding="utf-8", errors="replace")
+
+
+def iter_stanzas(lines):
+    """Yields the stanzas of a deb822 file as dicts, continuation lines joined with newlines."""
+    stanza = {}
+    field = None
     for line in lines:
-        if '(' in line and ')' in line:
-            package, version, description = extract_line(line)
-            packages.append({'package': package, 'version': version, 'description': description})
-    return packages
+        line = line.rstrip("\n")
+        if line.strip() == "":
+            if stanza:
+                yield stanza
+            stanza = {}
+            field = None
+        elif line[0] in " \t":
+            if field is not None:
+                stanza[field] += "\n" + line.strip()
+        elif ":" in line:
+            field, value = line.split(":", 1)
+            stanza[field] = value.strip()
+    if stanza:
+        yield stanza
+
+
+def _order(c):
+    if c == "~":
+        return -1
+    if c.isalpha():
+        return ord(c)
+    return ord(c) + 256
+
+
+def _compare_lexical(a, b):
+    a = [_order(c) for c in a]
+    b = [_order(c) for c in b]
+    # The end of a string sorts before anything but '~'
+    a += [0] * (len(b) - len(a))
+    b += [0] * (len(a) - len(b))
+    return (a > b) - (a < b)
+
+
+def _compare_fragment(a, b):
+    for (a_lex, a_num), (b_lex, b_num) in itertools.zip_longest(
+        re.findall(r"(\D*)(\d*)", a), re.findall(r"(\D*)(\d*)", b), fillvalue=("", "")
+    ):
+        res = _compare_lexical(a_lex, b_lex)
+        if res == 0:
+            res = (int(a_num or 0) > int(b_num or 0)) - (int(a_num or 0) < int(b_num or 0))
+        if res != 0:
+            return res
+    return 0
+
+
+def _split_version(version):
+    epoch, upstream = version.split(":", 1) if ":" in version else ("0", version)
+    upstream, _, revision = upstream.rpartition("-") if "-" in upstream else (upstream, "", "")
+    return int(epoch or 0), upstream, revision
+
+
+def compare_versions(a, b):
+    """Compares two Debian versions like dpkg, returns -1, 0 or 1."""
+    a_epoch, a_upstream, a_revision = _split_version(a)
+    b_epoch, b_upstream, b_revision = _split_version(b)
+    if a_epoch != b_epoch:
+        return (a_epoch > b_epoch) - (a_epoch < b_epoch)
+    return _compare_fragment(a_upstream, b_upstream) or _compare_fragment(a_revision, b_revision)
+
+
+def read_sources(path):
+    """Yields {package, version, size, binaries, architecture, package_list} of each stanza of a Sources index.
+
+    `package_list` maps binaries to their architectures, from the
+    Package-List field where there is one.
+    """
+    with open_index(path) as f:
+        for stanza in iter_stanzas(f):
+            # "<checksum> <size> <name>" per line, the first line is empty
+            files = stanza.get("Files") or stanza.get("Checksums-Sha256", "")
+            size = sum(int(line.split()[1]) for line in files.split("\n") if len(line.split()) == 3)
+            # "<name> <type> <section> <priority> arch=<arch,...>" per line
+            package_list = {}
+            for line in stanza.get("Package-List", "").split("\n"):
+                fields = line.split()
+                arch = [field[5:] for field in fields if field.startswith("arch=")]
+                if len(fields) >= 4 and len(arch) > 0:
+                    package_list[fields[0]] = arch[0]
+            yield {
+                "package": stanza["Package"],
+                "version": stanza.get("Version"),
+                "size": size,
+                "binaries": [name.strip() for name in stanza.get("Binary", "").replace("\n", " ").split(",") if name.strip()],
+                "architecture": stanza.get("Architecture", ""),
+                "package_list": package_list
+            }
+
+
+def read_packages(path):
+    """Yields (binary, source) of each stanza of a Packages index."""
+    with open_index(path) as f:
+        for stanza in iter_stanzas(f):
+            # "Source: name (version)" for binNMUs, missing if named alike
+            source = stanza.get("Source", stanza["Package"]).split(" ")[0]
+            yield stanza["Package"], source
+
+
+def load_sources(sources_paths, packages_paths=()):
+    """Returns the newest stanza of every source and a map of binary names to sources."""
+    logger = logging.getLogger("PackageIndex")
+    sources = {}
+    for path in sources_paths:
+        for source in read_sources(path):
+            known = sources.get(source["package"])
+            if known is None or compare_versions(source["version"], known["version"]) > 0:
+                sources[source["package"]] = source
+    binaries = {}
+    for source in sources.values():
+        for binary in source["binaries"]:
+            binaries[binary] = source["package"]
+    for path in packages_paths:
+        for binary, source in read_packages(path):
+            if source in sources:
+                binaries[binary] = source
+    logger.info("%d sources building %d binaries", len(sources), len(binaries))
+    return sources, binaries
+
+
+def source_jobs(sources, binaries, wanted=None):
+    """Returns the package list of the sources building `wanted`, every source once.
+
+    Without `wanted`, every source is in the list. Names found neither
+    as binaries nor as sources are logged and left out.
+    """
+    logger = logging.getLogger("PackageIndex")
+    if wanted is None:
+        names = list(sources)
+    else:
+        names = []
+        for name in wanted:
+            # Lists made by earlier versions of this script hold dicts
+            name = name["package"] if isinstance(name, dict) else name
+            source = binaries.get(name, name if name in sources else None)
+            if source is None:
+                logger.warning("No source package builds %s", name)
+                continue
+            names.append(source)
+    res = []
+    seen = set()
+    for name in names:
+        if name in seen:
+            continue
+        seen.add(name)
+        source = sources[name]
+        res.append({
+            "package": source["package"],
+            "version": source["version"],
+            "size": source["size"],
+            "binaries": source["binaries"]
+        })
+    if wanted is not None:
+        logger.info("%d packages map to %d sources", len(wanted), len(res))
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create the package list of a project from Sources/Packages indices of a mirror")
+    parser.add_argument("output", type=str, help="Package list to write, a json file")
+    parser.add_argument("-s", "--sources", type=str, action="append", required=True, help="Sources index, e.g. dists/focal/main/source/Sources.gz (repeatable)")
+    parser.add_argument("-b", "--packages", type=str, action="append", default=[], help="Packages index, e.g. dists/focal/main/binary-amd64/Packages.gz (repeatable)")
+    parser.add_argument("-l", "--list", type=str, help="Json list of binary package names to build, e.g. package_list/all_packages.json (default: every source)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    wanted = None
+    if args.list:
+        with open(args.list, "r") as f:
+            wanted = json.load(f)
+    sources, binaries = load_sources(args.sources, args.packages)
+    packages = source_jobs(sources, binaries, wanted)
+    with open(args.output, "w") as f:
+        json.dump(packages, f, indent=4)
 
 
 if __name__ == '__main__':
-    data = get_url("https://packages.ubuntu.com/focal/allpackages?format=txt.gz")
-    data = extract_gzip(data)
-    packages = extract_package(data)
-    import json
-    import sys
-    with open(sys.argv[1], 'w') as f:
-        json.dump(packages, f)
+    main()
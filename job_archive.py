@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+"""Packed job outputs: one compressed archive per job with a footer index.
+
+Layout of `<dirname>.gdpack`:
+
+    header   magic "GDPK", format version, codec (1 byte each after magic)
+    blobs    every distinct file content, compressed on its own
+    index    compressed JSON: directories, and for each file its blob
+             offset/length, size, mode, mtime and SHA-256
+    trailer  index offset, index length (little-endian u64), magic
+
+Files are compressed one by one, so any of them is read with a single
+pread without unpacking the rest; identical files within a job share
+one blob. zstd is used when the `zstandard` module is installed,
+zlib otherwise.
+"""
+import argparse
+import concurrent.futures
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from project_db import ProjectDB
+
+SUFFIX = ".gdpack"
+MAGIC = b"GDPK"
+VERSION = 1
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+ZSTD_LEVEL = 10
+ZLIB_LEVEL = 6
+# Like the kernel's limit on symlinks followed in one path lookup
+MAX_LINKS = 40
+HEADER = struct.Struct("<4sBB")
+TRAILER = struct.Struct("<QQ4s")
+
+
+def _compressor(codec: int):
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress
+    return lambda data: zlib.compress(data, ZLIB_LEVEL)
+
+
+def _decompressor(codec: int):
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise Exception("Archive is zstd-compressed, but the zstandard module is not installed")
+        return zstandard.ZstdDecompressor().decompress
+    elif codec == CODEC_ZLIB:
+        return zlib.decompress
+    raise Exception(f"Unknown archive codec: {codec}")
+
+
+def _key(name: str) -> str:
+    name = os.path.normpath(name)
+    return "" if name == "." else name
+
+
+def pack(src: str, dst: str, codec: int = None) -> dict:
+    """Packs the directory `src` into the archive `dst`, written atomically.
+
+    Symlinks, to files or directories, are stored as links. FIFOs, sockets
+    and devices cannot be stored; they are returned in `skipped`, and
+    `verify` refuses such an archive as a replacement for `src`.
+    """
+    codec = codec or (CODEC_ZSTD if zstandard is not None else CODEC_ZLIB)
+    compress = _compressor(codec)
+    logger = logging.getLogger("JobArchive")
+    dirs = []
+    entries = {}
+    blobs = {}
+    skipped = []
+    size = 0
+    tmp = f"{dst}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, codec))
+            for root, dirnames, filenames in os.walk(src):
+                dirnames.sort()
+                rel_root = os.path.relpath(root, src)
+                if rel_root != ".":
+                    dirs.append(rel_root)
+                for dir_name in dirnames:
+                    path = os.path.join(root, dir_name)
+                    if os.path.islink(path):
+                        # Listed as a directory, but never walked into
+                        entries[os.path.normpath(os.path.join(rel_root, dir_name))] = {"link": os.readlink(path), "dir": True}
+                for file_name in sorted(filenames):
+                    path = os.path.join(root, file_name)
+                    name = os.path.normpath(os.path.join(rel_root, file_name))
+                    st = os.lstat(path)
+                    if stat.S_ISLNK(st.st_mode):
+                        entries[name] = {"link": os.readlink(path)}
+                        continue
+                    if not stat.S_ISREG(st.st_mode):
+                        logger.warning("Cannot pack %s, not a regular file", path)
+                        skipped.append(name)
+                        continue
+                    with open(path, "rb") as g:
+                        data = g.read()
+                    digest = hashlib.sha256(data).hexdigest()
+                    if digest not in blobs:
+                        packed = compress(data)
+                        blobs[digest] = (f.tell(), len(packed))
+                        f.write(packed)
+                    offset, length = blobs[digest]
+                    entries[name] = {
+                        "offset": offset,
+                        "length": length,
+                        "size": len(data),
+                        "mode": stat.S_IMODE(st.st_mode),
+                        "mtime": st.st_mtime,
+                        "sha256": digest
+                    }
+                    size += len(data)
+            index = compress(json.dumps({"dirs": dirs, "entries": entries}).encode())
+            offset = f.tell()
+            f.write(index)
+            f.write(TRAILER.pack(offset, len(index), MAGIC))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return {"files": len(entries), "bytes": size, "packed_bytes": os.path.getsize(dst), "skipped": skipped}
+
+
+def _describe(path: str, st: os.stat_result) -> tuple:
+    if stat.S_ISLNK(st.st_mode):
+        return "link", os.readlink(path)
+    elif stat.S_ISDIR(st.st_mode):
+        return "dir", None
+    elif stat.S_ISREG(st.st_mode):
+        return "file", st.st_size
+    return "special", None
+
+
+def verify(src: str, archive_path: str):
+    """Raises unless the archive holds every entry of the directory `src`.
+
+    The directory is walked again, independently of `pack`, and every
+    entry found by lstat is compared with the archive: directories,
+    links and their targets, files and their sizes. Run before `src` is
+    deleted.
+    """
+    expected = {}
+    for root, dirnames, filenames in os.walk(src, followlinks=False):
+        rel_root = os.path.relpath(root, src)
+        for name in dirnames + filenames:
+            path = os.path.join(root, name)
+            expected[os.path.normpath(os.path.join(rel_root, name))] = _describe(path, os.lstat(path))
+    found = {}
+    with JobArchive(archive_path) as archive:
+        for name in archive.children:
+            if name != "":
+                found[name] = ("dir", None)
+        for name, entry in archive.entries.items():
+            found[name] = ("link", entry["link"]) if "link" in entry else ("file", entry["size"])
+    if found != expected:
+        missing = sorted(name for name in expected if found.get(name) != expected[name])
+        extra = sorted(name for name in found if name not in expected)
+        raise Exception(f"Archive of {src} does not match the directory: {len(missing)} entries missing or different "
+                        f"(e.g. {missing[:3]}), {len(extra)} unexpected (e.g. {extra[:3]})")
+
+
+class JobArchive:
+    """Read access to a packed job, with the paths of the unpacked directory.
+
+    Reads use pread on one shared descriptor and are safe from several
+    threads.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        try:
+            magic, version, codec = HEADER.unpack(os.pread(self.fd, HEADER.size, 0))
+            if magic != MAGIC or version != VERSION:
+                raise Exception(f"Not a job archive: {path}")
+            end = os.fstat(self.fd).st_size
+            offset, length, magic = TRAILER.unpack(os.pread(self.fd, TRAILER.size, end - TRAILER.size))
+            if magic != MAGIC:
+                raise Exception(f"Truncated job archive: {path}")
+            self._decompress = _decompressor(codec)
+            index = json.loads(self._decompress(os.pread(self.fd, length, offset)))
+        except BaseException:
+            os.close(self.fd)
+            raise
+        self.entries = index["entries"]
+        self.children = {"": []}
+        for name in index["dirs"]:
+            self.children[name] = []
+        for name in list(index["dirs"]) + list(self.entries):
+            self.children[os.path.dirname(name)].append(os.path.basename(name))
+
+    def names(self) -> list:
+        """Paths of all files, relative to the job directory."""
+        # Links to directories are directories to os.walk
+        return [name for name, entry in self.entries.items() if not entry.get("dir")]
+
+    def isdir(self, name: str) -> bool:
+        try:
+            return self._resolve(name) in self.children
+        except OSError:
+            return False
+
+    def exists(self, name: str) -> bool:
+        try:
+            name = self._resolve(name)
+        except OSError:
+            return False
+        return name in self.entries or name in self.children
+
+    def listdir(self, name: str = "") -> list:
+        resolved = self._resolve(name)
+        if resolved not in self.children:
+            raise FileNotFoundError(f"{self.path}: {name}")
+        return list(self.children[resolved])
+
+    def readlink(self, name: str) -> str:
+        """The target of a link, as stored."""
+        name = _key(name)
+        entry = self.entries.get(_key(os.path.join(self._resolve(os.path.dirname(name)), os.path.basename(name))))
+        if entry is None or "link" not in entry:
+            raise FileNotFoundError(f"{self.path}: {name} is not a link")
+        return entry["link"]
+
+    def _resolve(self, name: str) -> str:
+        """The path of `name` with the links in all of its components followed.
+
+        Links are followed as long as they stay inside the job, a limited
+        number of times so that a loop fails like it would on disk.
+        """
+        parts = _key(name).split(os.sep)[::-1]
+        resolved = ""
+        links = 0
+        while len(parts) > 0:
+            path = _key(os.path.join(resolved, parts.pop()))
+            entry = self.entries.get(path)
+            if entry is None or "link" not in entry:
+                resolved = path
+                continue
+            links += 1
+            if links > MAX_LINKS:
+                raise OSError(errno.ELOOP, f"Too many levels of symbolic links: {self.path}: {name}")
+            target = _key(os.path.join(resolved, entry["link"]))
+            if os.path.isabs(target) or target.split(os.sep)[0] == os.pardir:
+                # Outside the job, nothing there
+                return os.path.join(target, *parts[::-1])
+            parts += target.split(os.sep)[::-1]
+            resolved = ""
+        return resolved
+
+    def _entry(self, name: str) -> dict:
+        entry = self.entries.get(self._resolve(name))
+        if entry is None:
+            raise FileNotFoundError(f"{self.path}: {name}")
+        return entry
+
+    def read(self, name: str) -> bytes:
+        entry = self._entry(name)
+        return self._decompress(os.pread(self.fd, entry["length"], entry["offset"]))
+
+    def hash(self, name: str) -> str:
+        return self._entry(name)["sha256"]
+
+    def size(self, name: str) -> int:
+        return self._entry(name)["size"]
+
+    def stat(self, name: str) -> tuple:
+        """(size, mtime in ns, inode) of a file, the inode is the archive's."""
+        entry = self._entry(name)
+        return entry["size"], int(entry["mtime"] * 1e9), os.fstat(self.fd).st_ino
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class JobDirectory:
+    """The JobArchive interface over an unpacked job directory."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def names(self) -> list:
+        res = []
+        for root, dirs, files in os.walk(self.path):
+            res += [os.path.relpath(os.path.join(root, file_name), self.path) for file_name in files]
+        return res
+
+    def isdir(self, name: str) -> bool:
+        return os.path.isdir(os.path.join(self.path, name))
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(os.path.join(self.path, name))
+
+    def listdir(self, name: str = "") -> list:
+        return os.listdir(os.path.join(self.path, name))
+
+    def read(self, name: str) -> bytes:
+        with open(os.path.join(self.path, name), "rb") as f:
+            return f.read()
+
+    def hash(self, name: str) -> str:
+        sha256 = hashlib.sha256()
+        with open(os.path.join(self.path, name), "rb") as f:
+            while True:
+                data = f.read(65536)
+                if not data:
+                    break
+                sha256.update(data)
+        return sha256.hexdigest()
+
+    def size(self, name: str) -> int:
+        return os.path.getsize(os.path.join(self.path, name))
+
+    def stat(self, name: str) -> tuple:
+        st = os.stat(os.path.join(self.path, name))
+        return st.st_size, st.st_mtime_ns, st.st_ino
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_job(packages_root: str, dirname: str):
+    """Opens the output of a job, packed or not."""
+    archive_path = os.path.join(packages_root, dirname + SUFFIX)
+    if os.path.exists(archive_path):
+        return JobArchive(archive_path)
+    return JobDirectory(os.path.join(packages_root, dirname))
+
+
+def job_dirname(entry_name: str) -> str:
+    """Maps an entry of the packages directory to the dirname of its job."""
+    return entry_name[:-len(SUFFIX)] if entry_name.endswith(SUFFIX) else entry_name
+
+
+def unpack(src: str, dst: str) -> dict:
+    """Extracts the archive `src` into the directory `dst`."""
+    size = 0
+    with JobArchive(src) as archive:
+        os.makedirs(dst, exist_ok=True)
+        for name in archive.children:
+            os.makedirs(os.path.join(dst, name), exist_ok=True)
+        for name, entry in archive.entries.items():
+            path = os.path.join(dst, name)
+            if "link" in entry:
+                os.symlink(entry["link"], path)
+                continue
+            with open(path, "wb") as f:
+                f.write(archive.read(name))
+            os.chmod(path, entry["mode"])
+            os.utime(path, (entry["mtime"], entry["mtime"]))
+            size += entry["size"]
+        return {"files": len(archive.entries), "bytes": size, "packed_bytes": os.fstat(archive.fd).st_size}
+
+
+def _pack_job(packages_root: str, dirname: str) -> dict:
+    src = os.path.join(packages_root, dirname)
+    res = pack(src, src + SUFFIX)
+    try:
+        verify(src, src + SUFFIX)
+    except BaseException:
+        # open_job prefers the archive, which must not hide the directory
+        os.remove(src + SUFFIX)
+        raise
+    shutil.rmtree(src)
+    return res
+
+
+def _unpack_job(packages_root: str, dirname: str) -> dict:
+    src = os.path.join(packages_root, dirname + SUFFIX)
+    tmp = os.path.join(packages_root, f".unpack_{dirname}")
+    shutil.rmtree(tmp, ignore_errors=True)
+    res = unpack(src, tmp)
+    os.rename(tmp, os.path.join(packages_root, dirname))
+    os.remove(src)
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pack the job directories of an existing project into archives, or back")
+    parser.add_argument("command", choices=("pack", "unpack"))
+    parser.add_argument("-p", "--project", type=str, required=True, help="Project path")
+    parser.add_argument("-j", "--parallel", type=int, default=os.cpu_count(), help="Max parallel jobs")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger("JobArchive")
+
+    packages_root = os.path.join(args.project, "packages")
+    db = ProjectDB(os.path.join(args.project, "project_db.sqlite3"))
+    # Running jobs still write to their directories
+    finished = db.execute("SELECT dirname FROM packages WHERE status NOT IN ('NOT_STARTED', 'STARTED')")
+    db.close()
+    if args.command == "pack":
+        todo = [dirname for dirname, in finished if os.path.isdir(os.path.join(packages_root, dirname))]
+        func = _pack_job
+    else:
+        todo = [dirname for dirname, in finished if os.path.exists(os.path.join(packages_root, dirname + SUFFIX))]
+        func = _unpack_job
+    logger.info("%d jobs to %s", len(todo), args.command)
+
+    total = {"files": 0, "bytes": 0, "packed_bytes": 0}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.parallel) as executor:
+        futures = {executor.submit(func, packages_root, dirname): dirname for dirname in todo}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                res = future.result()
+            except Exception as e:
+                logger.error("Failed to %s %s: %s", args.command, futures[future], e)
+                continue
+            for key in total:
+                total[key] += res[key]
+    logger.info("%s: %d files, %d bytes, %d bytes packed", args.command, total["files"], total["bytes"], total["packed_bytes"])
+
+
+if __name__ == '__main__':
+    main()
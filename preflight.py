@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import logging
+import os
+import sqlite3
+
+from get_all_packages import load_sources
+from job_archive import SUFFIX, open_job
+from project_db import ProjectDB
+
+# Expected wall time of a job: its own recorded one, else the longest one
+# among its optimization levels, else the median of the project's jobs
+ESTIMATE = "coalesce(wall_time, (SELECT max(h.wall_time) FROM packages h WHERE h.package_name = packages.package_name), ?)"
+
+
+class Preflight:
+    """Sets jobs that cannot produce gcc output SKIPPED before they are scheduled.
+
+    A package is skipped when
+    - its source builds architecture-independent binaries only, by the
+      Architecture or Package-List field of a Sources index ("arch:all"),
+    - one of its optimization levels, in this project or an earlier one,
+      finished DONE without a single gcc task ("no gcc output"); the level
+      changes how gcc runs, not whether.
+    Build-Depends is not used: build-essential, gcc included, is installed
+    for every build whatever the source asks for. SKIPPED jobs are never
+    claimed; `reset` puts them back to NOT_STARTED.
+    """
+
+    def __init__(self, db: ProjectDB, packages_root: str):
+        self.db = db
+        self.packages_root = packages_root
+        self.logger = logging.getLogger("Preflight")
+
+    def count_gcc_tasks(self) -> int:
+        """Records the gcc tasks of DONE jobs whose output is on this host."""
+        res = self.db.execute("SELECT id, dirname FROM packages WHERE status = 'DONE' AND gcc_tasks IS NULL")
+        counts = []
+        for package_id, dirname in res:
+            path = os.path.join(self.packages_root, dirname)
+            if not os.path.exists(path) and not os.path.exists(path + SUFFIX):
+                # e.g. built by a farm worker on another host
+                continue
+            with open_job(self.packages_root, dirname) as job:
+                counts.append((len(job.listdir("gcc")) if job.isdir("gcc") else 0, package_id))
+        with self.db.transaction() as cursor:
+            cursor.executemany("UPDATE packages SET gcc_tasks = ? WHERE id = ?", counts)
+        return len(counts)
+
+    def metadata_reasons(self, sources_paths: list) -> dict:
+        sources, binaries = load_sources(sources_paths)
+        res = {}
+        for (package_name,) in self.db.execute("SELECT DISTINCT package_name FROM packages WHERE status = 'NOT_STARTED'"):
+            # Older package lists hold binary names
+            source = sources.get(binaries.get(package_name, package_name))
+            if source is None:
+                continue
+            if set(source["architecture"].split()) == {"all"}:
+                res[package_name] = "arch:all"
+            elif len(source["package_list"]) > 0 and set(source["package_list"].values()) == {"all"}:
+                res[package_name] = "arch:all"
+        return res
+
+    def history_reasons(self, history_db_path: str = None) -> dict:
+        query = "SELECT DISTINCT package_name FROM packages WHERE status = 'DONE' AND gcc_tasks = 0"
+        names = [name for name, in self.db.execute(query)]
+        if history_db_path is not None:
+            history = sqlite3.connect(history_db_path)
+            try:
+                columns = [column[1] for column in history.execute("PRAGMA table_info(packages)")]
+                if "gcc_tasks" in columns:
+                    names += [name for name, in history.execute(query)]
+                else:
+                    self.logger.warning("No gcc tasks recorded in %s", history_db_path)
+            finally:
+                history.close()
+        return dict.fromkeys(names, "no gcc output")
+
+    def run(self, sources_paths: list = (), history_db_path: str = None, dry_run: bool = False) -> dict:
+        """Skips what can be skipped, returns the jobs and expected seconds saved per reason."""
+        self.count_gcc_tasks()
+        reasons = {}
+        if len(sources_paths) > 0:
+            reasons.update(self.metadata_reasons(sources_paths))
+        reasons.update(self.history_reasons(history_db_path))
+        res = self.db.execute("SELECT wall_time FROM packages WHERE status = 'DONE' AND wall_time IS NOT NULL ORDER BY 1")
+        median = res[len(res) // 2][0] if len(res) > 0 else 0
+        report = collections.defaultdict(lambda: {"jobs": 0, "seconds": 0.0})
+        with self.db.transaction():
+            for package_name, reason in reasons.items():
+                jobs = self.db.execute(
+                    f"SELECT count(*), coalesce(sum({ESTIMATE}), 0) FROM packages WHERE status = 'NOT_STARTED' AND package_name = ?",
+                    (median, package_name)
+                )[0]
+                if jobs[0] == 0:
+                    continue
+                report[reason]["jobs"] += jobs[0]
+                report[reason]["seconds"] += jobs[1]
+                if not dry_run:
+                    self.db.execute(
+                        "UPDATE packages SET status = 'SKIPPED', skip_reason = ? WHERE status = 'NOT_STARTED' AND package_name = ?",
+                        (reason, package_name)
+                    )
+        for reason, item in report.items():
+            self.logger.info("%s %d jobs (%s), saving about %.1f container hours",
+                             "Would skip" if dry_run else "Skipped", item["jobs"], reason, item["seconds"] / 3600)
+        return dict(report)
+
+    def reset(self) -> int:
+        return len(self.db.execute(
+            "UPDATE packages SET status = 'NOT_STARTED', skip_reason = NULL WHERE status = 'SKIPPED' RETURNING id"
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Skip the jobs of a project that cannot produce gcc output")
+    parser.add_argument("-p", "--project", type=str, required=True, help="Project path")
+    parser.add_argument("-s", "--sources", type=str, action="append", default=[], help="Sources index of the mirror (repeatable)")
+    parser.add_argument("-H", "--history", type=str, help="Database of an earlier project")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="Only report what would be skipped")
+    parser.add_argument("--reset", action="store_true", help="Put every SKIPPED job back to NOT_STARTED")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    db = ProjectDB(os.path.join(args.project, "project_db.sqlite3"))
+    db.migrate()
+    preflight = Preflight(db, os.path.join(args.project, "packages"))
+    if args.reset:
+        preflight.logger.info("Reset %d jobs", preflight.reset())
+    else:
+        preflight.run(args.sources, args.history, args.dry_run)
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+import contextlib
+import logging
+import sqlite3
+import threading
+import time
+
+BUSY_TIMEOUT = 60
+CONNECT_RETRY = 5
+
+# Schema of the job table, one list of statements per version. A database
+# at `PRAGMA user_version` N gets every migration after N applied in order;
+# databases created before versioning report version 0.
+MIGRATIONS = [
+    [
+        "CREATE TABLE IF NOT EXISTS packages (id INTEGER PRIMARY KEY AUTOINCREMENT, package_name TEXT, optimization_level TEXT, status TEXT, dirname TEXT)",
+    ],
+    [
+        "ALTER TABLE packages ADD COLUMN worker_id TEXT",
+        "ALTER TABLE packages ADD COLUMN claimed_at REAL",
+        "ALTER TABLE packages ADD COLUMN finished_at REAL",
+        # (status, id) lets a claim seek straight to the first NOT_STARTED
+        # row in rowid order, however many rows are already DONE
+        "CREATE INDEX IF NOT EXISTS packages_status ON packages (status, id)",
+        "CREATE INDEX IF NOT EXISTS packages_package_name ON packages (package_name)",
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS dep_layers (package_name TEXT PRIMARY KEY, image TEXT, status TEXT, created_at REAL)",
+    ],
+    [
+        "ALTER TABLE packages ADD COLUMN version TEXT",
+        "CREATE TABLE IF NOT EXISTS source_cache (package_name TEXT, version TEXT, status TEXT, hits INTEGER, misses INTEGER, updated_at REAL, PRIMARY KEY (package_name, version))",
+    ],
+    [
+        "ALTER TABLE packages ADD COLUMN size INTEGER",
+        "ALTER TABLE packages ADD COLUMN priority REAL NOT NULL DEFAULT 0",
+        "ALTER TABLE packages ADD COLUMN wall_time REAL",
+        "ALTER TABLE packages ADD COLUMN peak_memory INTEGER",
+        "ALTER TABLE packages ADD COLUMN output_size INTEGER",
+        # Claims now go by priority, the index follows the claim order
+        "DROP INDEX IF EXISTS packages_status",
+        "CREATE INDEX IF NOT EXISTS packages_claim ON packages (status, priority DESC, id)",
+    ],
+    [
+        "ALTER TABLE packages ADD COLUMN memory_estimate INTEGER",
+    ],
+    [
+        # Set while a farm worker holds the job, see farm.Coordinator
+        "ALTER TABLE packages ADD COLUMN lease_expires REAL",
+    ],
+    [
+        # Strict consolidation maps directories found on disk back to jobs
+        "CREATE INDEX IF NOT EXISTS packages_dirname ON packages (dirname)",
+    ],
+    [
+        "ALTER TABLE packages ADD COLUMN deduplicated_files INTEGER",
+        "ALTER TABLE packages ADD COLUMN deduplicated_bytes INTEGER",
+        "CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, size INTEGER, created_at REAL)",
+    ],
+    [
+        # The finished_at of a job when it went into the knowledge graph,
+        # see KnowledgeGraph/analysis_state.py. Jobs used to be set ANALYZED.
+        "ALTER TABLE packages ADD COLUMN analyzed_at REAL",
+        "UPDATE packages SET status = 'DONE', analyzed_at = coalesce(finished_at, 0) WHERE status = 'ANALYZED'",
+        "CREATE INDEX IF NOT EXISTS packages_analysis ON packages (status, analyzed_at)",
+    ],
+    [
+        # Why preflight.py set a job SKIPPED, and how many gcc tasks a DONE
+        # job ran, see preflight.py
+        "ALTER TABLE packages ADD COLUMN skip_reason TEXT",
+        "ALTER TABLE packages ADD COLUMN gcc_tasks INTEGER",
+    ],
+    [
+        # Kind of a COMPILE_ERROR, see build_failure.py
+        "ALTER TABLE packages ADD COLUMN failure TEXT",
+    ],
+]
+
+
+class ProjectDB:
+    """Thread-safe access to a project's sqlite3 database.
+
+    Every thread gets its own long-lived connection in WAL mode, so readers
+    never block the writer and a status transition costs one small WAL
+    append instead of a connect, a journal fsync and a close. Statements
+    outside of `transaction()` are committed immediately (autocommit);
+    inside of it they are batched into a single commit.
+    """
+
+    def __init__(self, db_path: str, timeout: float = BUSY_TIMEOUT):
+        self.db_path = db_path
+        self.timeout = timeout
+        self.logger = logging.getLogger("ProjectDB")
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def _connect(self) -> sqlite3.Connection:
+        tried = 0
+        while True:
+            try:
+                conn = sqlite3.connect(
+                    self.db_path,
+                    timeout=self.timeout,
+                    isolation_level=None,
+                    check_same_thread=False
+                )
+                conn.execute(f"PRAGMA busy_timeout = {int(self.timeout * 1000)}")
+                conn.execute("PRAGMA journal_mode = WAL")
+                conn.execute("PRAGMA synchronous = NORMAL")
+                return conn
+            except sqlite3.OperationalError as e:
+                tried += 1
+                if tried >= CONNECT_RETRY:
+                    self.logger.error("Error connecting to database: %s", e)
+                    raise
+                self.logger.warning("Error connecting to database: %s, retrying %d/%d", e, tried, CONNECT_RETRY)
+                time.sleep(0.1 * 2 ** tried)
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.depth = 0
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _run(self, func, *args):
+        # busy_timeout already waits for the lock; this only covers the
+        # rare SQLITE_BUSY returned without waiting (e.g. WAL recovery).
+        conn = self.connection()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                return func(conn, *args)
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) and "busy" not in str(e):
+                    raise
+                if self._local.depth > 0 or time.monotonic() >= deadline:
+                    raise
+                self.logger.warning("Database busy: %s, retrying", e)
+                time.sleep(0.05)
+
+    def execute(self, *args) -> list:
+        return self._run(lambda conn: conn.execute(*args).fetchall())
+
+    def executemany(self, *args) -> int:
+        return self._run(lambda conn: conn.executemany(*args).rowcount)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Group statements into one write transaction with a single commit.
+
+        The write lock is taken up front (BEGIN IMMEDIATE), so a transaction
+        never fails half-way on a lock upgrade. Nested calls join the
+        outermost transaction.
+        """
+        conn = self.connection()
+        if self._local.depth > 0:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+        self._run(lambda conn: conn.execute("BEGIN IMMEDIATE"))
+        self._local.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            self._local.depth = 0
+
+    def migrate(self, migrations=MIGRATIONS):
+        with self.transaction() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for idx in range(version, len(migrations)):
+                self.logger.info("Migrating database to version %d", idx + 1)
+                for statement in migrations[idx]:
+                    conn.execute(statement)
+            if version < len(migrations):
+                conn.execute(f"PRAGMA user_version = {len(migrations)}")
+
+    def release(self):
+        """Closes the connection of the calling thread, e.g. at the end of a
+        short-lived thread; the next statement of the thread reconnects."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            return
+        if self._local.depth > 0:
+            raise Exception("Releasing a connection inside a transaction")
+        with self._lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        self._local.conn = None
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
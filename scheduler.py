@@ -0,0 +1,177 @@
+import collections
+import logging
+import threading
+import psutil
+
+CPU_THRESHOLD = 80
+MEMORY_THRESHOLD = 85
+SAMPLE_INTERVAL = 5
+SMOOTHING = 0.3
+
+
+class LoadMonitor(threading.Thread):
+    """Samples machine load in the background and keeps a smoothed view.
+
+    `psutil.cpu_percent()` without an interval compares against the previous
+    call, which is meaningless when calls are irregular. Here every sample
+    spans exactly `interval` seconds and feeds an exponentially weighted
+    moving average, so a single compiler spike does not stall admission.
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL, smoothing: float = SMOOTHING):
+        super(LoadMonitor, self).__init__(name="LoadMonitor", daemon=True)
+        self.interval = interval
+        self.smoothing = smoothing
+        self.cpu = psutil.cpu_percent(interval=None)
+        self.memory = psutil.virtual_memory().percent
+        self.listeners = []
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            cpu = psutil.cpu_percent(interval=self.interval)
+            memory = psutil.virtual_memory().percent
+            self.cpu += self.smoothing * (cpu - self.cpu)
+            self.memory += self.smoothing * (memory - self.memory)
+            for listener in self.listeners:
+                listener()
+
+    def stop(self):
+        self._stopped.set()
+
+
+class WorkerPool:
+    """A fixed set of long-lived workers that claim and run jobs.
+
+    Workers block on a condition variable until they are admitted, then take
+    the next job from a local queue that is refilled in batches through
+    `fetch(num_jobs)`. A finished job or a new load sample wakes the waiting
+    workers, so a free slot is reused immediately instead of after a poll.
+    One worker fetches at a time, without holding the condition: a fetch
+    may wait for jobs to come back (see farm.RemoteProject) while the
+    other workers finish theirs.
+
+    Admission needs a free slot below the current limit and smoothed load
+    below the thresholds. With `ramp_up`, the limit starts at one and grows
+    on every load sample in proportion to the remaining CPU headroom, and
+    shrinks back while the machine is overloaded.
+
+    With a `capacity`, every job also has to fit: the `weight(job)` of all
+    running jobs (e.g. their expected peak memory) must stay within it. A
+    job that does not fit waits for running ones to finish, while smaller
+    jobs queued behind it may go first. A job always runs on an idle pool,
+    however heavy it is.
+    """
+
+    def __init__(self, fetch, run, max_workers: int, ramp_up: bool = False, monitor: LoadMonitor = None,
+                 cpu_threshold: float = CPU_THRESHOLD, memory_threshold: float = MEMORY_THRESHOLD,
+                 weight=None, capacity: float = None):
+        self.fetch = fetch
+        self.run = run
+        self.max_workers = max_workers
+        self.monitor = monitor or LoadMonitor()
+        self.cpu_threshold = cpu_threshold
+        self.memory_threshold = memory_threshold
+        self.weight = weight or (lambda job: 0)
+        self.capacity = capacity
+        self.logger = logging.getLogger("WorkerPool")
+        self.limit = 1 if ramp_up else max_workers
+        self.running = 0
+        self.committed = 0
+        self.exhausted = False
+        self.fetching = False
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.workers = []
+        self.monitor.listeners.append(self._on_sample)
+
+    def _overloaded(self) -> bool:
+        return self.monitor.cpu >= self.cpu_threshold or self.monitor.memory >= self.memory_threshold
+
+    def _on_sample(self):
+        with self.cond:
+            if self._overloaded():
+                self.limit = max(1, min(self.limit, self.running) - 1)
+            elif self.limit < self.max_workers and self.running >= self.limit:
+                headroom = 1 - self.monitor.cpu / self.cpu_threshold
+                self.limit = min(self.max_workers, self.limit + max(1, int(self.limit * headroom)))
+                self.logger.info("Ramping up to %d/%d slots (cpu %.1f%%, memory %.1f%%)",
+                                 self.limit, self.max_workers, self.monitor.cpu, self.monitor.memory)
+            self.cond.notify_all()
+
+    def _fits(self, job) -> bool:
+        return self.running == 0 or self.capacity is None or self.committed + self.weight(job) <= self.capacity
+
+    def _fill(self, num_jobs: int):
+        """Fetches up to `num_jobs` more jobs, with `cond` held but released meanwhile."""
+        self.fetching = True
+        self.cond.release()
+        try:
+            jobs = self.fetch(num_jobs)
+        finally:
+            self.cond.acquire()
+            self.fetching = False
+        if len(jobs) == 0:
+            self.exhausted = True
+        self.queue.extend(jobs)
+        self.cond.notify_all()
+
+    def _take(self):
+        for job in self.queue:
+            if self._fits(job):
+                self.queue.remove(job)
+                return job
+        return None
+
+    def _admit(self):
+        """Waits until a job may start and returns it, or None when all are done."""
+        with self.cond:
+            while not (self.exhausted and len(self.queue) == 0):
+                # An idle machine always gets one job, whatever else runs on it
+                if self.running < self.limit and (self.running == 0 or not self._overloaded()):
+                    job = self._take()
+                    if job is not None:
+                        self.running += 1
+                        self.committed += self.weight(job)
+                        return job
+                    # Claim enough for every slot that may be admitted right now, or
+                    # look a bounded distance ahead for a job small enough to fit
+                    if not (self.exhausted or self.fetching or len(self.queue) >= self.max_workers):
+                        self._fill(max(1, self.limit - self.running) if len(self.queue) == 0 else 1)
+                        # Jobs may have started and finished meanwhile
+                        continue
+                self.cond.wait()
+            return None
+
+    def _release(self, job):
+        with self.cond:
+            self.running -= 1
+            self.committed -= self.weight(job)
+            self.cond.notify_all()
+
+    def _worker(self):
+        while True:
+            job = self._admit()
+            if job is None:
+                break
+            try:
+                self.run(job)
+            except Exception:
+                self.logger.exception("Job %s failed", job)
+            finally:
+                self._release(job)
+
+    def start(self):
+        if not self.monitor.is_alive():
+            self.monitor.start()
+        for idx in range(self.max_workers):
+            worker = threading.Thread(target=self._worker, name=f"Worker-{idx}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def join(self):
+        for worker in self.workers:
+            # Join with a timeout so KeyboardInterrupt reaches the main thread
+            while worker.is_alive():
+                worker.join(1)
+        self.monitor.stop()
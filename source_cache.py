@@ -0,0 +1,183 @@
+import asyncio
+import collections
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+import docker
+from docker_async import AsyncDockerClient, container_config
+
+
+class SourceCache:
+    """Source packages fetched and unpacked once per project.
+
+    The first job of a package runs `compile.sh` with COMPILE_STAGE=fetch,
+    which only runs `apt source` into a fresh directory under
+    `<project>/source_cache`. The directory is renamed to its final name
+    `<package>_<version>` once complete, so an interrupted fetch is never
+    mistaken for a pristine tree. Every optimization level then mounts the
+    tree read-only at /source and builds from a copy of it.
+
+    Hits and misses are counted per (package, version) in the
+    `source_cache` table. A tree is pruned once the last job of its package
+    has finished; a package whose fetch fails builds the usual way.
+    """
+
+    def __init__(self, db, base_image: str, cache_root: str):
+        self.db = db
+        self.base_image = base_image
+        self.cache_root = cache_root
+        self.logger = logging.getLogger("SourceCache")
+        self._locks = collections.defaultdict(threading.Lock)
+        self._async_locks = collections.defaultdict(asyncio.Lock)
+        self._locks_lock = threading.Lock()
+        os.makedirs(cache_root, exist_ok=True)
+        # Fetches interrupted by a crash
+        for name in os.listdir(cache_root):
+            if name.startswith(".fetch_"):
+                shutil.rmtree(os.path.join(cache_root, name), ignore_errors=True)
+
+    def _version(self, package_name: str) -> str:
+        res = self.db.execute(
+            "SELECT version FROM packages WHERE package_name = ? AND version IS NOT NULL LIMIT 1",
+            (package_name,)
+        )
+        return res[0][0] if len(res) > 0 else "unknown"
+
+    def source_path(self, package_name: str, version: str) -> str:
+        # Epochs put a ':' into versions, which does not belong in a path
+        return os.path.join(self.cache_root, f"{package_name}_{version.replace(':', '%')}")
+
+    def fetch_spec(self, package_name: str, fetch_path: str) -> dict:
+        return {
+            "image": self.base_image,
+            "command": [
+                "/bin/sh",
+                "-c",
+                f"compile.sh {package_name} {os.getuid()} {os.getgid()}"
+            ],
+            "environment": {
+                "COMPILE_STAGE": "fetch",
+                "SOURCE_PATH": "/source"
+            },
+            "volumes": {
+                os.path.abspath(fetch_path): {
+                    "bind": "/source",
+                    "mode": "rw"
+                }
+            },
+            "name": f"{package_name}_fetch"
+        }
+
+    def _lookup(self, package_name: str):
+        """Returns (version, path, cached) where cached is None after a failed fetch."""
+        version = self._version(package_name)
+        path = self.source_path(package_name, version)
+        res = self.db.execute(
+            "SELECT status FROM source_cache WHERE package_name = ? AND version = ?",
+            (package_name, version)
+        )
+        if len(res) > 0 and res[0][0] == "FAILED":
+            return version, path, None
+        return version, path, os.path.isdir(path)
+
+    def _count(self, package_name: str, version: str, hit: bool, status: str):
+        self.db.execute(
+            "INSERT INTO source_cache (package_name, version, status, hits, misses, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (package_name, version) DO UPDATE SET status = excluded.status, hits = hits + excluded.hits, misses = misses + excluded.misses, updated_at = excluded.updated_at",
+            (package_name, version, status, int(hit), int(not hit), time.time())
+        )
+
+    def _log_path(self, package_name: str) -> str:
+        return os.path.join(self.cache_root, f"{package_name}.fetch.log")
+
+    def _fetch_path(self) -> str:
+        fetch_path = os.path.join(self.cache_root, f".fetch_{uuid.uuid4().hex}")
+        os.makedirs(fetch_path)
+        return fetch_path
+
+    def _finish(self, package_name: str, version: str, path: str, fetch_path: str, succeed: bool):
+        if succeed:
+            os.rename(fetch_path, path)
+            self.logger.info("Source of %s %s cached in %s", package_name, version, path)
+        else:
+            shutil.rmtree(fetch_path, ignore_errors=True)
+            self.logger.warning("Fetching source of %s %s failed, building without cache", package_name, version)
+        self._count(package_name, version, False, "CACHED" if succeed else "FAILED")
+        return path if succeed else None
+
+    def _lock(self, package_name: str) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks[package_name]
+
+    def acquire(self, package_name: str) -> str:
+        """Returns the pristine source tree of `package_name`, or None."""
+        with self._lock(package_name):
+            version, path, cached = self._lookup(package_name)
+            if cached is None:
+                return None
+            if cached:
+                self._count(package_name, version, True, "CACHED")
+                return path
+            fetch_path = self._fetch_path()
+            try:
+                client = docker.from_env()
+                container = client.containers.run(detach=True, **self.fetch_spec(package_name, fetch_path))
+                try:
+                    succeed = container.wait()["StatusCode"] == 0
+                    with open(self._log_path(package_name), "wb") as f:
+                        f.write(container.logs())
+                finally:
+                    container.remove(force=True)
+            except Exception as e:
+                self.logger.error("Error fetching source of %s: %s", package_name, e)
+                succeed = False
+            return self._finish(package_name, version, path, fetch_path, succeed)
+
+    async def acquire_async(self, client: AsyncDockerClient, package_name: str) -> str:
+        async with self._async_locks[package_name]:
+            version, path, cached = await asyncio.to_thread(self._lookup, package_name)
+            if cached is None:
+                return None
+            if cached:
+                await asyncio.to_thread(self._count, package_name, version, True, "CACHED")
+                return path
+            fetch_path = self._fetch_path()
+            spec = self.fetch_spec(package_name, fetch_path)
+            try:
+                state = await client.run_container(
+                    container_config(spec),
+                    name=spec["name"],
+                    log_path=self._log_path(package_name)
+                )
+                succeed = state["ExitCode"] == 0
+            except Exception as e:
+                self.logger.error("Error fetching source of %s: %s", package_name, e)
+                succeed = False
+            return await asyncio.to_thread(self._finish, package_name, version, path, fetch_path, succeed)
+
+    def release(self, package_name: str):
+        """Prunes the tree once the last job of `package_name` has finished."""
+        with self._lock(package_name):
+            pending = self.db.execute(
+                "SELECT count(*) FROM packages WHERE package_name = ? AND status IN ('NOT_STARTED', 'STARTED')",
+                (package_name,)
+            )[0][0]
+            if pending > 0:
+                return
+            version = self._version(package_name)
+            path = self.source_path(package_name, version)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+                self.db.execute(
+                    "UPDATE source_cache SET status = 'PRUNED' WHERE package_name = ? AND version = ?",
+                    (package_name, version)
+                )
+
+    def stats(self) -> dict:
+        hits, misses, failed = self.db.execute(
+            "SELECT coalesce(sum(hits), 0), coalesce(sum(misses), 0), count(CASE WHEN status = 'FAILED' THEN 1 END) FROM source_cache"
+        )[0]
+        return {"hits": hits, "misses": misses, "failed": failed}
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Analysis checkpoints of DONE jobs and following a running compilation."""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "KnowledgeGraph"))
+from analysis_state import AnalysisState
+
+
+def create_state(tmp: str, statuses: list) -> AnalysisState:
+    state = AnalysisState(tmp)
+    for idx, status in enumerate(statuses):
+        state.db.execute(
+            "INSERT INTO packages (package_name, optimization_level, status, dirname, finished_at) VALUES (?, ?, ?, ?, ?)",
+            (f"pkg{idx}", "O2", status, f"pkg{idx}_O2", 1.0 if status == "DONE" else None)
+        )
+    return state
+
+
+def test_checkpoints():
+    with tempfile.TemporaryDirectory() as tmp:
+        state = create_state(tmp, ["DONE", "DONE", "COMPILE_ERROR"])
+        pending = state.pending()
+        assert [package[3] for package in pending] == ["pkg0_O2", "pkg1_O2"]
+        state.mark(pending[0])
+        state.close()
+        # Survives a restart
+        state = AnalysisState(tmp)
+        assert [package[3] for package in state.pending()] == ["pkg1_O2"]
+        # Compiled again, pending in the order jobs finished
+        state.db.execute("UPDATE packages SET finished_at = 2.0 WHERE id = 1")
+        assert [package[3] for package in state.pending()] == ["pkg1_O2", "pkg0_O2"]
+        state.close()
+
+
+def test_follow():
+    with tempfile.TemporaryDirectory() as tmp:
+        state = create_state(tmp, ["DONE", "STARTED"])
+
+        def finish():
+            time.sleep(0.1)
+            state.db.execute("UPDATE packages SET status = 'DONE', finished_at = 3.0 WHERE id = 2")
+
+        thread = threading.Thread(target=finish)
+        thread.start()
+        batches = []
+        for batch in state.follow(poll_interval=0.02):
+            batches.append([package[3] for package in batch])
+            # The first one fails and is not yielded again
+            for package in batch[1:] if len(batches) == 1 else batch:
+                state.mark(package)
+        thread.join()
+        assert batches == [["pkg0_O2"], ["pkg1_O2"]]
+        assert [package[3] for package in state.pending()] == ["pkg0_O2"]
+        state.close()
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name} ok")
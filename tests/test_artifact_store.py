@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""Identical job outputs share one blob, unless their modes differ."""
+import os
+import stat
+import sys
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from artifact_store import ArtifactStore
+from project_db import ProjectDB
+
+
+def write(path: str, data: bytes, mode: int):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    os.chmod(path, mode)
+
+
+def test_modes():
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ProjectDB(os.path.join(tmp, "db.sqlite3"))
+        db.migrate()
+        package_id = db.execute("INSERT INTO packages (package_name) VALUES ('a') RETURNING id")[0][0]
+        store = ArtifactStore(db, os.path.join(tmp, "blobs"))
+        job = os.path.join(tmp, "job")
+        write(os.path.join(job, "O0", "run"), b"#!/bin/sh\n", 0o755)
+        write(os.path.join(job, "O1", "run"), b"#!/bin/sh\n", 0o755)
+        write(os.path.join(job, "O0", "run.txt"), b"#!/bin/sh\n", 0o644)
+        res = store.ingest(package_id, job)
+        assert (res["files"], res["deduplicated_files"]) == (3, 1)
+        runs = [os.stat(os.path.join(job, level, "run")) for level in ("O0", "O1")]
+        text = os.stat(os.path.join(job, "O0", "run.txt"))
+        assert runs[0].st_ino == runs[1].st_ino != text.st_ino
+        # Modes are left as the job wrote them
+        assert stat.S_IMODE(runs[0].st_mode) == 0o755
+        assert stat.S_IMODE(text.st_mode) == 0o644
+        assert store.stats()["blobs"] == 2
+        db.close()
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name} ok")
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Failed builds are told apart by their logs; only transient ones are retried."""
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import build_failure
+
+LOGS = {
+    build_failure.DEPENDENCY: "E: apt build-dep foo failed with status 100\n",
+    build_failure.FETCH: "E: Unable to find a source package for foo\n",
+    build_failure.TRANSIENT: "Err:1 http://archive.ubuntu.com focal/main foo\n  Temporary failure resolving 'archive.ubuntu.com'\nE: Failed to fetch foo\n",
+    build_failure.COMPILER: "foo.c:12:5: error: 'bar' undeclared (first use in this function)\nmake: *** [Makefile:3: foo.o] Error 1\n",
+    build_failure.UNKNOWN: "dh_auto_test: error: make -j1 check returned exit code 2\n",
+}
+
+
+def write_log(save_path: str, text: str):
+    os.makedirs(save_path, exist_ok=True)
+    with open(os.path.join(save_path, "compile.log"), "w") as f:
+        f.write(text)
+
+
+def test_classify_failure():
+    with tempfile.TemporaryDirectory() as tmp:
+        for kind, text in LOGS.items():
+            write_log(os.path.join(tmp, kind), text)
+            assert build_failure.classify_failure(os.path.join(tmp, kind)) == kind
+        assert build_failure.classify_failure(os.path.join(tmp, "missing")) == build_failure.UNKNOWN
+
+
+def test_mixed_log():
+    # A mirror timed out while apt updated, the build went on and failed to compile
+    recovered = "W: Failed to fetch http://archive.ubuntu.com/focal/InRelease  Temporary failure resolving 'archive.ubuntu.com'\n"
+    build = "".join(f"gcc -c -O2 foo{idx}.c\n" for idx in range(build_failure.TRANSIENT_LINES))
+    disk_full = "foo.c:1:0: fatal error: error writing to /tmp/ccx.s: No space left on device\n"
+    with tempfile.TemporaryDirectory() as tmp:
+        write_log(os.path.join(tmp, "compiler"), recovered + build + LOGS[build_failure.COMPILER])
+        assert build_failure.classify_failure(os.path.join(tmp, "compiler")) == build_failure.COMPILER
+        # What ended the build is transient, whatever came before it
+        write_log(os.path.join(tmp, "transient"), LOGS[build_failure.COMPILER] + build + disk_full)
+        assert build_failure.classify_failure(os.path.join(tmp, "transient")) == build_failure.TRANSIENT
+
+
+def test_siblings():
+    for module in ("docker", "psutil"):
+        pytest.importorskip(module)
+    from compile_project import CompileProject
+
+    class FakeProject(CompileProject):
+        runs = []
+
+        def compile_package_internal(self, package_name, optimization_level, dirname, in_memory=False, image=None, source_path=None, metrics=None):
+            self.runs.append(dirname)
+            write_log(os.path.join(self.packages_root, dirname), LOGS[package_name])
+            return "COMPILE_ERROR"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        kinds = (build_failure.DEPENDENCY, build_failure.TRANSIENT, build_failure.COMPILER)
+        project = FakeProject(tmp, [{"package": kind} for kind in kinds])
+        jobs = project.db_exec("SELECT id, package_name, dirname FROM packages WHERE optimization_level = '0'")
+        for package_id, package_name, dirname in jobs:
+            assert project.compile_package(package_id, package_name, "0", dirname, 2, False) == "COMPILE_ERROR"
+        # Only the transient failure was retried
+        assert len(project.runs) == 5
+        siblings = dict(project.db_exec(
+            "SELECT package_name, group_concat(DISTINCT status || ':' || (priority < 0)) FROM packages WHERE optimization_level != '0' GROUP BY package_name"
+        ))
+        assert siblings == {
+            build_failure.DEPENDENCY: "SKIPPED:0",
+            build_failure.TRANSIENT: "NOT_STARTED:0",
+            build_failure.COMPILER: "NOT_STARTED:1"
+        }
+        # A sibling that builds does not bring the others forward again
+        package_id, = project.db_exec("SELECT id FROM packages WHERE package_name = ? AND optimization_level = '2'", (build_failure.COMPILER,))[0]
+        project.record_result(package_id, "DONE", 100.0, None, 0)
+        assert project.db_exec(
+            "SELECT DISTINCT priority FROM packages WHERE package_name = ? AND status = 'NOT_STARTED'", (build_failure.COMPILER,)
+        ) == [(-1,)]
+        project.trash.close()
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name} ok")
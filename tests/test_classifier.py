@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""Classification of the files of compile jobs from their headers."""
+import os
+import struct
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import classifier
+
+
+def elf(e_type: int, interp: bool = False) -> bytes:
+    # One program header right after the ELF header
+    header = b"\x7fELF\x02\x01\x01" + b"\x00" * 9 + struct.pack("<HHIQQQIHHHHHH", e_type, 62, 1, 0, 64, 0, 0, 64, 56, 1, 64, 0, 0)
+    return header + struct.pack("<II", 3 if interp else 1, 0) + b"\x00" * 48
+
+
+def test_binaries():
+    assert classifier.classify("a.o", elf(1))[:2] == ("Relocatable", None)
+    assert classifier.classify("a", elf(2))[:2] == ("Executable", None)
+    # Like libmagic: a PIE executable is a shared object
+    assert classifier.classify("a", elf(3, interp=True)) == ("SharedLib", None, "ELF 64-bit LSB shared object, x86-64", None)
+    assert classifier.classify("a.so", elf(3))[:2] == ("SharedLib", None)
+    assert classifier.classify("liba.a", b"!<arch>\n" + b"\x00" * 64)[:2] == ("ArchiveLib", None)
+    assert classifier.classify("a.bin", b"\x01\x00\x02")[:2] == (None, None)
+
+
+def test_text():
+    assert classifier.classify("a.c", b"int main(void) { return 0; }\n")[:2] == ("Source", "C")
+    assert classifier.classify("a.cc", b"int f();\n")[:2] == ("Source", "C++")
+    assert classifier.classify("a", b"x") == ("Dummy", None, "very short file (no magic)", None)
+    assert classifier.classify("a.c", b"")[0] is None
+
+
+class FakeMagic:
+    def __init__(self, file_info: str):
+        self.file_info = file_info
+        self.calls = 0
+
+    def from_buffer(self, data: bytes) -> str:
+        self.calls += 1
+        return self.file_info
+
+
+def test_ambiguous_extensions():
+    # A .h header may be C++, only libmagic can tell
+    saved = classifier.magic
+    classifier.magic = FakeMagic("C++ source, ASCII text")
+    try:
+        header = b"namespace a {\nclass B { public: virtual ~B(); };\n}\n"
+        assert classifier.classify("b.h", header) == ("Source", "C++", "C++ source, ASCII text", "C++ source, ASCII text")
+        assert classifier.classify("b.cpp", header)[3] is None
+        assert classifier.magic.calls == 1
+    finally:
+        classifier.magic = saved
+    if saved is None:
+        # Without libmagic the extension is all there is
+        assert classifier.classify("a.h", b"int f(void);\n")[:2] == ("Source", "C")
+
+
+def test_magic_rules():
+    assert classifier.classify_magic("a.c", "C source, ASCII text") == ("Source", "C")
+    assert classifier.classify_magic("a.hpp", "ASCII text") == ("Source", "C++")
+    assert classifier.classify_magic("a.txt", "ASCII text") == (None, None)
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name} ok")
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""The IDA decompilation driver against a stub idat64."""
+import os
+import stat
+import sys
+import tempfile
+import time
+
+import pytest
+
+pytest.importorskip("tqdm")
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "decomp"))
+from extract_functions_with_ida import DecompProject, decompile_project, time_budget
+
+# Called as idat64 -A -S"<script> <dir>" -L<log> <binary>, writes <binary>.decomp
+# next to the binary unless its name says otherwise: "broken" exits with an
+# error, "flaky" is killed on its first run, "hang" never ends
+STUB_IDAT = f"""#!{sys.executable}
+import json, os, signal, subprocess, sys, time
+binary = sys.argv[-1]
+with open(os.path.join(os.path.dirname(sys.argv[0]), "runs"), "a") as f:
+    print(binary, file=f)
+open(binary + ".id0", "w").close()
+if "broken" in binary:
+    sys.exit(1)
+if "flaky" in binary and not os.path.exists(binary + ".killed"):
+    open(binary + ".killed", "w").close()
+    os.kill(os.getpid(), signal.SIGKILL)
+if "hang" in binary:
+    subprocess.Popen(["sleep", "60"])
+    time.sleep(60)
+with open(binary + ".decomp", "w") as f:
+    json.dump([], f)
+"""
+
+
+def make_stub(tmp: str) -> str:
+    path = os.path.join(tmp, "idat64")
+    with open(path, "w") as f:
+        f.write(STUB_IDAT)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+    return path
+
+
+def test_decompile_project():
+    with tempfile.TemporaryDirectory() as tmp:
+        idat = make_stub(tmp)
+        project_root = os.path.join(tmp, "project")
+        for package, binaries in {"foo_O2": ["foo", "libfoo.a"], "bar_O0": ["bar", "broken"]}.items():
+            os.makedirs(os.path.join(project_root, package, "bin"))
+            for name in binaries:
+                with open(os.path.join(project_root, package, "bin", name), "wb") as f:
+                    f.write(b"\x7fELF" + name.encode())
+        # Decompiled by an earlier run
+        open(os.path.join(project_root, "foo_O2", "bin", "foo.decomp"), "w").close()
+        project = DecompProject(project_root)
+        assert project.scan() == 4
+        assert project.scan() == 0
+        counts = decompile_project(project, idat, max_workers=2, retry=2)
+        assert counts == {"DONE": 3, "FAILED": 1}
+        # Not transient, so not retried
+        assert project.db.execute("SELECT attempts, error FROM binaries WHERE name = 'broken'") == [(1, f"{idat} exited with status 1")]
+        # IDA's databases are removed
+        assert not any(name.endswith(".id0") for name in os.listdir(os.path.join(project_root, "bar_O0", "bin")))
+        project.close()
+
+
+def test_schedule():
+    with tempfile.TemporaryDirectory() as tmp:
+        idat = make_stub(tmp)
+        project_root = os.path.join(tmp, "project")
+        os.makedirs(os.path.join(project_root, "foo_O2", "bin"))
+        for name, size in {"small": 10, "large": 1000, "flaky": 100, "hang": 500}.items():
+            with open(os.path.join(project_root, "foo_O2", "bin", name), "wb") as f:
+                f.write(b"\0" * size)
+        project = DecompProject(project_root)
+        project.scan()
+        assert [os.path.basename(path) for _, path, _, _ in project.pending()] == ["large", "hang", "flaky", "small"]
+        assert time_budget(1 << 20, 10, 5) == 15
+        start = time.monotonic()
+        counts = decompile_project(project, idat, max_workers=4, retry=3, timeout_base=2, timeout_per_mb=0)
+        assert time.monotonic() - start < 30
+        assert counts == {"DONE": 3, "FAILED": 1}
+        res = dict((name, (status, attempts)) for name, status, attempts in project.db.execute("SELECT name, status, attempts FROM binaries"))
+        assert res["flaky"] == ("DONE", 2)
+        assert res["hang"] == ("FAILED", 1)
+        assert project.db.execute("SELECT error FROM binaries WHERE name = 'hang'") == [("Timed out after 2 s",)]
+        assert all(elapsed is not None for elapsed, in project.db.execute("SELECT elapsed FROM binaries"))
+        project.close()
+
+
+def test_duplicates():
+    with tempfile.TemporaryDirectory() as tmp:
+        idat = make_stub(tmp)
+        project_root = os.path.join(tmp, "project")
+        binaries = {"foo_O0/bin/foo": b"same", "foo_O2/bin/foo": b"same", "bar_O0/bin/vendored": b"same",
+                    "bar_O0/bin/bar": b"other", "baz_O0/bin/broken": b"bad", "baz_O2/bin/broken": b"bad"}
+        for name, data in binaries.items():
+            os.makedirs(os.path.join(project_root, os.path.dirname(name)), exist_ok=True)
+            with open(os.path.join(project_root, name), "wb") as f:
+                f.write(data)
+        project = DecompProject(project_root)
+        project.scan()
+        assert len(project.pending()) == 3
+        counts = decompile_project(project, idat, max_workers=2)
+        assert counts == {"DONE": 4, "FAILED": 2}
+        with open(os.path.join(tmp, "runs")) as f:
+            assert len(f.readlines()) == 3
+        for name in binaries:
+            if "broken" not in name:
+                with open(os.path.join(project_root, name + ".decomp")) as f:
+                    assert f.read() == "[]"
+        assert project.db.execute("SELECT count(*) FROM binaries WHERE duplicate_of IS NOT NULL") == [(3,)]
+        assert project.saved()[0] == 3
+        # Copies found later are linked without running IDA
+        os.makedirs(os.path.join(project_root, "foo_O3", "bin"))
+        with open(os.path.join(project_root, "foo_O3", "bin", "foo"), "wb") as f:
+            f.write(b"same")
+        assert project.scan() == 1
+        assert project.counts() == {"DONE": 5, "FAILED": 2}
+        assert os.path.exists(os.path.join(project_root, "foo_O3", "bin", "foo.decomp"))
+        project.close()
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name} ok")
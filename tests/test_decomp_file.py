@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""Streaming .decomp files: writing, resuming and lazy reading."""
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "decomp"))
+from decomp_file import DecompWriter, iter_functions
+
+
+def function(address: int) -> dict:
+    return {"name": f"sub_{address:x}", "pseudocode": "int f()\n{\n  return 0;\n}\n", "address": address, "file_offset": address - 0x400000}
+
+
+def test_resume():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "foo.decomp")
+        writer = DecompWriter(path)
+        for address in (0x401000, 0x401100):
+            writer.write(function(address))
+        # Killed while writing the third one
+        writer.file.write(b'{"name": "sub_4012')
+        writer.file.close()
+        assert not os.path.exists(path)
+        with DecompWriter(path) as writer:
+            assert writer.done == {0x401000, 0x401100}
+            writer.write(function(0x401200))
+        assert not os.path.exists(path + ".part")
+        assert [f["address"] for f in iter_functions(path)] == [0x401000, 0x401100, 0x401200]
+        with open(path) as f:
+            assert len(f.readlines()) == 3
+
+
+def test_legacy():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "foo.decomp")
+        with open(path, "w") as f:
+            json.dump([function(0x401000), function(0x401100)], f, indent=4)
+        assert [f["name"] for f in iter_functions(path)] == ["sub_401000", "sub_401100"]
+
+
+def test_zstd():
+    pytest.importorskip("zstandard")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "foo.decomp")
+        with DecompWriter(path, compress=True) as writer:
+            for address in range(0x401000, 0x402000, 0x10):
+                writer.write(function(address))
+        with open(path, "rb") as f:
+            assert f.read(4) == b"\x28\xb5\x2f\xfd"
+        assert len(list(iter_functions(path))) == 0x100
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name} ok")
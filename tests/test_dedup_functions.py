@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Function-level deduplication of .decomp files."""
+import os
+import struct
+import sys
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "decomp"))
+from dedup_functions import FunctionDedup, load_ranges, normalize
+from decomp_file import DecompWriter, iter_functions
+
+STRLEN = """__int64 __fastcall %s(__int64 a1)
+{
+  __int64 v1; // %s
+
+  v1 = 0LL;
+  while ( *(_BYTE *)(a1 + v1) )
+    ++v1;
+  return sub_%X(v1, &dword_%X);
+}
+"""
+
+
+CRC32 = """unsigned int __fastcall %s(unsigned int a1)
+{
+  return (a1 >> 1) ^ (%s & -(a1 & 1));
+}
+"""
+
+
+def test_normalize():
+    assert normalize(STRLEN % ("sub_401000", "rax", 0x401200, 0x6010A0), "sub_401000") == \
+        normalize(STRLEN % ("my_strlen", "rdx", 0x8A1230, 0x9000F0), "my_strlen")
+    assert normalize("return 0x7FFF;") != normalize("return 0x8000;")
+    # Constants inside the binary's segments are addresses, any other is kept
+    assert normalize("call(0x401000);", ranges=[(0x400000, 0x402000)]) == normalize("call(0x8a1230);", ranges=[(0x8a0000, 0x8b0000)])
+    assert normalize("call(0x401000);") != normalize("call(0x8a1230);")
+    ranges = [(0x400000, 0x500000), (0x600000, 0x602000)]
+    assert normalize(CRC32 % ("crc32_step", "0xEDB88320"), "crc32_step", ranges) != \
+        normalize(CRC32 % ("crc32c_step", "0x82F63B78"), "crc32c_step", ranges)
+
+
+
+def test_load_ranges():
+    header = b"\x7fELF\x02\x01\x01" + b"\x00" * 9 + struct.pack("<HHIQQQIHHHHHH", 2, 62, 1, 0x401000, 64, 0, 0, 64, 56, 2, 64, 0, 0)
+    # PT_LOAD of the text, PT_NOTE
+    phdrs = struct.pack("<IIQQQQQQ", 1, 5, 0, 0x400000, 0x400000, 0x1000, 0x1000, 0x1000)
+    phdrs += struct.pack("<IIQQQQQQ", 4, 4, 0, 0x400100, 0x400100, 0x20, 0x20, 4)
+    with tempfile.TemporaryFile() as f:
+        f.write(header + phdrs)
+        f.flush()
+        assert load_ranges(f) == [(0x400000, 0x401000)]
+    with tempfile.TemporaryFile() as f:
+        f.write(b"!<arch>\n")
+        f.flush()
+        assert load_ranges(f) == []
+
+def write_binary(project_root: str, binary: str, functions: list):
+    path = os.path.join(project_root, binary)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = b""
+    with DecompWriter(path + ".decomp") as writer:
+        for name, pseudocode, code in functions:
+            writer.write({"name": name, "pseudocode": pseudocode, "address": 0x401000 + len(data),
+                          "file_offset": len(data), "size": len(code)})
+            data += code
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_dedup():
+    with tempfile.TemporaryDirectory() as tmp:
+        write_binary(tmp, "foo_O2/bin/foo", [
+            ("sub_401000", STRLEN % ("sub_401000", "rax", 0x401200, 0x6010A0), b"\x48\x31\xc0\xc3"),
+            ("main", "int main()\n{\n  return 0;\n}\n", b"\x31\xc0\xc3"),
+        ])
+        write_binary(tmp, "bar_O0/bin/bar", [
+            ("my_strlen", STRLEN % ("my_strlen", "rdx", 0x8A1230, 0x9000F0), b"\x48\x31\xc0\xc3"),
+            ("main", "int main()\n{\n  return 1;\n}\n", b"\x31\xc0\xff\xc0\xc3"),
+        ])
+        dedup = FunctionDedup(tmp)
+        assert dedup.update() == 2
+        assert dedup.update() == 0
+        stats = dedup.stats()
+        assert (stats["functions"], stats["unique_bodies"], stats["binaries"]) == (4, 3, 2)
+        assert (stats["functions_with_bytes"], stats["unique_bytes"]) == (4, 3)
+        assert stats["most_common"][0] == ("my_strlen", 2)
+        # Rewritten .decomp files replace their references
+        write_binary(tmp, "bar_O0/bin/bar", [("main", "int main()\n{\n  return 0;\n}\n", b"\x31\xc0\xc3")])
+        assert dedup.update() == 1
+        assert dedup.db.execute("SELECT refs FROM bodies ORDER BY refs") == [(1,), (2,)]
+        export_path = os.path.join(tmp, "unique.jsonl")
+        assert dedup.export(export_path) == 2
+        assert sorted(f["refs"] for f in iter_functions(export_path)) == [1, 2]
+        dedup.close()
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name} ok")
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""AsyncDockerClient against an in-process fake of the Docker Engine API.
+
+The fake serves the endpoints the client uses over a unix socket. A fake
+container sleeps for FAKE_DURATION seconds, prints FAKE_OUTPUT and exits
+with FAKE_EXIT_CODE, all taken from its environment.
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import urllib.parse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from docker_async import AsyncDockerClient, DockerAPIError
+
+
+class FakeDocker:
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self.containers = {}
+        self.images = {}
+        self.subscribers = []
+        self.connections = 0
+        self.peak_connections = 0
+        self.server = None
+        self.stopped = asyncio.Event()
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self.handle, self.socket_path)
+
+    async def stop(self):
+        self.stopped.set()
+        self.server.close()
+        for writer in self.subscribers:
+            writer.close()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        self.peak_connections = max(self.peak_connections, self.connections)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode().strip()
+                    if not line:
+                        break
+                    key, _, value = line.partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                url = urllib.parse.urlparse(target)
+                params = dict(urllib.parse.parse_qsl(url.query))
+                if not await self.route(method, url.path.split("/")[2:], params, body, writer):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    def respond(self, writer, status: int, payload=None):
+        body = json.dumps(payload).encode() if payload is not None else b""
+        head = f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n"
+        if status != 204:
+            head += f"Content-Length: {len(body)}\r\n"
+        writer.write(head.encode() + b"\r\n" + body)
+
+    def start_chunked(self, writer):
+        writer.write(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n")
+
+    def write_chunk(self, writer, data: bytes):
+        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+    async def route(self, method, path, params, body, writer) -> bool:
+        if method == "POST" and path == ["containers", "create"]:
+            config = json.loads(body)
+            env = dict(item.split("=", 1) for item in config["Env"])
+            container_id = os.urandom(8).hex()
+            self.containers[container_id] = {
+                "name": params.get("name"),
+                "env": env,
+                "state": {"Status": "created", "Running": False, "ExitCode": 0, "OOMKilled": False},
+                "exited": asyncio.Event(),
+            }
+            self.respond(writer, 201, {"Id": container_id})
+        elif method == "POST" and path[0] == "containers" and path[2] == "start":
+            container = self.containers[path[1]]
+            container["state"].update({"Status": "running", "Running": True})
+            asyncio.ensure_future(self.run(path[1]))
+            self.respond(writer, 204)
+        elif method == "GET" and path == ["events"]:
+            self.start_chunked(writer)
+            self.subscribers.append(writer)
+            await self.stopped.wait()
+            return False
+        elif method == "GET" and path[0] == "containers" and path[2] == "logs":
+            container = self.containers[path[1]]
+            self.start_chunked(writer)
+            await container["exited"].wait()
+            for line in container["env"].get("FAKE_OUTPUT", "").split(","):
+                data = line.encode() + b"\n"
+                self.write_chunk(writer, b"\x01\x00\x00\x00" + len(data).to_bytes(4, "big") + data)
+                await writer.drain()
+            self.write_chunk(writer, b"")
+            return False
+        elif method == "GET" and path[0] == "containers" and path[2] == "stats":
+            usage = int(self.containers[path[1]]["env"].get("FAKE_MEMORY", "0"))
+            self.respond(writer, 200, {"memory_stats": {"usage": usage}})
+        elif method == "GET" and path[0] == "containers" and path[2] == "json":
+            if path[1] not in self.containers:
+                self.respond(writer, 404, {"message": "No such container"})
+            else:
+                self.respond(writer, 200, {"Id": path[1], "State": self.containers[path[1]]["state"]})
+        elif method == "POST" and path == ["commit"]:
+            self.images[f"{params['repo']}:{params['tag']}"] = params["container"]
+            self.respond(writer, 201, {"Id": "sha256:" + params["container"]})
+        elif method == "DELETE" and path[0] == "images":
+            if self.images.pop(path[1], None) is None:
+                self.respond(writer, 404, {"message": "No such image"})
+            else:
+                self.respond(writer, 200, [{"Deleted": path[1]}])
+        elif method == "DELETE" and path[0] == "containers":
+            self.containers.pop(path[1], None)
+            self.respond(writer, 204)
+        else:
+            self.respond(writer, 404, {"message": "page not found"})
+        await writer.drain()
+        return True
+
+    async def run(self, container_id: str):
+        container = self.containers[container_id]
+        await asyncio.sleep(float(container["env"].get("FAKE_DURATION", "0")))
+        exit_code = int(container["env"].get("FAKE_EXIT_CODE", "0"))
+        container["state"].update({"Status": "exited", "Running": False, "ExitCode": exit_code})
+        container["exited"].set()
+        event = {"Type": "container", "Action": "die", "Actor": {"ID": container_id, "Attributes": {"exitCode": str(exit_code)}}}
+        for writer in self.subscribers:
+            if not writer.is_closing():
+                self.write_chunk(writer, json.dumps(event).encode() + b"\n")
+
+
+def config(duration: float, output: str = "", exit_code: int = 0) -> dict:
+    return {
+        "Image": "compile_docker:latest",
+        "Cmd": ["/bin/sh", "-c", "true"],
+        "Env": [f"FAKE_DURATION={duration}", f"FAKE_OUTPUT={output}", f"FAKE_EXIT_CODE={exit_code}"],
+        "HostConfig": {"Binds": []},
+    }
+
+
+def with_fake_docker(test):
+    def wrapper():
+        async def main(tmp):
+            fake = FakeDocker(os.path.join(tmp, "docker.sock"))
+            await fake.start()
+            client = AsyncDockerClient(f"unix://{fake.socket_path}", max_connections=4)
+            try:
+                await test(fake, client, tmp)
+            finally:
+                await client.close()
+                await fake.stop()
+        with tempfile.TemporaryDirectory() as tmp:
+            asyncio.run(main(tmp))
+    wrapper.__name__ = test.__name__
+    return wrapper
+
+
+@with_fake_docker
+async def test_run_container(fake, client, tmp):
+    log_path = os.path.join(tmp, "container.log")
+    state = await client.run_container(config(0.05, "hello,world", 3), name="sl_O2", log_path=log_path)
+    assert state["ExitCode"] == 3
+    with open(log_path) as f:
+        assert f.read() == "hello\nworld\n"
+    assert len(fake.containers) == 0
+
+
+@with_fake_docker
+async def test_many_containers_share_the_pool(fake, client, tmp):
+    jobs = 200
+    states = await asyncio.gather(*(
+        client.run_container(config(0.01 * (idx % 10), exit_code=idx % 2))
+        for idx in range(jobs)
+    ))
+    assert [state["ExitCode"] for state in states] == [idx % 2 for idx in range(jobs)]
+    assert len(fake.containers) == 0
+    # Four pooled connections plus the shared event stream
+    assert fake.peak_connections <= 5
+
+
+@with_fake_docker
+async def test_peak_memory(fake, client, tmp):
+    spec = config(0.2)
+    spec["Env"].append("FAKE_MEMORY=4096")
+    state = await client.run_container(spec, memory_interval=0.01)
+    assert state["PeakMemory"] == 4096
+
+
+@with_fake_docker
+async def test_commit_on_exit(fake, client, tmp):
+    async def commit(container_id, state):
+        await client.commit_container(container_id, "compile_docker_deps", "sl")
+
+    await client.run_container(config(0), on_exit=commit)
+    assert list(fake.images) == ["compile_docker_deps:sl"]
+    await client.remove_image("compile_docker_deps:sl")
+    assert len(fake.images) == 0
+
+
+@with_fake_docker
+async def test_api_error(fake, client, tmp):
+    for _ in range(3):
+        try:
+            await client.inspect_container("missing")
+        except DockerAPIError as e:
+            assert e.status == 404
+        else:
+            assert False, "expected DockerAPIError"
+    # Error responses are drained, so the connection is reused
+    assert fake.peak_connections == 1
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name} ok")
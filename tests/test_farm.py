@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""A Coordinator and several worker processes on one box.
+
+Workers are RemoteProjects whose builds are faked: a job sleeps for a
+moment and leaves a compile_succeed file, no container is started.
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+for module in ("docker", "psutil", "tqdm"):
+    pytest.importorskip(module)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from compile_project import CompileProject, compile_packages_parallel
+from farm import Coordinator, FarmClient, RemoteProject
+
+PACKAGES = [{"package": f"pkg{idx}"} for idx in range(6)]
+
+
+class FakeRemoteProject(RemoteProject):
+    def compile_package_internal(self, package_name, optimization_level, dirname, in_memory=False, image=None, source_path=None, metrics=None):
+        save_path = os.path.join(self.packages_root, dirname)
+        os.makedirs(save_path, exist_ok=True)
+        time.sleep(0.05)
+        with open(os.path.join(save_path, "compile_succeed"), "w") as f:
+            f.write(self.worker_id)
+        return "DONE"
+
+
+def run_worker(url: str, root: str):
+    project = FakeRemoteProject(root, url, heartbeat_interval=0.2)
+    project.start()
+    compile_packages_parallel(project, 0, 4, False)
+    project.stop()
+
+
+def run_crashing_worker(url: str, num_packages: int):
+    FarmClient(url, "crashed").claim(num_packages)
+    os._exit(0)
+
+
+def with_coordinator(test):
+    def wrapper():
+        with tempfile.TemporaryDirectory() as tmp:
+            project = CompileProject(os.path.join(tmp, "project"), PACKAGES)
+            coordinator = Coordinator(project, "127.0.0.1", 0, lease_timeout=1)
+            coordinator.start()
+            try:
+                test(coordinator, f"http://127.0.0.1:{coordinator.address[1]}", tmp)
+            finally:
+                coordinator.stop()
+                project.db.close()
+    wrapper.__name__ = test.__name__
+    return wrapper
+
+
+def spawn(target, *args) -> multiprocessing.Process:
+    # Forking while other tests' threads hold locks deadlocks the child
+    process = multiprocessing.get_context("spawn").Process(target=target, args=args)
+    process.start()
+    return process
+
+
+def join(processes: list, timeout: float = 60):
+    """Waits for `processes`, kills whatever is still running after `timeout`."""
+    deadline = time.monotonic() + timeout
+    try:
+        for process in processes:
+            process.join(max(0, deadline - time.monotonic()))
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+
+@with_coordinator
+def test_workers_share_jobs(coordinator, url, tmp):
+    workers = [spawn(run_worker, url, os.path.join(tmp, f"worker{idx}")) for idx in range(4)]
+    join(workers)
+    assert [worker.exitcode for worker in workers] == [0] * 4
+    assert coordinator.status() == {"DONE": len(PACKAGES) * 7}
+    # Every job ran exactly once, spread over the workers
+    outputs = []
+    for idx in range(4):
+        packages_root = os.path.join(tmp, f"worker{idx}", "packages")
+        outputs += [name for name in os.listdir(packages_root)]
+    assert sorted(outputs) == sorted(dirname for dirname, in coordinator.db.execute("SELECT dirname FROM packages"))
+    assert len(set(worker_id for worker_id, in coordinator.db.execute("SELECT worker_id FROM packages"))) > 1
+
+
+@with_coordinator
+def test_expired_lease_restored(coordinator, url, tmp):
+    crashed = spawn(run_crashing_worker, url, 5)
+    join([crashed])
+    assert coordinator.status() == {"STARTED": 5, "NOT_STARTED": len(PACKAGES) * 7 - 5}
+    # The new worker waits for the crashed worker's leases to come back
+    worker = spawn(run_worker, url, os.path.join(tmp, "worker"))
+    join([worker])
+    assert worker.exitcode == 0
+    assert coordinator.status() == {"DONE": len(PACKAGES) * 7}
+
+
+@with_coordinator
+def test_lost_lease_result_dropped(coordinator, url, tmp):
+    client = FarmClient(url, "slow")
+    package = client.claim(1)["packages"][0]
+    assert client.heartbeat([package["package_id"]]) == [package["package_id"]]
+    time.sleep(1.5)
+    coordinator.expire()
+    assert client.heartbeat([package["package_id"]]) == []
+    assert not client.finish(package["package_id"], "DONE", 1.0, None, 0)
+    assert coordinator.project.get_package_status(package["package_id"]) == "NOT_STARTED"
+
+
+@with_coordinator
+def test_connections_released(coordinator, url, tmp):
+    client = FarmClient(url, "poller", timeout=5)
+    fds = len(os.listdir("/proc/self/fd"))
+    # More requests than the usual limit of open files, each on a new thread
+    for _ in range(1100):
+        assert sum(client.status().values()) == len(PACKAGES) * 7
+    # The test's, the lease reaper's, and the last request's if it is still finishing
+    assert len(coordinator.db._connections) <= 3
+    assert len(os.listdir("/proc/self/fd")) < fds + 10
+
+
+@with_coordinator
+def test_server_error_not_retried(coordinator, url, tmp):
+    def claim(worker_id: str, num_packages: int) -> dict:
+        raise Exception("database disk image is malformed")
+
+    coordinator.claim = claim
+    client = FarmClient(url, "confused", timeout=5)
+    started = time.monotonic()
+    # Would only fail again, unlike a proxy's 502 while the coordinator restarts
+    with pytest.raises(Exception, match="rejected /claim: 500"):
+        client.claim(1)
+    assert time.monotonic() - started < 1
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name} ok")
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""Records of the file cache are kept until the file changes."""
+import os
+import sys
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from file_cache import FileCache
+from job_archive import JobDirectory
+
+
+def test_invalidation():
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, "job"))
+        path = os.path.join(tmp, "job", "a.c")
+        with open(path, "w") as f:
+            f.write("int a;\n")
+        job = JobDirectory(os.path.join(tmp, "job"))
+        with FileCache(tmp) as cache:
+            assert cache.get("packages/job/a.c", job.stat("a.c")) is None
+            cache.put("packages/job/a.c", job.stat("a.c"), "h", None, "C source, ASCII text", "Source", "C")
+            # Visible before the commit
+            assert cache.get("packages/job/a.c", job.stat("a.c"))["node_type"] == "Source"
+        with FileCache(tmp) as cache:
+            record = cache.get("packages/job/a.c", job.stat("a.c"))
+            assert record["hash"] == "h" and record["language"] == "C"
+            with open(path, "a") as f:
+                f.write("int b;\n")
+            assert cache.get("packages/job/a.c", job.stat("a.c")) is None
+            assert (cache.hits, cache.misses) == (1, 1)
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name} ok")
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Reading mirror indices into a package list with one job per source."""
+import gzip
+import os
+import sys
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from get_all_packages import compare_versions, load_sources, source_jobs
+
+SOURCES = """Package: gawk
+Binary: gawk, gawk-doc
+Version: 1:5.0.1+dfsg-1
+Architecture: any all
+Files:
+ 0123 2000 gawk_5.0.1+dfsg-1.dsc
+ 4567 3000000 gawk_5.0.1+dfsg.orig.tar.xz
+
+Package: cmocka
+Binary: libcmocka0,
+ libcmocka-dev
+Version: 1.1.5-2
+Files:
+ 89ab 100 cmocka_1.1.5-2.dsc
+
+Package: cmocka
+Binary: libcmocka0
+Version: 1.1.5-1
+Files:
+ cdef 50 cmocka_1.1.5-1.dsc
+"""
+
+PACKAGES = """Package: libcmocka-doc
+Source: cmocka (1.1.5-2build1)
+Version: 1.1.5-2build1
+
+Package: gawk
+Version: 1:5.0.1+dfsg-1
+"""
+
+
+def test_compare_versions():
+    assert compare_versions("1:1.0", "2.0") == 1
+    assert compare_versions("1.0~rc1", "1.0") == -1
+    assert compare_versions("1.0-1", "1.0-1ubuntu1") == -1
+    assert compare_versions("1.10", "1.9") == 1
+    assert compare_versions("1.0", "1.0-0") == 0
+
+
+def test_source_jobs():
+    with tempfile.TemporaryDirectory() as tmp:
+        with gzip.open(os.path.join(tmp, "Sources.gz"), "wt") as f:
+            f.write(SOURCES)
+        with open(os.path.join(tmp, "Packages"), "w") as f:
+            f.write(PACKAGES)
+        sources, binaries = load_sources([os.path.join(tmp, "Sources.gz")], [os.path.join(tmp, "Packages")])
+        assert sources["cmocka"]["version"] == "1.1.5-2"
+        assert binaries["libcmocka-dev"] == binaries["libcmocka-doc"] == "cmocka"
+        jobs = source_jobs(sources, binaries, ["libcmocka0", "gawk-doc", "libcmocka-dev", "gawk", "missing"])
+        assert [(job["package"], job["version"], job["size"]) for job in jobs] == [
+            ("cmocka", "1.1.5-2", 100),
+            ("gawk", "1:5.0.1+dfsg-1", 3002000)
+        ]
+        assert len(source_jobs(sources, binaries)) == 2
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name} ok")
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Packing a job directory and reading it back without unpacking."""
+import errno
+import os
+import sys
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import job_archive
+from job_archive import JobArchive, JobDirectory, open_job, pack, unpack
+
+
+def make_job(path: str):
+    for task in ("gcc/1", "gcc/2", "ld/1"):
+        os.makedirs(os.path.join(path, task, "input"))
+        os.makedirs(os.path.join(path, task, "output"))
+    # Identical headers across tasks, as across optimization levels
+    for task in ("gcc/1", "gcc/2"):
+        with open(os.path.join(path, task, "input", "common.h"), "w") as f:
+            f.write("#define COMMON 1\n" * 1000)
+    with open(os.path.join(path, "gcc/1/output", "a.o"), "wb") as f:
+        f.write(bytes(range(256)) * 64)
+    with open(os.path.join(path, "compile.log"), "w") as f:
+        f.write("ok\n")
+    os.symlink("../../../gcc/1/output/a.o", os.path.join(path, "ld/1/input", "a.o"))
+
+
+def test_round_trip():
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "job")
+        make_job(src)
+        res = pack(src, src + job_archive.SUFFIX)
+        assert res["files"] == 5
+        assert res["packed_bytes"] < res["bytes"]
+        directory = JobDirectory(src)
+        with JobArchive(src + job_archive.SUFFIX) as archive:
+            assert sorted(archive.names()) == sorted(directory.names())
+            assert sorted(archive.listdir()) == ["compile.log", "gcc", "ld"]
+            assert sorted(archive.listdir("gcc")) == ["1", "2"]
+            # Empty directories survive
+            assert archive.isdir("gcc/2/output") and archive.listdir("gcc/2/output") == []
+            assert not archive.exists("gcc/3")
+            for name in directory.names():
+                assert archive.read(name) == directory.read(name)
+                assert archive.hash(name) == directory.hash(name)
+            # Identical files share one blob
+            assert archive.entries["gcc/1/input/common.h"]["offset"] == archive.entries["gcc/2/input/common.h"]["offset"]
+        unpack(src + job_archive.SUFFIX, os.path.join(tmp, "unpacked"))
+        unpacked = JobDirectory(os.path.join(tmp, "unpacked"))
+        assert sorted(unpacked.names()) == sorted(directory.names())
+        assert os.path.islink(os.path.join(tmp, "unpacked", "ld/1/input/a.o"))
+
+
+def test_open_job():
+    with tempfile.TemporaryDirectory() as tmp:
+        make_job(os.path.join(tmp, "job"))
+        assert isinstance(open_job(tmp, "job"), JobDirectory)
+        job_archive._pack_job(tmp, "job")
+        assert not os.path.exists(os.path.join(tmp, "job"))
+        with open_job(tmp, "job") as job:
+            assert isinstance(job, JobArchive)
+            assert job.read("compile.log") == b"ok\n"
+        assert job_archive.job_dirname("job" + job_archive.SUFFIX) == "job"
+
+
+def test_links_and_special_files():
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "job")
+        make_job(src)
+        os.symlink("gcc/1", os.path.join(src, "latest"))
+        os.symlink("loop", os.path.join(src, "loop"))
+        job_archive._pack_job(tmp, "job")
+        with open_job(tmp, "job") as job:
+            assert job.readlink("latest") == "gcc/1"
+            assert "latest" not in job.names() and "latest" in job.listdir()
+            try:
+                job.read("loop")
+                assert False
+            except OSError as e:
+                assert e.errno == errno.ELOOP
+        job_archive._unpack_job(tmp, "job")
+        assert os.readlink(os.path.join(src, "latest")) == "gcc/1"
+        # A FIFO cannot be packed, the directory stays
+        os.mkfifo(os.path.join(src, "gcc/1/input/pipe"))
+        try:
+            job_archive._pack_job(tmp, "job")
+            assert False
+        except Exception as e:
+            assert "does not match" in str(e)
+        assert os.path.isdir(src) and not os.path.exists(src + job_archive.SUFFIX)
+
+
+def test_linked_directories():
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "job")
+        make_job(src)
+        os.symlink("gcc/1", os.path.join(src, "latest"))
+        # The link in ld/1/input is relative to where it really is
+        os.symlink("../ld", os.path.join(src, "gcc", "ld"))
+        names = ["latest", "latest/input", "latest/output/a.o", "gcc/ld/1/input/a.o", "latest/missing", "compile.log/a"]
+        directory = JobDirectory(src)
+        expected = [(directory.isdir(name), directory.exists(name)) for name in names]
+        job_archive._pack_job(tmp, "job")
+        with open_job(tmp, "job") as job:
+            assert [(job.isdir(name), job.exists(name)) for name in names] == expected
+            assert sorted(job.listdir("latest")) == ["input", "output"]
+            assert job.read("latest/output/a.o") == job.read("gcc/ld/1/input/a.o") == bytes(range(256)) * 64
+            assert job.readlink("gcc/ld/1/input/a.o") == "../../../gcc/1/output/a.o"
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name} ok")
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Jobs that cannot produce gcc output are skipped before scheduling."""
+import os
+import sys
+import tempfile
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from preflight import Preflight
+from project_db import ProjectDB
+
+SOURCES = """Package: fonts-foo
+Binary: fonts-foo
+Version: 1.0-1
+Architecture: all
+
+Package: bar
+Binary: bar, bar-doc
+Version: 2.0-1
+Architecture: any all
+Package-List:
+ bar deb utils optional arch=all
+ bar-doc deb doc optional arch=all
+
+Package: baz
+Binary: baz
+Version: 3.0-1
+Architecture: any
+"""
+
+
+def test_preflight():
+    with tempfile.TemporaryDirectory() as tmp:
+        db = ProjectDB(os.path.join(tmp, "project_db.sqlite3"))
+        db.migrate()
+        packages_root = os.path.join(tmp, "packages")
+        jobs = [
+            ("fonts-foo", "0", "NOT_STARTED", None),
+            ("bar", "0", "NOT_STARTED", None),
+            ("baz", "0", "NOT_STARTED", None),
+            ("qux", "0", "DONE", 100.0),
+            ("qux", "2", "NOT_STARTED", None),
+            ("qux", "3", "NOT_STARTED", None),
+        ]
+        for package_name, level, status, wall_time in jobs:
+            db.execute(
+                "INSERT INTO packages (package_name, optimization_level, status, dirname, wall_time) VALUES (?, ?, ?, ?, ?)",
+                (package_name, level, status, f"{package_name}_O{level}", wall_time)
+            )
+        # qux ran no gcc task at -O0
+        os.makedirs(os.path.join(packages_root, "qux_O0", "gcc"))
+        with open(os.path.join(tmp, "Sources"), "w") as f:
+            f.write(SOURCES)
+        preflight = Preflight(db, packages_root)
+        report = preflight.run([os.path.join(tmp, "Sources")], dry_run=True)
+        assert db.execute("SELECT count(*) FROM packages WHERE status = 'SKIPPED'")[0][0] == 0
+        report = preflight.run([os.path.join(tmp, "Sources")])
+        assert report["arch:all"]["jobs"] == 2
+        assert report["no gcc output"] == {"jobs": 2, "seconds": 200.0}
+        assert db.execute("SELECT package_name FROM packages WHERE status = 'NOT_STARTED'") == [("baz",)]
+        assert preflight.reset() == 4
+        db.close()
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name} ok")
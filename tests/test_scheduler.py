@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""WorkerPool admission with fake jobs and a fake load monitor."""
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("psutil")
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from scheduler import WorkerPool
+
+
+class FakeMonitor:
+    """Load as the test sets it, samples when the test calls `sample`."""
+
+    def __init__(self, cpu: float = 0, memory: float = 0):
+        self.cpu = cpu
+        self.memory = memory
+        self.listeners = []
+
+    def sample(self):
+        for listener in self.listeners:
+            listener()
+
+    def is_alive(self):
+        return True
+
+    def stop(self):
+        pass
+
+
+class Jobs:
+    """Hands out `jobs` in batches and records what runs at the same time."""
+
+    def __init__(self, jobs: list, weight=None, duration: float = 0.01):
+        self.todo = list(jobs)
+        self.weight = weight or (lambda job: 0)
+        self.duration = duration
+        self.ran = []
+        self.running = []
+        self.max_running = 0
+        self.max_weight = 0
+        self.lock = threading.Lock()
+
+    def fetch(self, num_jobs: int) -> list:
+        with self.lock:
+            res, self.todo = self.todo[:num_jobs], self.todo[num_jobs:]
+            return res
+
+    def run(self, job):
+        with self.lock:
+            self.running.append(job)
+            self.max_running = max(self.max_running, len(self.running))
+            self.max_weight = max(self.max_weight, sum(self.weight(job) for job in self.running))
+        time.sleep(self.duration)
+        with self.lock:
+            self.running.remove(job)
+            self.ran.append(job)
+
+
+def test_every_job_once_within_capacity():
+    # Weights of 1 to 5, a capacity of 8: never more than a few at once
+    jobs = Jobs(range(60), weight=lambda job: job % 5 + 1)
+    pool = WorkerPool(jobs.fetch, jobs.run, 8, monitor=FakeMonitor(), weight=jobs.weight, capacity=8)
+    pool.start()
+    pool.join()
+    assert sorted(jobs.ran) == list(range(60))
+    assert jobs.max_weight <= 8
+    assert jobs.max_running > 1
+    assert pool.running == 0 and pool.committed == 0
+
+
+def test_heavy_job_runs_alone():
+    jobs = Jobs([1, 20, 1], weight=lambda job: job)
+    pool = WorkerPool(jobs.fetch, jobs.run, 4, monitor=FakeMonitor(), weight=jobs.weight, capacity=10)
+    pool.start()
+    pool.join()
+    assert sorted(jobs.ran) == [1, 1, 20]
+    # Over capacity on its own, so only on an idle pool
+    assert jobs.max_weight <= 20 and jobs.max_running <= 2
+
+
+def test_ramp_up():
+    release = threading.Event()
+    jobs = Jobs(range(20))
+    run = jobs.run
+
+    def blocking_run(job):
+        release.wait(10)
+        run(job)
+
+    monitor = FakeMonitor()
+    pool = WorkerPool(jobs.fetch, blocking_run, 8, ramp_up=True, monitor=monitor)
+    pool.start()
+    time.sleep(0.2)
+    # One slot until the first load sample
+    assert pool.running == 1
+    monitor.sample()
+    time.sleep(0.2)
+    assert pool.running == 2
+    monitor.sample()
+    time.sleep(0.2)
+    assert pool.running == 4
+    # Overloaded: no new slots, the limit shrinks below what runs
+    monitor.cpu = 95
+    monitor.sample()
+    assert pool.limit == 3
+    release.set()
+    pool.join()
+    assert sorted(jobs.ran) == list(range(20))
+    assert jobs.max_running <= 4
+
+
+def test_slow_fetch():
+    # Like a farm worker waiting for leases to come back: running jobs finish meanwhile
+    jobs = Jobs(["a"])
+    released = []
+
+    def fetch(num_jobs: int) -> list:
+        if len(jobs.todo) > 0:
+            return jobs.fetch(num_jobs)
+        deadline = time.monotonic() + 5
+        while pool.running > 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        released.append(pool.running == 0)
+        return []
+
+    pool = WorkerPool(fetch, jobs.run, 2, monitor=FakeMonitor())
+    pool.start()
+    pool.join()
+    assert jobs.ran == ["a"]
+    assert released == [True]
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name} ok")
@@ -0,0 +1,55 @@
+import concurrent.futures
+import logging
+import os
+import shutil
+import uuid
+
+MAX_WORKERS = 4
+
+
+class Trash:
+    """Deletes directories (or files) in the background.
+
+    `discard(path)` renames the directory into `root` and returns at once;
+    a small thread pool removes it from there. The rename is atomic, so a
+    crash never leaves a half-deleted directory at its original place, and
+    whatever is still in `root` on the next start is removed then.
+    `root` must be on the same filesystem as the discarded directories.
+    """
+
+    def __init__(self, root: str, max_workers: int = MAX_WORKERS):
+        self.root = root
+        self.logger = logging.getLogger("Trash")
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="Trash")
+        os.makedirs(root, exist_ok=True)
+        # Left behind by an interrupted run
+        for name in os.listdir(root):
+            self.executor.submit(self._remove, os.path.join(root, name))
+
+    def _remove(self, path: str):
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.logger.warning("Failed to remove %s: %s", path, e)
+
+    def discard(self, path: str) -> bool:
+        """Moves `path` out of the way to be deleted, returns False if it does not exist."""
+        target = os.path.join(self.root, f"{uuid.uuid4().hex}_{os.path.basename(path)}")
+        try:
+            os.rename(path, target)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            # e.g. another filesystem, delete in place
+            self.logger.warning("Failed to move %s to trash: %s", path, e)
+            target = path
+        self.executor.submit(self._remove, target)
+        return True
+
+    def close(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)